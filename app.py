@@ -1,4 +1,14 @@
 import sys
+import os
+
+# Socket.IO server mode: "threading" (default, plain Werkzeug/gunicorn
+# threads) or "eventlet". eventlet must patch the standard library before
+# anything else is imported.
+SOCKETIO_ASYNC_MODE = os.environ.get("SOCKETIO_ASYNC_MODE", "threading")
+if SOCKETIO_ASYNC_MODE == "eventlet":
+    import eventlet
+    eventlet.monkey_patch()
+
 import collections
 from OpenSSL import crypto
 import base64
@@ -16,12 +26,23 @@ if sys.version_info >= (3, 3):
 # Now import everything else
 from flask import Flask, request, jsonify, render_template, session, redirect, Response, url_for
 from flask_cors import CORS
-import json, os, time, sqlite3, traceback, uuid, re
+import json, os, time, sqlite3, threading, traceback, uuid, re
 from urllib.parse import urlparse
 import random, time, hashlib
+import bisect, heapq, itertools
 from datetime import datetime, time as dt_time
-from collections import defaultdict
 from image_filter_ai import classify_image as _gschool_classify_image
+from image_filter_ai import ImageBatcher, VerdictCache, normalize_src
+from backplane import make_backplane
+from locks import LockManager
+from event_store import CommandLog, EventRing, MinuteCounters, StudentEventLog
+from chat_store import ChatStore
+from realtime import EventHub, Waiters, sse_format
+from screenshot_store import IMAGE_TYPES, ScreenshotStore, parse_image_data_url
+from string_table import StringTable
+from present_registry import PresentRegistry, RoomFull
+from presence_shards import PresenceShards
+from janitor import Janitor
 import jwt
 from functools import wraps
 import plistlib
@@ -38,6 +59,19 @@ app = Flask(__name__, static_url_path="/static", static_folder="static", templat
 app.secret_key = os.environ.get("SECRET_KEY", "dev_secret_key")
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+# ImageBatcher spawns its workers, and a spawned child re-imports the entry
+# script as "__mp_main__". Such a child only scores images, so it skips the
+# background threads and startup passes below.
+_POOL_WORKER = __name__ == "__mp_main__"
+
+# Real-time channel to student extensions (HTTP polling stays as fallback)
+try:
+    from flask_socketio import SocketIO, join_room
+    socketio = SocketIO(app, async_mode=SOCKETIO_ASYNC_MODE, cors_allowed_origins="*")
+except Exception as e:
+    print("[WARN] Socket.IO unavailable, students will poll:", e)
+    socketio = None
+
 # Register AI blueprint (AI category classifier & chat)
 try:
     from ai_routes import ai as ai_blueprint
@@ -124,6 +158,285 @@ def _init_db():
 
 _init_db()
 
+# Shared state between worker processes (see backplane.py). The default
+# keeps everything in this process; to run several gunicorn workers set
+# BACKPLANE_URL=sqlite:// (one machine) or redis://host:6379/0.
+BACKPLANE = make_backplane(os.environ.get("BACKPLANE_URL", "local://"),
+                           sqlite_path=os.path.join(ROOT, "backplane.db"))
+
+# Locks around read-modify-write of data.json: "student:<email>" and
+# "class:<cid>" for one entity, "data.json" (held only by save_data) for
+# the file itself. Wait/hold metrics at /api/locks/stats.
+DATA_LOCKS = LockManager(BACKPLANE, timeout=float(os.environ.get("DATA_LOCK_TIMEOUT", "10")))
+
+def _socket_emit(event, data, to=None, namespace=None):
+    """Emit to Socket.IO clients connected to any worker."""
+    if socketio is None:
+        return
+    BACKPLANE.publish("socketio", {"op": "emit", "event": event, "data": data, "to": to, "ns": namespace})
+
+def _on_socket_message(msg):
+    try:
+        if msg.get("op") == "emit":
+            socketio.emit(msg["event"], msg.get("data"), to=msg.get("to"), namespace=msg.get("ns"))
+        elif msg.get("op") == "class_room":
+            _sync_class_room_local(msg["class_id"], msg.get("students"))
+    except Exception as e:
+        print("[WARN] Socket.IO push failed:", e)
+
+if socketio is not None and not _POOL_WORKER:
+    BACKPLANE.subscribe("socketio", _on_socket_message)
+
+# Append-only event streams (SQLite-backed ring buffers with sequence ids).
+# These used to be lists in data.json that were copied, trimmed and
+# rewritten on every event; clients now poll with ?after=<seq>.
+IMAGE_FILTER_EVENTS = EventRing(DB_PATH, "image_filter_events", capacity=500)
+# Alerts are read and cleared per student, so they are indexed that way.
+ALERTS = StudentEventLog(DB_PATH, "alerts", per_student=int(os.environ.get("ALERTS_PER_STUDENT", "200")))
+OFFTASK_EVENTS = EventRing(DB_PATH, "offtask_events", capacity=2000)
+
+# Per-student minute buckets behind /api/engagement ("timeline", "offtask",
+# "alert"), counted as events come in; kept for the longest window served.
+ENGAGEMENT_MAX_WINDOW = 14400
+ENGAGEMENT = MinuteCounters(DB_PATH, retention=ENGAGEMENT_MAX_WINDOW + 60)
+
+# Commands for student extensions: one row per send, read through per-student
+# ack cursors. Unread commands expire after COMMAND_TTL seconds.
+COMMANDS = CommandLog(DB_PATH, ttl=int(os.environ.get("COMMAND_TTL", "3600")))
+
+# Class chat ("class:<cid>") and DMs ("dm:<student>"), paged by message id,
+# with per-room unread counters for each side.
+CHAT = ChatStore(DB_PATH)
+
+# URLs, titles and favicons in presence, history and screenshot rows are
+# stored as ids into this table; decode before returning them to clients.
+# The janitor collects ids those rows no longer use (RETENTION["string_table"]).
+STRINGS = StringTable(DB_PATH)
+TEXT_FIELDS = ("url", "title", "favIconUrl")
+
+# Screenshot-log images (full size plus a thumbnail rendered in the
+# background); data.json keeps only their metadata and `shot_id`.
+SCREENSHOTS = ScreenshotStore(DB_PATH)
+SCREENSHOTS_PER_STUDENT = 200
+
+def _decode_presence(pres):
+    """Copy of a presence entry with its tab/tabs text fields decoded."""
+    tabs = [t for t in pres.get("tabs") or [] if isinstance(t, dict)]
+    rows = STRINGS.decode_rows([pres.get("tab") or {}] + tabs, TEXT_FIELDS)
+    out = dict(pres)
+    if "tab" in pres:
+        out["tab"] = rows[0]
+    if "tabs" in pres:
+        out["tabs"] = rows[1:]
+    return out
+
+# Live events for teacher dashboards (/api/stream), one channel per class.
+HUB = EventHub(backplane=BACKPLANE)
+
+# Live presence of each active class's students, for /api/presence; kept
+# in step with rosters by _sync_presence_shard().
+PRESENCE_SHARDS = PresenceShards(BACKPLANE)
+
+# Long-poll waiters (?wait=N), keyed by lowercased student email. Commands
+# wake theirs when sent; policy waiters are woken by _policy_changed() from
+# the writers of anything /api/policy reads.
+COMMAND_WAITERS = Waiters(backplane=BACKPLANE, name="waiters:commands")
+POLICY_WAITERS = Waiters(backplane=BACKPLANE, name="waiters:policy")
+LONG_POLL_MAX = 55  # seconds; stay under typical proxy idle timeouts
+
+# /api/state document, rebuilt only when "state:version" moves (bumped by
+# _state_changed() and set_setting()).
+_STATE_CACHE = {"entry": None}  # entry: (version, doc, etag)
+
+def _migrate_event_lists():
+    """One-time move of legacy data.json event lists into their streams."""
+    if not os.path.exists(DATA_PATH):
+        return
+    try:
+        with open(DATA_PATH, "r", encoding="utf-8") as f:
+            d = json.load(f)
+    except Exception:
+        return
+    if not isinstance(d, dict):
+        return
+    moved = False
+    for key, ring in (("image_filter_events", IMAGE_FILTER_EVENTS),
+                      ("alerts", ALERTS),
+                      ("offtask_events", OFFTASK_EVENTS)):
+        legacy = d.get(key)
+        if isinstance(legacy, list):
+            if legacy:
+                ring.seed([e for e in legacy if isinstance(e, dict)])
+            d.pop(key, None)
+            moved = True
+    # Per-student command queues -> command log ("_meta" was never delivered).
+    queues = d.pop("pending_commands", None)
+    if isinstance(queues, dict):
+        for who, cmds in queues.items():
+            if who == "_meta" or not isinstance(cmds, list):
+                continue
+            target = "*" if who == "*" else "student:" + (who or "").strip().lower()
+            for cmd in cmds:
+                if isinstance(cmd, dict):
+                    COMMANDS.append(target, cmd)
+        moved = True
+    # Class chat and the (never written) DM map -> chat store, as read.
+    for key, prefix in (("chat", "class:"), ("dm", "dm:")):
+        rooms = d.pop(key, None)
+        if not isinstance(rooms, dict):
+            continue
+        for name, msgs in rooms.items():
+            items = [(m.get("user") or m.get("from"), m.get("from") or "student", m.get("text") or "", m.get("ts"))
+                     for m in msgs or [] if isinstance(m, dict)]
+            if items:
+                CHAT.extend(prefix + name, items)
+                for reader in ("student", "teacher"):
+                    CHAT.mark_read(prefix + name, reader)
+        moved = True
+    if moved:
+        with open(DATA_PATH, "w", encoding="utf-8") as f:
+            json.dump(d, f, indent=2)
+
+_migrate_event_lists()
+
+# Browsing timeline: history[student] is a list of intervals
+#   {"url", "title", "favIconUrl", "start", "end", "ts": start}
+# extended in place while the student stays on one URL. Heartbeats used to
+# append a row every TIMELINE_SAMPLE seconds instead; expand=1 on
+# /api/timeline reproduces those rows. A gap of more than TIMELINE_GAP
+# seconds without heartbeats starts a new interval.
+TIMELINE_SAMPLE = 15
+TIMELINE_GAP = 60
+TIMELINE_MAX = 500
+
+def _as_interval(e):
+    """Interval form of a history entry (legacy point rows have only `ts`)."""
+    start = int(e.get("start", e.get("ts")) or 0)
+    return dict(e, start=start, end=max(start, int(e.get("end", start) or start)), ts=start)
+
+def _interval_samples(iv, since=0):
+    """Timestamps of the per-sample rows an interval stands for, from `since`."""
+    start, end = iv["start"], iv["end"]
+    first = start if since <= start else start + -(-(since - start) // TIMELINE_SAMPLE) * TIMELINE_SAMPLE
+    return range(first, end + 1, TIMELINE_SAMPLE)
+
+def _compact_timeline(timeline):
+    """Convert legacy point rows to intervals, merging repeats of one URL."""
+    out = []
+    for e in timeline:
+        if not isinstance(e, dict):
+            continue
+        iv = _as_interval(e)
+        last = out[-1] if out else None
+        if last and last.get("url") == iv.get("url") and iv["start"] - last["end"] <= TIMELINE_GAP:
+            last["end"] = max(last["end"], iv["end"])
+        else:
+            out.append(iv)
+    return out
+
+def _seed_engagement_counts():
+    """Backfill the engagement buckets from stored events on first run."""
+    with BACKPLANE.lock("seed:engagement", timeout=30):
+        if not ENGAGEMENT.is_empty():
+            return
+        since = int(time.time()) - ENGAGEMENT_MAX_WINDOW
+        items = []
+        try:
+            with open(DATA_PATH, "r", encoding="utf-8") as f:
+                history = (json.load(f) or {}).get("history") or {}
+        except Exception:
+            history = {}
+        for student, arr in history.items():
+            for e in arr or []:
+                if isinstance(e, dict):
+                    for ts in _interval_samples(_as_interval(e), since):
+                        items.append((student, "timeline", 1, ts))
+        for e in OFFTASK_EVENTS.latest():
+            if (e.get("ts") or 0) >= since and not bool(e.get("on_task", True)):
+                items.append((e.get("student"), "offtask", 1, e["ts"]))
+        for a in ALERTS.latest():
+            if (a.get("ts") or 0) >= since:
+                items.append((a.get("student"), "alert", 1, a["ts"]))
+        ENGAGEMENT.add_many(items)
+
+_seed_engagement_counts()
+
+def _migrate_screenshot_blobs():
+    """One-time move of inline screenshot-log images into SCREENSHOTS.
+
+    Images the store rejects are dropped rather than left inline."""
+    with BACKPLANE.lock("migrate:screenshots", timeout=60):
+        try:
+            with open(DATA_PATH, "r", encoding="utf-8") as f:
+                d = json.load(f)
+        except Exception:
+            return
+        moved = False
+        for student, arr in ((d or {}).get("screenshots") or {}).items():
+            for e in arr if isinstance(arr, list) else []:
+                if isinstance(e, dict) and "dataUrl" in e:
+                    shot_id = SCREENSHOTS.put(student, e.pop("dataUrl"), ts=e.get("ts"))
+                    if shot_id:
+                        e["shot_id"] = shot_id
+                    moved = True
+        if moved:
+            with open(DATA_PATH, "w", encoding="utf-8") as f:
+                json.dump(d, f, indent=2)
+
+_migrate_screenshot_blobs()
+
+def _after_seq_arg():
+    """Parse ?after=<seq> (None when absent or invalid)."""
+    try:
+        return int(request.args["after"])
+    except (KeyError, ValueError):
+        return None
+
+def _wait_arg():
+    """Parse ?wait=<seconds> for long-poll endpoints (0 when absent or invalid)."""
+    try:
+        return max(0.0, min(float(request.args.get("wait") or 0), LONG_POLL_MAX))
+    except ValueError:
+        return 0.0
+
+def _fingerprint(obj):
+    return hashlib.md5(json.dumps(obj, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def _queue_pending(students, item):
+    """Append `item` to each student's pending_per_student queue.
+
+    /api/policy drains a queue under the student's lock, so appends take
+    the same locks and re-load, rather than riding along with a bigger
+    document loaded earlier.
+    """
+    students = sorted({s for s in students if s})
+    if not students:
+        return
+    with DATA_LOCKS.hold(*(f"student:{s.lower()}" for s in students)):
+        d = ensure_keys(load_data())
+        pend = d.setdefault("pending_per_student", {})
+        for s in students:
+            arr = pend.setdefault(s, [])
+            arr.append(dict(item))
+            arr[:] = arr[-50:]
+        save_data(d)
+
+def _policy_changed(*students):
+    """Wake /api/policy long-pollers after saving something it serves.
+
+    Pass the students whose overrides, scenes or pending items changed;
+    with none, everyone is woken (settings, classes, categories, scenes,
+    policies, announcements, ...).
+    """
+    if not students:
+        POLICY_WAITERS.notify("*")
+    for key in {(s or "").strip().lower() for s in students}:
+        POLICY_WAITERS.notify(key)
+
+def _state_changed():
+    """Move "state:version" after saving anything /api/state serves."""
+    BACKPLANE.incr("state:version")
+
 def _safe_default_data():
     return {
         "settings": {"chat_enabled": False},
@@ -141,13 +454,10 @@ def _safe_default_data():
             }
         },
         "categories": {},
-        "pending_commands": {},
         "pending_per_student": {},
         "presence": {},
         "history": {},
         "screenshots": {},
-        "dm": {},
-        "alerts": [],
         "audit": []
     }
 
@@ -164,6 +474,16 @@ def _coerce_to_dict(obj):
         return d
     return _safe_default_data()
 
+class _DataDoc(dict):
+    """data.json contents plus the text and file version they were loaded from (see save_data)."""
+    __slots__ = ("base", "stat")
+
+def _data_stat(st):
+    """Identity of one version of data.json; save_data() swaps in a new file every write."""
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+_MISSING = object()
+
 def load_data():
     """Load JSON with self-repair for common corruption patterns."""
     if not os.path.exists(DATA_PATH):
@@ -172,8 +492,15 @@ def load_data():
         return d
     try:
         with open(DATA_PATH, "r", encoding="utf-8") as f:
-            obj = json.load(f)
-            return ensure_keys(_coerce_to_dict(obj))
+            stat = _data_stat(os.fstat(f.fileno()))
+            text = f.read()
+        obj = json.loads(text)
+        if isinstance(obj, dict):
+            doc = _DataDoc(obj)
+            doc.base = text
+            doc.stat = stat
+            return ensure_keys(doc)
+        return ensure_keys(_coerce_to_dict(obj))
     except json.JSONDecodeError as e:
         # Try simple auto-repair: merge stray blocks like "} {"
         try:
@@ -197,10 +524,86 @@ def load_data():
         print("[WARN] load_data failed; using defaults:", e)
         return ensure_keys(_safe_default_data())
 
+def _merge_changes(base, mine, theirs):
+    """Apply what changed from `base` to `mine` onto `theirs`, per entity.
+
+    Entities are second-level keys (presence[student], classes[cid], ...),
+    or the whole value for top-level keys that are not dicts. Returns
+    `theirs`, or None if `mine` has no changes at all.
+    """
+    changed = False
+    for k in set(base) | set(mine):
+        b, m = base.get(k, _MISSING), mine.get(k, _MISSING)
+        if b == m:
+            continue
+        changed = True
+        t = theirs.get(k)
+        if isinstance(b, dict) and isinstance(m, dict) and isinstance(t, dict):
+            for sk in set(b) | set(m):
+                if b.get(sk, _MISSING) != m.get(sk, _MISSING):
+                    if sk in m:
+                        t[sk] = m[sk]
+                    else:
+                        t.pop(sk, None)
+        elif m is _MISSING:
+            theirs.pop(k, None)
+        else:
+            theirs[k] = m
+    return theirs if changed else None
+
 def save_data(d):
+    """Write `d` to data.json.
+
+    A document from load_data() only writes what changed since it was
+    loaded, merged into the file as it is now, so a request that loaded
+    earlier does not roll back entities other requests saved meanwhile.
+    When the file has not been replaced since `d` was loaded there is
+    nothing to merge and `d` is written as is. Two requests changing the
+    same entity -- including the same top-level list (audit, raises,
+    exam_violations) -- still need a DATA_LOCKS lock around their
+    load/modify/save.
+    """
     d = ensure_keys(_coerce_to_dict(d))
-    with open(DATA_PATH, "w", encoding="utf-8") as f:
-        json.dump(d, f, indent=2)
+    with DATA_LOCKS.hold("data.json"):
+        out = d
+        text = None
+        base = getattr(d, "base", None)
+        if base is not None:
+            try:
+                on_disk = _data_stat(os.stat(DATA_PATH))
+            except OSError:
+                on_disk = None
+            if on_disk is not None and on_disk == d.stat:
+                # Nobody wrote since `d` was loaded: write it as is.
+                text = json.dumps(d, indent=2)
+                if text == base:
+                    return
+            else:
+                try:
+                    with open(DATA_PATH, "r", encoding="utf-8") as f:
+                        current = ensure_keys(_coerce_to_dict(json.load(f)))
+                except Exception:
+                    current = None
+                if current is not None:
+                    out = _merge_changes(ensure_keys(json.loads(base)), d, current)
+                    if out is None:
+                        return
+        if text is None:
+            text = json.dumps(out, indent=2)
+        # Write to a temp file and swap it in, so a concurrent load_data() never
+        # sees a half-written file (long-poll wakeups make that overlap common).
+        tmp = "%s.%d.%d.tmp" % (DATA_PATH, os.getpid(), threading.get_ident())
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        stat = _data_stat(os.stat(tmp))
+        os.replace(tmp, DATA_PATH)
+        if base is not None:
+            if out is d:
+                d.base, d.stat = text, stat
+            else:
+                # The file now also holds other requests' changes, so the
+                # next save of `d` has to merge again.
+                d.base, d.stat = json.dumps(d), None
 
 def get_setting(key, default=None):
     con = db(); cur = con.cursor()
@@ -218,6 +621,7 @@ def set_setting(key, value):
     con = db(); cur = con.cursor()
     cur.execute("REPLACE INTO settings (k, v) VALUES (?,?)", (key, json.dumps(value)))
     con.commit(); con.close()
+    _state_changed()
 
 def current_user():
     return session.get("user")
@@ -281,15 +685,12 @@ def ensure_keys(d):
 
     # Core collections
     d.setdefault("categories", {})
-    d.setdefault("pending_commands", {})
     d.setdefault("pending_per_student", {})
     d.setdefault("student_scenes", {})
     d.setdefault("class_scenes", {})
     d.setdefault("presence", {})
     d.setdefault("history", {})
     d.setdefault("screenshots", {})
-    d.setdefault("alerts", [])
-    d.setdefault("dm", {})
     d.setdefault("audit", [])
 
     # Policy system
@@ -307,13 +708,14 @@ def ensure_keys(d):
 
 def log_action(entry):
     try:
-        d = ensure_keys(load_data())
-        log = d.setdefault("audit", [])
-        entry = dict(entry or {})
-        entry["ts"] = int(time.time())
-        log.append(entry)
-        d["audit"] = log[-500:]
-        save_data(d)
+        with DATA_LOCKS.hold("audit"):
+            d = ensure_keys(load_data())
+            log = d.setdefault("audit", [])
+            entry = dict(entry or {})
+            entry["ts"] = int(time.time())
+            log.append(entry)
+            d["audit"] = log[-500:]
+            save_data(d)
     except Exception:
         pass
 
@@ -638,12 +1040,10 @@ def gprotect_manage_ai_categories(child_email):
     
     d["gprotect"]["ai_categories"][child_email] = categories
     
-    # Push policy refresh to child
-    d.setdefault("pending_per_student", {}).setdefault(child_email, []).append({
-        "type": "gprotect_refresh"
-    })
-    
     save_data(d)
+    # Push policy refresh to child
+    _queue_pending([child_email], {"type": "gprotect_refresh"})
+    _policy_changed(child_email)
     log_action({"event": "gprotect_ai_categories_update", "parent": parent_email, "child": child_email})
     
     return jsonify({"ok": True, "categories": categories})
@@ -680,12 +1080,10 @@ def gprotect_manage_manual(child_email):
     if "allows" in body:
         d["gprotect"]["manual_allows"][child_email] = body["allows"]
     
-    # Push refresh
-    d.setdefault("pending_per_student", {}).setdefault(child_email, []).append({
-        "type": "gprotect_refresh"
-    })
-    
     save_data(d)
+    # Push refresh
+    _queue_pending([child_email], {"type": "gprotect_refresh"})
+    _policy_changed(child_email)
     log_action({"event": "gprotect_manual_update", "parent": parent_email, "child": child_email})
     
     return jsonify({"ok": True})
@@ -724,12 +1122,10 @@ def gprotect_manage_schedules(child_email):
     schedules[schedule_type] = config
     d["gprotect"]["schedules"][child_email] = schedules
     
-    # Push refresh
-    d.setdefault("pending_per_student", {}).setdefault(child_email, []).append({
-        "type": "gprotect_refresh"
-    })
-    
     save_data(d)
+    # Push refresh
+    _queue_pending([child_email], {"type": "gprotect_refresh"})
+    _policy_changed(child_email)
     log_action({"event": "gprotect_schedule_update", "parent": parent_email, "child": child_email, "type": schedule_type})
     
     return jsonify({"ok": True, "schedules": schedules})
@@ -937,20 +1333,22 @@ def gprotect_log_event():
     url = body.get("url", "")
     data = body.get("data", {})
     
-    d = ensure_keys(load_data())
-    _ensure_gprotect_structure(d)
-    
-    logs = d["gprotect"]["logs"]
-    logs.append({
-        "ts": int(time.time()),
-        "child": child_email,
-        "type": event_type,
-        "url": url,
-        "data": data
-    })
-    
-    d["gprotect"]["logs"] = logs[-5000:]
-    save_data(d)
+    # Shared with the janitor's sweep of old logs.
+    with DATA_LOCKS.hold("gprotect:logs"):
+        d = ensure_keys(load_data())
+        _ensure_gprotect_structure(d)
+
+        logs = d["gprotect"]["logs"]
+        logs.append({
+            "ts": int(time.time()),
+            "child": child_email,
+            "type": event_type,
+            "url": url,
+            "data": data
+        })
+
+        d["gprotect"]["logs"] = logs[-5000:]
+        save_data(d)
     
     return jsonify({"ok": True})
 
@@ -1006,6 +1404,7 @@ def _save_scenes(obj):
         obj["current"] = []
     with open(SCENES_PATH, "w", encoding="utf-8") as f:
         json.dump(obj, f, indent=2)
+    POLICY_WAITERS.notify("*")
 
 
 def ai_get_categories():
@@ -1206,6 +1605,7 @@ def generate_bypass_code():
 
     _clean_expired_bypass_codes(settings)
     save_data(d)
+    _policy_changed()
 
     return jsonify({
         "ok": True,
@@ -1264,6 +1664,7 @@ def teacher_class_page(cid):
         }
         classes[cid] = cls
         save_data(d)
+        _policy_changed()
     else:
         owner = (cls.get("owner") or "").strip().lower()
         if owner and owner != email and u.get("role") != "admin":
@@ -1272,6 +1673,7 @@ def teacher_class_page(cid):
         if not owner:
             cls["owner"] = email
             save_data(d)
+            _policy_changed()
 
     return render_template("teacher.html", data=d, user=u, class_id=cid)
 
@@ -1304,6 +1706,7 @@ def create_class_session():
 
     email = (u.get("email") or "").strip().lower()
 
+    _roster_changed(cid, [], students)
     classes[cid] = {
         "name": name,
         "active": False,
@@ -1316,6 +1719,7 @@ def create_class_session():
         "schedule": {"window": window} if window else {},
     }
     save_data(d)
+    _policy_changed()
     return redirect(url_for("teacher_class_page", cid=cid))
 
 pending_commands = {}  # key = UDID, value = list of commands
@@ -1336,22 +1740,23 @@ def mdm_command_response():
         
         print(f"[MDM Command] Response from {udid}: {status} for {command_uuid}")
         
-        d = ensure_keys(load_data())
-        mdm = _ensure_mdm_structure(d)
-        
-        # Store command result
-        mdm["command_results"][command_uuid] = {
-            "udid": udid,
-            "status": status,
-            "response": response_data,
-            "timestamp": int(time.time())
-        }
-        
-        # Update last seen
-        if udid in mdm["enrolled_devices"]:
-            mdm["enrolled_devices"][udid]["last_seen"] = int(time.time())
-        
-        save_data(d)
+        with DATA_LOCKS.hold("mdm:results"):
+            d = ensure_keys(load_data())
+            mdm = _ensure_mdm_structure(d)
+
+            # Store command result
+            mdm["command_results"][command_uuid] = {
+                "udid": udid,
+                "status": status,
+                "response": response_data,
+                "timestamp": int(time.time())
+            }
+
+            # Update last seen
+            if udid in mdm["enrolled_devices"]:
+                mdm["enrolled_devices"][udid]["last_seen"] = int(time.time())
+
+            save_data(d)
         
         # If there are more pending commands, send the next one
         if udid in mdm.get("pending_commands", {}):
@@ -1981,12 +2386,15 @@ def edit_class_session(cid):
             for part in line.replace(",", " ").split():
                 if "@" in part:
                     students.append(part.strip().lower())
+        _roster_changed(cid, cls.get("students"), students)
         cls["students"] = students
 
     if window:
         cls.setdefault("schedule", {})["window"] = window
 
     save_data(d)
+    _policy_changed()
+    _sync_presence_shard(cid, cls, d)
     return redirect(url_for("teacher_page"))
 
 
@@ -2009,6 +2417,9 @@ def delete_class_session(cid):
 
     classes.pop(cid, None)
     save_data(d)
+    _policy_changed()
+    _roster_changed(cid, cls.get("students"), [])
+    _sync_presence_shard(cid, None, d)
     return redirect(url_for("teacher_page"))
 @app.route("/logout")
 def logout():
@@ -2017,24 +2428,52 @@ def logout():
 
 
 # =========================
-# Teacher Presentation (WebRTC signaling via REST polling)
+# Teacher Presentation (WebRTC signaling)
 # =========================
+# Offers, answers and ICE candidates are posted over REST and stored here
+# for polling clients; they are also pushed right away on the PRESENT_NS
+# Socket.IO namespace, where the teacher joins "present:<room>:teacher",
+# each viewer "present:<room>:viewer:<client_id>" and both "present:<room>".
+PRESENT_NS = "/present"
+
+PRESENT = PresentRegistry(
+    idle_ttl=int(os.environ.get("PRESENT_IDLE_TTL", "900")),
+    viewer_ttl=int(os.environ.get("PRESENT_VIEWER_TTL", "120")),
+    max_rooms=int(os.environ.get("PRESENT_MAX_ROOMS", "500")),
+    max_viewers=int(os.environ.get("PRESENT_MAX_VIEWERS", "200")),
+    backplane=BACKPLANE,
+)
+
+def _present_emit(room, event, data, to=None):
+    """Push a signaling message to the whole room, "teacher", or one viewer client_id."""
+    if to is None:
+        target = f"present:{room}"
+    elif to == "teacher":
+        target = f"present:{room}:teacher"
+    else:
+        target = f"present:{room}:viewer:{to}"
+    _socket_emit(event, data, to=target, namespace=PRESENT_NS)
+
+def _present_socket_join(data=None):
+    data = data if isinstance(data, dict) else {}
+    room = re.sub(r'[^a-zA-Z0-9_-]+', '', str(data.get("room") or ""))
+    if not room:
+        return {"ok": False}
+    if data.get("role") == "teacher":
+        u = session.get("user") or {}
+        if u.get("role") not in ("teacher", "admin"):
+            return {"ok": False, "error": "forbidden"}
+        join_room(f"present:{room}")
+        join_room(f"present:{room}:teacher")
+    else:
+        join_room(f"present:{room}")
+        client_id = re.sub(r'[^a-zA-Z0-9_-]+', '', str(data.get("client_id") or ""))
+        if client_id:
+            join_room(f"present:{room}:viewer:{client_id}")
+    return {"ok": True}
 
-PRESENT = defaultdict(lambda: {
-    "offers": {},
-    "answers": {},
-    "cand_v": defaultdict(list),
-    "cand_t": defaultdict(list),
-    "updated": int(time.time()),
-    "active": False
-})
-
-def _clean_room(room):
-    r = PRESENT.get(room)
-    if not r:
-        return
-    now = int(time.time())
-    r["updated"] = now
+if socketio is not None:
+    socketio.on_event("join", _present_socket_join, namespace=PRESENT_NS)
 
 @app.route("/teacher/present")
 def teacher_present_page():
@@ -2059,65 +2498,59 @@ def student_present_view(room):
 @app.route("/api/present/<room>/start", methods=["POST"])
 def api_present_start(room):
     room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
-    PRESENT[room]["active"] = True
-    PRESENT[room]["updated"] = int(time.time())
+    try:
+        PRESENT.start(room)
+    except RoomFull as e:
+        return jsonify({"ok": False, "error": str(e)}), 429
+    _present_emit(room, "present:status", {"active": True})
     return jsonify({"ok": True, "room": room})
 
 @app.route("/api/present/<room>/end", methods=["POST"])
 def api_present_end(room):
     room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
-    PRESENT[room] = {
-        "offers": {},
-        "answers": {},
-        "cand_v": defaultdict(list),
-        "cand_t": defaultdict(list),
-        "updated": int(time.time()),
-        "active": False
-    }
+    PRESENT.end(room)
+    _present_emit(room, "present:status", {"active": False})
     return jsonify({"ok": True})
 
 @app.route("/api/present/<room>/status", methods=["GET"])
 def api_present_status(room):
     room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
-    r = PRESENT.get(room) or {}
-    return jsonify({"ok": True, "active": bool(r.get("active"))})
+    return jsonify({"ok": True, "active": PRESENT.is_active(room)})
 
 # Viewer posts offer and polls for answer
 @app.route("/api/present/<room>/viewer/offer", methods=["POST"])
 def api_present_viewer_offer(room):
     body = request.json or {}
     sdp = body.get("sdp")
-    client_id = body.get("client_id") or str(uuid.uuid4())
+    client_id = re.sub(r'[^a-zA-Z0-9_-]+', '', body.get("client_id") or "") or str(uuid.uuid4())
     room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
-    r = PRESENT[room]
-    r["offers"][client_id] = sdp
-    r["updated"] = int(time.time())
+    try:
+        PRESENT.add_offer(room, client_id, sdp)
+    except RoomFull as e:
+        return jsonify({"ok": False, "error": str(e)}), 429
+    _present_emit(room, "viewer:offer", {"client_id": client_id, "sdp": sdp}, to="teacher")
     return jsonify({"ok": True, "client_id": client_id})
 
 @app.route("/api/present/<room>/offers", methods=["GET"])
 def api_present_offers(room):
     # Teacher polls for pending offers
     room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
-    offers = PRESENT[room]["offers"]
-    return jsonify({"ok": True, "offers": offers})
+    return jsonify({"ok": True, "offers": PRESENT.offers(room)})
 
 @app.route("/api/present/<room>/answer/<client_id>", methods=["POST", "GET"])
 def api_present_answer(room, client_id):
     room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
     client_id = re.sub(r'[^a-zA-Z0-9_-]+', '', client_id)
-    r = PRESENT[room]
     if request.method == "POST":
         body = request.json or {}
         sdp = body.get("sdp")
-        r["answers"][client_id] = sdp
-        # once answered, remove offer (optional)
-        if client_id in r["offers"]:
-            del r["offers"][client_id]
-        r["updated"] = int(time.time())
+        # once answered, the offer is dropped
+        if not PRESENT.set_answer(room, client_id, sdp):
+            return jsonify({"ok": False, "error": "unknown viewer"}), 404
+        _present_emit(room, "teacher:answer", {"client_id": client_id, "sdp": sdp}, to=client_id)
         return jsonify({"ok": True})
     else:
-        ans = r["answers"].get(client_id)
-        return jsonify({"ok": True, "answer": ans})
+        return jsonify({"ok": True, "answer": PRESENT.answer(room, client_id)})
 
 # ICE candidates (trickle)
 @app.route("/api/present/<room>/candidate/<side>/<client_id>", methods=["POST", "GET"])
@@ -2125,34 +2558,227 @@ def api_present_candidate(room, side, client_id):
     room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
     client_id = re.sub(r'[^a-zA-Z0-9_-]+', '', client_id)
     side = "viewer" if side.lower().startswith("v") else "teacher"
-    r = PRESENT[room]
-    bucket_from = r["cand_v"] if side == "viewer" else r["cand_t"]
-    bucket_to = r["cand_t"] if side == "viewer" else r["cand_v"]
     if request.method == "POST":
         body = request.json or {}
         cands = body.get("candidates") or []
-        if cands:
-            bucket_from[client_id].extend(cands)
-        r["updated"] = int(time.time())
-        return jsonify({"ok": True})
+        try:
+            accepted = PRESENT.add_candidates(room, side, client_id, cands) if cands else []
+        except RoomFull as e:
+            return jsonify({"ok": False, "error": str(e)}), 429
+        to = "teacher" if side == "viewer" else client_id
+        for cand in accepted:
+            _present_emit(room, f"ice:{side}", {"client_id": client_id, "candidate": cand}, to=to)
+        return jsonify({"ok": True, "accepted": len(accepted)})
     else:
         # GET fetch and clear incoming candidates for this side
-        cands = bucket_to.get(client_id, [])
-        bucket_to[client_id] = []
-        return jsonify({"ok": True, "candidates": cands})
+        return jsonify({"ok": True, "candidates": PRESENT.take_candidates(room, side, client_id)})
 
 @app.route("/api/present/<room>/diag", methods=["GET"])
 def api_present_diag(room):
     room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
-    r = PRESENT.get(room) or {"offers": {}, "answers": {}, "cand_v": {}, "cand_t": {}, "active": False}
-    return jsonify({
-        "ok": True,
-        "active": bool(r.get("active")),
-        "offers": len(r.get("offers", {})),
-        "answers": len(r.get("answers", {})),
-        "cand_v": {k: len(v) for k, v in (r.get("cand_v") or {}).items()},
-        "cand_t": {k: len(v) for k, v in (r.get("cand_t") or {}).items()},
-    })
+    r = PRESENT.stats(room) or {"active": False, "viewers": 0, "offers": 0, "answers": 0, "cand_v": {}, "cand_t": {}}
+    return jsonify(dict(r, ok=True))
+
+@app.route("/api/present/diag", methods=["GET"])
+def api_present_diag_all():
+    """Registry-wide stats: room count and per-room sizes."""
+    u = current_user()
+    if not u or u["role"] not in ("teacher", "admin"):
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    return jsonify(dict(PRESENT.stats(), ok=True))
+
+@app.route("/api/locks/stats")
+def api_locks_stats():
+    """Per-section lock counters for data.json writers (this worker only)."""
+    u = current_user()
+    if not u or u.get("role") != "admin":
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    return jsonify({"ok": True, "pid": os.getpid(), "locks": DATA_LOCKS.stats()})
+
+
+# =========================
+# Retention janitor
+# =========================
+# Retention per collection: (max age in seconds, max entries -- per student
+# for per-student collections); None leaves that side unbounded. Writers
+# still cap their own lists; JANITOR expires the rest in the background,
+# one collection per JANITOR_INTERVAL seconds and JANITOR_BATCH students
+# (or rows) at a time.
+DAY = 86400
+RETENTION = {
+    "presence":            (7 * DAY, None),
+    "history":             (14 * DAY, TIMELINE_MAX),
+    "screenshots":         (7 * DAY, SCREENSHOTS_PER_STUDENT),
+    "gprotect.logs":       (30 * DAY, 5000),
+    "mdm.command_results": (7 * DAY, 1000),
+    "polls":               (30 * DAY, 200),
+    "offtask_events":      (7 * DAY, None),    # also capped by its ring
+    "image_filter_events": (7 * DAY, None),    # also capped by its ring
+    "alerts":              (30 * DAY, None),   # also capped per student
+    "chat":                (180 * DAY, None),
+    "string_table":        (DAY, None),        # grace before an unused id goes
+}
+JANITOR_BATCH = int(os.environ.get("JANITOR_BATCH", "100"))
+JANITOR = Janitor(BACKPLANE, interval=float(os.environ.get("JANITOR_INTERVAL", "60")))
+
+def _retain(rows, policy, now, ts):
+    """(kept, dropped) of `rows` (oldest first) under `policy`; ts(row) gives a row's time."""
+    kept = [r for r in rows if policy.max_age is None or (ts(r) or 0) >= now - policy.max_age]
+    if policy.max_count is not None and len(kept) > policy.max_count:
+        kept = kept[len(kept) - policy.max_count:]
+    ids = {id(r) for r in kept}
+    return kept, [r for r in rows if id(r) not in ids]
+
+def _student_sweep(key, trim):
+    """Sweep d[key] (student -> entries) a batch of students at a time.
+
+    trim(d, student, policy, now) updates d[key][student] in place (or
+    deletes it) and returns the number of entries dropped.
+    """
+    cursor = {"after": ""}
+
+    def sweep(policy, now):
+        names = sorted(s for s in (ensure_keys(load_data()).get(key) or {}) if s > cursor["after"])
+        batch = names[:JANITOR_BATCH]
+        cursor["after"] = batch[-1] if len(names) > JANITOR_BATCH else ""
+        if not batch:
+            return 0
+        removed = 0
+        with DATA_LOCKS.hold(*(f"student:{s}" for s in batch)):
+            d = ensure_keys(load_data())
+            for s in batch:
+                if s in (d.get(key) or {}):
+                    removed += trim(d, s, policy, now)
+            if removed:
+                save_data(d)
+        return removed
+    return sweep
+
+def _trim_presence(d, student, policy, now):
+    pres = d["presence"][student]
+    if not isinstance(pres, dict) or (pres.get("last_seen") or 0) < now - policy.max_age:
+        del d["presence"][student]
+        # The grid reads the shard copy, not data.json.
+        PRESENCE_SHARDS.drop(student)
+        return 1
+    return 0
+
+def _trim_history(d, student, policy, now):
+    arr = [e for e in d["history"][student] or [] if isinstance(e, dict)]
+    kept, dropped = _retain(arr, policy, now, lambda e: e.get("end") or e.get("ts"))
+    if kept:
+        d["history"][student] = kept
+    else:
+        del d["history"][student]
+    return len(dropped)
+
+def _trim_screenshots(d, student, policy, now):
+    arr = [e for e in d["screenshots"][student] or [] if isinstance(e, dict)]
+    kept, dropped = _retain(arr, policy, now, lambda e: e.get("ts"))
+    if kept:
+        d["screenshots"][student] = kept
+    else:
+        del d["screenshots"][student]
+    SCREENSHOTS.delete(e.get("shot_id") for e in dropped)
+    return len(dropped)
+
+def _sweep_gprotect_logs(policy, now):
+    with DATA_LOCKS.hold("gprotect:logs"):
+        d = ensure_keys(load_data())
+        _ensure_gprotect_structure(d)
+        logs = [e for e in d["gprotect"]["logs"] if isinstance(e, dict)]
+        kept, dropped = _retain(logs, policy, now, lambda e: e.get("ts"))
+        if dropped:
+            d["gprotect"]["logs"] = kept
+            save_data(d)
+    return len(dropped)
+
+def _sweep_mdm_results(policy, now):
+    with DATA_LOCKS.hold("mdm:results"):
+        d = ensure_keys(load_data())
+        results = _ensure_mdm_structure(d)["command_results"]
+        rows = sorted(results.items(), key=lambda kv: (kv[1] or {}).get("timestamp") or 0)
+        kept, dropped = _retain(rows, policy, now, lambda kv: (kv[1] or {}).get("timestamp"))
+        if dropped:
+            for uuid_, _ in dropped:
+                del results[uuid_]
+            save_data(d)
+    return len(dropped)
+
+def _poll_ts(poll_id):
+    try:
+        return int(str(poll_id).rsplit("_", 1)[-1]) // 1000
+    except ValueError:
+        return 0
+
+def _sweep_polls(policy, now):
+    with DATA_LOCKS.hold("polls"):
+        d = ensure_keys(load_data())
+        polls = d.get("polls") or {}
+        rows = sorted(polls, key=_poll_ts)
+        kept, dropped = _retain(rows, policy, now, _poll_ts)
+        if dropped:
+            for poll_id in dropped:
+                del polls[poll_id]
+            save_data(d)
+    return len(dropped)
+
+def _string_ids(d):
+    """Ids of interned strings that presence, history and screenshot rows still use."""
+    live = set()
+    rows = []
+    for pres in (d.get("presence") or {}).values():
+        if isinstance(pres, dict):
+            rows += [pres.get("tab")] + list(pres.get("tabs") or [])
+    for key in ("history", "screenshots"):
+        for arr in (d.get(key) or {}).values():
+            rows += arr if isinstance(arr, list) else []
+    for r in rows:
+        if isinstance(r, dict):
+            live.update(r[f] for f in TEXT_FIELDS if isinstance(r.get(f), int))
+    return live
+
+def _sweep_string_table():
+    """Mark-and-sweep of STRINGS, a batch of ids per run (see StringTable.sweep)."""
+    cursor = {"after": 0}
+
+    def sweep(policy, now):
+        removed, cursor["after"] = STRINGS.sweep(_string_ids(ensure_keys(load_data())), cursor["after"],
+                                                 grace=policy.max_age, now=now)
+        return removed
+    return sweep
+
+def _sweep_rows(expire):
+    """Sweep for a SQLite-backed store whose expire(before_ts) drops a bounded batch."""
+    return lambda policy, now: expire(now - policy.max_age)
+
+for _name, _sweep in (
+    ("presence", _student_sweep("presence", _trim_presence)),
+    ("history", _student_sweep("history", _trim_history)),
+    ("screenshots", _student_sweep("screenshots", _trim_screenshots)),
+    ("gprotect.logs", _sweep_gprotect_logs),
+    ("mdm.command_results", _sweep_mdm_results),
+    ("polls", _sweep_polls),
+    ("offtask_events", _sweep_rows(OFFTASK_EVENTS.expire)),
+    ("image_filter_events", _sweep_rows(IMAGE_FILTER_EVENTS.expire)),
+    ("alerts", _sweep_rows(ALERTS.expire)),
+    ("chat", _sweep_rows(CHAT.expire)),
+    ("string_table", _sweep_string_table()),
+):
+    JANITOR.register(_name, _sweep, *RETENTION[_name])
+# Screenshot images are kept as long as the log rows pointing at them;
+# this also clears blobs whose rows were lost.
+JANITOR.register("screenshot_blobs", _sweep_rows(SCREENSHOTS.expire), RETENTION["screenshots"][0])
+if not _POOL_WORKER:
+    JANITOR.start()
+
+@app.route("/api/janitor/stats")
+def api_janitor_stats():
+    """Retention policies and sweep counters (this worker only)."""
+    u = current_user()
+    if not u or u.get("role") != "admin":
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    return jsonify({"ok": True, "pid": os.getpid(), "interval": JANITOR.interval, "collections": JANITOR.stats()})
 
 # =========================
 # User Admin (create/list/delete)
@@ -2299,11 +2925,12 @@ def api_data():
     on its own class without affecting others.
     """
     d = ensure_keys(load_data())
-    cid = request.args.get("class_id") or "period1"
+    return jsonify(_class_panel(d, request.args.get("class_id") or "period1"))
+
+def _class_panel(d, cid):
     classes = d.get("classes") or {}
     cls = classes.get(cid) or classes.get("period1") or {}
-
-    return jsonify({
+    return {
         "settings": {
             "chat_enabled": bool(d.get("settings", {}).get("chat_enabled", True)),
             "youtube_mode": get_setting("youtube_mode", "normal"),
@@ -2323,7 +2950,7 @@ def api_data():
                 "students": list(cls.get("students", [])),
             }
         }
-    })
+    }
 
 @app.route("/api/bypass/active", methods=["GET"])
 def get_active_bypass_codes():
@@ -2380,6 +3007,8 @@ def api_settings():
         d["settings"]["bypass_ttl_minutes"] = ttl
 
     save_data(d)
+    _policy_changed()
+    _state_changed()
     return jsonify({"ok": True, "settings": d["settings"]})
 
 @app.route("/api/categories", methods=["POST"])
@@ -2398,12 +3027,10 @@ def api_categories():
 
     d["categories"][name] = {"urls": urls, "blockPage": bp}
 
-    # Policy changed → force refresh for all extensions
-    d.setdefault("pending_commands", {}).setdefault("*", []).append({
-        "type": "policy_refresh"
-    })
-
     save_data(d)
+    _policy_changed()
+    # Policy changed → force refresh for all extensions
+    _send_command({"type": "policy_refresh"})
     log_action({"event": "categories_update", "name": name})
     return jsonify({"ok": True})
 
@@ -2418,12 +3045,10 @@ def api_categories_delete():
     if name in d["categories"]:
         del d["categories"][name]
 
-        # Policy changed → force refresh
-        d.setdefault("pending_commands", {}).setdefault("*", []).append({
-            "type": "policy_refresh"
-        })
-
         save_data(d)
+        _policy_changed()
+        # Policy changed → force refresh
+        _send_command({"type": "policy_refresh"})
         log_action({"event": "categories_delete", "name": name})
     return jsonify({"ok": True})
 
@@ -2517,87 +3142,91 @@ def api_announce():
 
     d["announcements"] = msg
 
-    # Tell all extensions to re-fetch /api/policy so they see the new announcement
-    d.setdefault("pending_commands", {}).setdefault("*", []).append({
-        "type": "policy_refresh"
-    })
-
     save_data(d)
+    _policy_changed()
+    # Tell all extensions to re-fetch /api/policy so they see the new announcement
+    _send_command({"type": "policy_refresh"})
     log_action({"event": "announce", "message": msg})
     return jsonify({"ok": True})
 
 @app.route("/api/class/set", methods=["GET", "POST"])
 def api_class_set():
-    d = ensure_keys(load_data())
-    classes = d.setdefault("classes", {})
-
     if request.method == "GET":
+        d = ensure_keys(load_data())
+        classes = d.setdefault("classes", {})
         cid = request.args.get("class_id") or "period1"
         cls = classes.get(cid) or classes.get("period1", {})
         return jsonify({"class": cls, "settings": d["settings"]})
 
     body = request.json or {}
     cid = body.get("class_id") or "period1"
-    cls = classes.get(cid)
-    if cls is None:
-        cls = {
-            "name": body.get("name") or cid,
-            "active": False,
-            "focus_mode": False,
-            "paused": False,
-            "allowlist": [],
-            "teacher_blocks": [],
-            "students": [],
-            "owner": None,
-            "schedule": {},
-        }
-        classes[cid] = cls
+    with DATA_LOCKS.hold(f"class:{cid}"):
+        d = ensure_keys(load_data())
+        classes = d.setdefault("classes", {})
+        cls = classes.get(cid)
+        if cls is None:
+            cls = {
+                "name": body.get("name") or cid,
+                "active": False,
+                "focus_mode": False,
+                "paused": False,
+                "allowlist": [],
+                "teacher_blocks": [],
+                "students": [],
+                "owner": None,
+                "schedule": {},
+            }
+            classes[cid] = cls
 
-    prev_active = bool(cls.get("active", False))
+        prev_active = bool(cls.get("active", False))
 
-    if "teacher_blocks" in body:
-        set_setting("teacher_blocks", body["teacher_blocks"])
-        cls["teacher_blocks"] = list(body["teacher_blocks"])
-    else:
-        cls.setdefault("teacher_blocks", [])
+        if "teacher_blocks" in body:
+            set_setting("teacher_blocks", body["teacher_blocks"])
+            cls["teacher_blocks"] = list(body["teacher_blocks"])
+        else:
+            cls.setdefault("teacher_blocks", [])
 
-    if "allowlist" in body:
-        set_setting("teacher_allow", body["allowlist"])
-        cls["allowlist"] = list(body["allowlist"])
-    else:
-        cls.setdefault("allowlist", [])
+        if "allowlist" in body:
+            set_setting("teacher_allow", body["allowlist"])
+            cls["allowlist"] = list(body["allowlist"])
+        else:
+            cls.setdefault("allowlist", [])
 
-    if "chat_enabled" in body:
-        d.setdefault("settings", {})["chat_enabled"] = bool(body["chat_enabled"])
-        set_setting("chat_enabled", body["chat_enabled"])
+        if "chat_enabled" in body:
+            d.setdefault("settings", {})["chat_enabled"] = bool(body["chat_enabled"])
+            set_setting("chat_enabled", body["chat_enabled"])
 
-    if "active" in body:
-        cls["active"] = bool(body["active"])
+        if "active" in body:
+            cls["active"] = bool(body["active"])
 
-    if isinstance(body.get("schedule"), dict):
-        cls["schedule"] = body["schedule"]
+        if isinstance(body.get("schedule"), dict):
+            cls["schedule"] = body["schedule"]
 
-    if isinstance(body.get("students"), list):
-        cls["students"] = [s.strip() for s in body["students"] if isinstance(s, str) and s.strip()]
+        if isinstance(body.get("students"), list):
+            old_roster = cls.get("students") or []
+            cls["students"] = [s.strip() for s in body["students"] if isinstance(s, str) and s.strip()]
+            _roster_changed(cid, old_roster, cls["students"])
 
-    if "passcode" in body and body["passcode"]:
-        d.setdefault("settings", {})["passcode"] = body["passcode"]
+        if "passcode" in body and body["passcode"]:
+            d.setdefault("settings", {})["passcode"] = body["passcode"]
+
+        save_data(d)
+        _policy_changed()
+        _state_changed()
+        _sync_presence_shard(cid, cls, d)
+    if isinstance(body.get("students"), list):
+        _sync_class_room(cid, cls["students"])
 
     # When this specific class becomes active, notify only its students
     if not prev_active and cls.get("active"):
-        for student in cls.get("students", []):
-            d.setdefault("pending_commands", {}).setdefault(student, []).append({
-                "type": "notify",
-                "title": "Class session is active",
-                "message": "Please join and stay until dismissed.",
-            })
-
-    # Ask extensions to refresh policy (no longer global '*', but keep meta bucket)
-    d.setdefault("pending_commands", {}).setdefault("_meta", []).append({
-        "type": "policy_refresh"
-    })
+        _send_command({
+            "type": "notify",
+            "title": "Class session is active",
+            "message": "Please join and stay until dismissed.",
+        }, class_id=cid, d=d)
 
-    save_data(d)
+    # Ask this class's extensions to refresh policy (no longer global '*')
+    _push_command({"type": "policy_refresh"}, class_id=cid)
     log_action({"event": "class_set", "class_id": cid, "active": cls.get("active", False)})
     return jsonify({"ok": True, "class": cls, "settings": d["settings"]})
 @app.route("/api/class/toggle", methods=["POST"])
@@ -2606,16 +3235,22 @@ def api_class_toggle():
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
 
-    d = ensure_keys(load_data())
     b = request.json or {}
     cid = b.get("class_id", "period1")
     key = b.get("key")
     val = bool(b.get("value"))
 
-    classes = d.get("classes") or {}
-    if cid in classes and key in ("focus_mode", "paused", "active"):
-        classes[cid][key] = val
-        save_data(d)
+    with DATA_LOCKS.hold(f"class:{cid}"):
+        d = ensure_keys(load_data())
+        classes = d.get("classes") or {}
+        changed = cid in classes and key in ("focus_mode", "paused", "active")
+        if changed:
+            classes[cid][key] = val
+            save_data(d)
+            _policy_changed()
+            if key == "active":
+                _sync_presence_shard(cid, classes[cid], d)
+    if changed:
         log_action({"event": "class_toggle", "class_id": cid, "key": key, "value": val})
         return jsonify({"ok": True, "class": classes[cid]})
 
@@ -2642,38 +3277,49 @@ def api_command():
 
     student = (b.get("student") or "").strip()
     class_id = (b.get("class_id") or "").strip()
-    d.setdefault("pending_commands", {})
 
     if student:
         # Direct student-targeted command
-        d["pending_commands"].setdefault(student, []).append(cmd)
+        cmd = _send_command(cmd, student=student)
         target_desc = student
     elif class_id:
-        # Fan out to all students in this class session
-        classes = d.get("classes") or {}
-        cls = classes.get(class_id, {})
-        students = cls.get("students", []) or []
-        for s in students:
-            d["pending_commands"].setdefault(s, []).append(cmd)
+        # One entry for the whole class; each student reads it by reference
+        cmd = _send_command(cmd, class_id=class_id, d=d)
         target_desc = f"class:{class_id}"
     else:
         return jsonify({"ok": False, "error": "missing student or class_id"}), 400
 
-    save_data(d)
     log_action({"event": "command", "target": target_desc, "type": cmd.get("type")})
-    return jsonify({"ok": True})
+    return jsonify({"ok": True, "seq": cmd["seq"]})
 
 
 @app.route("/api/commands/<student>", methods=["GET", "POST"])
 def api_commands(student):
-    d = ensure_keys(load_data())
+    """Commands for a student extension.
 
+    GET ?after=<seq> acknowledges everything up to `seq` and returns the
+    newer commands for this student, their classes and broadcasts; nothing
+    is lost if a response never arrives. Without ?after the reply is
+    acknowledged as soon as it is built (the old read-and-clear behaviour,
+    student and class commands only). ?wait=N long-polls.
+    """
     if request.method == "GET":
-        # Only deliver commands explicitly queued for this student.
-        cmds = d.get("pending_commands", {}).get(student, [])
-        d.setdefault("pending_commands", {})[student] = []
-        save_data(d)
-        return jsonify({"commands": cmds})
+        key = student.strip().lower()
+        after = _after_seq_arg()
+        if after is not None:
+            COMMANDS.ack(key, after)
+        targets = _command_targets(ensure_keys(load_data()), key, broadcast=after is not None)
+        shared = [t for t in targets if not t.startswith("student:")]
+        version = COMMAND_WAITERS.version(key)
+        cmds = COMMANDS.pending(key, targets, shared=shared)
+        wait = _wait_arg()
+        if not cmds and wait:
+            COMMAND_WAITERS.wait(key, version, wait)
+            cmds = COMMANDS.pending(key, targets, shared=shared)
+        if cmds and after is None:
+            COMMANDS.ack(key, cmds[-1]["seq"])
+        last_seq = cmds[-1]["seq"] if cmds else COMMANDS.cursor(key)
+        return jsonify({"commands": cmds, "last_seq": last_seq})
 
     # POST (push from teacher to a single student)
     u = current_user()
@@ -2684,10 +3330,118 @@ def api_commands(student):
     if not b.get("type"):
         return jsonify({"ok": False, "error": "missing type"}), 400
 
-    d.setdefault("pending_commands", {}).setdefault(student, []).append(b)
-    save_data(d)
+    cmd = _send_command(b, student=student)
     log_action({"event": "command_sent", "to": student, "cmd": b.get("type")})
-    return jsonify({"ok": True})
+    return jsonify({"ok": True, "seq": cmd["seq"]})
+
+
+@app.route("/api/commands/<student>/ack", methods=["POST"])
+def api_commands_ack(student):
+    """Acknowledge commands up to and including `seq`."""
+    b = request.json or {}
+    try:
+        seq = int(b.get("seq"))
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": "seq required"}), 400
+    acked = COMMANDS.ack(student.strip().lower(), seq)
+    return jsonify({"ok": True, "acked": acked})
+
+
+def _command_targets(d, student, broadcast=True):
+    """Command log targets a student reads from."""
+    if student == "*":
+        return ["*"]
+    targets = [f"student:{student}"] + [f"class:{cid}" for cid in _student_class_ids(d, student)]
+    if broadcast:
+        targets.append("*")
+    return targets
+
+def _roster_changed(cid, old, new):
+    """Students added to class `cid` get its commands from now on; removed ones stop."""
+    old = {(s or "").strip().lower() for s in old or []}
+    new = {(s or "").strip().lower() for s in new or []}
+    COMMANDS.join(f"class:{cid}", sorted(new - old))
+    COMMANDS.leave(f"class:{cid}", sorted(old - new))
+
+def _send_command(cmd, student=None, class_id=None, d=None):
+    """Log a command for a student, a class, or (neither given) everyone.
+
+    Wakes long-polling readers and pushes it over Socket.IO; returns the
+    stored command with its `id` and `seq`.
+    """
+    cmd = dict(cmd, id=cmd.get("id") or uuid.uuid4().hex)
+    if student:
+        key = student.strip().lower()
+        cmd = COMMANDS.append(f"student:{key}", cmd)
+        COMMAND_WAITERS.notify(key)
+    elif class_id:
+        cmd = COMMANDS.append(f"class:{class_id}", cmd)
+        if d is None:
+            d = ensure_keys(load_data())
+        cls = (d.get("classes") or {}).get(class_id) or {}
+        for s in cls.get("students") or []:
+            COMMAND_WAITERS.notify((s or "").strip().lower())
+    else:
+        cmd = COMMANDS.append("*", cmd)
+        COMMAND_WAITERS.notify("*")
+    _push_command(cmd, student=student, class_id=class_id)
+    return cmd
+
+
+# =========================
+# Student Socket.IO channel
+# =========================
+# Extensions connect to STUDENT_NS with auth {"student": email} and are put
+# in "student:<email>" plus one "class:<cid>" room per class roster they are
+# on. Pushed commands carry the same `id` and `seq` as the logged copy, so a
+# client can ack them and drop the duplicate a later poll would return.
+STUDENT_NS = "/student"
+_SOCKET_STUDENT = {}  # sid -> student email (sockets connected to this worker)
+
+def _push_command(cmd, student=None, class_id=None):
+    """Emit a command to a student, a class, or (neither given) everyone."""
+    if student:
+        room = f"student:{student.strip().lower()}"
+    elif class_id:
+        room = f"class:{class_id}"
+    else:
+        room = None
+    _socket_emit("command", cmd, to=room, namespace=STUDENT_NS)
+
+def _sync_class_room(cid, students):
+    """Re-seat connected sockets (in every worker) after a class roster change."""
+    if socketio is None:
+        return
+    BACKPLANE.publish("socketio", {"op": "class_room", "class_id": cid, "students": list(students or [])})
+
+def _sync_class_room_local(cid, students):
+    room = f"class:{cid}"
+    roster = {(s or "").strip().lower() for s in students or []}
+    for sid, student in list(_SOCKET_STUDENT.items()):
+        try:
+            if student in roster:
+                socketio.server.enter_room(sid, room, namespace=STUDENT_NS)
+            else:
+                socketio.server.leave_room(sid, room, namespace=STUDENT_NS)
+        except Exception:
+            pass
+
+def _student_socket_connect(auth=None):
+    student = str((auth or {}).get("student") or request.args.get("student") or "").strip().lower()
+    if not student or _is_guest_identity(student, ""):
+        return False
+    _SOCKET_STUDENT[request.sid] = student
+    join_room(f"student:{student}")
+    d = ensure_keys(load_data())
+    for cid in _student_class_ids(d, student):
+        join_room(f"class:{cid}")
+
+def _student_socket_disconnect(*_args):
+    _SOCKET_STUDENT.pop(request.sid, None)
+
+if socketio is not None:
+    socketio.on_event("connect", _student_socket_connect, namespace=STUDENT_NS)
+    socketio.on_event("disconnect", _student_socket_disconnect, namespace=STUDENT_NS)
 
 # =========================
 # Off-task Check (simple)
@@ -2719,18 +3473,11 @@ def api_offtask_check():
     if any(k in url.lower() for k in bad_kw):
         on_task = False
 
-    v = {"student": student, "url": url, "ts": int(time.time()), "on_task": bool(on_task)}
-    d.setdefault("offtask_events", []).append(v)
-    d["offtask_events"] = d["offtask_events"][-2000:]
-    save_data(d)
+    v = OFFTASK_EVENTS.append({"student": student, "url": url, "ts": int(time.time()), "on_task": bool(on_task)})
+    if not on_task:
+        ENGAGEMENT.add(student, "offtask", ts=v["ts"])
 
-    try:
-        # If using socketio, you could emit here; safely ignore if not present
-        from flask_socketio import SocketIO  # type: ignore
-        socketio = SocketIO(message_queue=None)
-        socketio.emit("offtask", v, broadcast=True)
-    except Exception:
-        pass
+    _publish_student_event(student, "offtask", v)
 
     return jsonify({"ok": True, "on_task": bool(on_task)})
 
@@ -2757,73 +3504,107 @@ def api_heartbeat():
             "extension_enabled": False  # completely disabled for guests
         })
 
-    d = ensure_keys(load_data())
-    d.setdefault("presence", {})
-
-    if student:
-        pres = d["presence"].setdefault(student, {})
-        pres["last_seen"] = int(time.time())
-        pres["student_name"] = display_name
-        pres["tab"] = b.get("tab", {}) or {}
-        pres["tabs"] = b.get("tabs", []) or []
-        # support both camel and snake favicon key names
-        if "favIconUrl" in pres.get("tab", {}):
-            pass
-        elif "favicon" in pres.get("tab", {}):
-            pres["tab"]["favIconUrl"] = pres["tab"].get("favicon")
-
-        pres["screenshot"] = b.get("screenshot", "") or ""
-
-        # --- Keep only screenshots for open tabs shown in modal preview ---
-        shots = pres.get("tabshots", {})
-        for k, v in (b.get("tabshots", {}) or {}).items():
-            shots[str(k)] = v
-        open_ids = {str(t.get("id")) for t in pres["tabs"] if "id" in t}
-        for k in list(shots.keys()):
-            if k not in open_ids:
-                del shots[k]
-        pres["tabshots"] = shots
-        d["presence"][student] = pres
-
-        # ---------- Timeline & Screenshot history ----------
-        try:
-            timeline = d.setdefault("history", {}).setdefault(student, [])
-            now = int(time.time())
-            cur = pres.get("tab", {}) or {}
-            url = (cur.get("url") or "").strip()
-            title = (cur.get("title") or "").strip()
-            fav = cur.get("favIconUrl")
-
-            should_add = False
-            if url:
-                if not timeline:
-                    should_add = True
-                else:
-                    last = timeline[-1]
-                    if last.get("url") != url or now - int(last.get("ts", 0)) >= 15:
-                        should_add = True
-
-            if should_add:
-                timeline.append({"ts": now, "title": title, "url": url, "favIconUrl": fav})
-                d["history"][student] = timeline[-500:]  # cap
-
-            # Screenshot history: if extension passes `shot_log: [{tabId,dataUrl,title,url}]`
-            shot_log = b.get("shot_log") or []
-            if shot_log:
-                hist = d.setdefault("screenshots", {}).setdefault(student, [])
-                for s in shot_log[:10]:
-                    hist.append({
-                        "ts": now,
-                        "tabId": s.get("tabId"),
-                        "dataUrl": s.get("dataUrl"),
-                        "title": (s.get("title") or ""),
-                        "url": (s.get("url") or "")
-                    })
-                d["screenshots"][student] = hist[-200:]
-        except Exception as e:
-            print("[WARN] Heartbeat logging error:", e)
+    # Presence, timeline and screenshots of one student; see save_data().
+    with DATA_LOCKS.hold(student and f"student:{student}"):
+        d = ensure_keys(load_data())
+        d.setdefault("presence", {})
+
+        if student:
+            pres = d["presence"].setdefault(student, {})
+            pres["last_seen"] = int(time.time())
+            pres["student_name"] = display_name
+            pres["tab"] = b.get("tab", {}) or {}
+            pres["tabs"] = [t for t in b.get("tabs", []) or [] if isinstance(t, dict)]
+            # support both camel and snake favicon key names
+            if "favIconUrl" in pres.get("tab", {}):
+                pass
+            elif "favicon" in pres.get("tab", {}):
+                pres["tab"]["favIconUrl"] = pres["tab"].get("favicon")
+            cur = pres["tab"]
+            rows = STRINGS.encode_rows([pres["tab"]] + pres["tabs"], TEXT_FIELDS)
+            pres["tab"], pres["tabs"] = rows[0], rows[1:]
+
+            pres["screenshot"] = b.get("screenshot", "") or ""
+
+            # --- Keep only screenshots for open tabs shown in modal preview ---
+            shots = pres.get("tabshots", {})
+            for k, v in (b.get("tabshots", {}) or {}).items():
+                shots[str(k)] = v
+            open_ids = {str(t.get("id")) for t in pres["tabs"] if "id" in t}
+            for k in list(shots.keys()):
+                if k not in open_ids:
+                    del shots[k]
+            pres["tabshots"] = shots
+            d["presence"][student] = pres
+
+            # ---------- Timeline & Screenshot history ----------
+            try:
+                timeline = d.setdefault("history", {}).setdefault(student, [])
+                if timeline and "start" not in timeline[-1]:
+                    timeline[:] = STRINGS.encode_rows(_compact_timeline(timeline), TEXT_FIELDS)
+                now = int(time.time())
+                url = (cur.get("url") or "").strip()
+                title = (cur.get("title") or "").strip()
+                fav = cur.get("favIconUrl")
+
+                if url:
+                    last = timeline[-1] if timeline else None
+                    if last and STRINGS.lookup(last.get("url")) == url and now - last["end"] <= TIMELINE_GAP:
+                        # Same page: stretch the interval; count a sample each time
+                        # it crosses the next TIMELINE_SAMPLE boundary.
+                        if (now - last["start"]) // TIMELINE_SAMPLE > (last["end"] - last["start"]) // TIMELINE_SAMPLE:
+                            ENGAGEMENT.add(student, "timeline", ts=now)
+                        last["end"] = max(last["end"], now)
+                        if title:
+                            last["title"] = STRINGS.intern(title)
+                        if fav:
+                            last["favIconUrl"] = STRINGS.intern(fav)
+                    else:
+                        timeline.append(STRINGS.encode({"url": url, "title": title, "favIconUrl": fav,
+                                                        "start": now, "end": now, "ts": now}, TEXT_FIELDS))
+                        ENGAGEMENT.add(student, "timeline", ts=now)
+                        d["history"][student] = timeline[-TIMELINE_MAX:]  # cap
+
+                # Screenshot history: if extension passes `shot_log: [{tabId,dataUrl,title,url}]`
+                shot_log = b.get("shot_log") or []
+                if shot_log:
+                    hist = d.setdefault("screenshots", {}).setdefault(student, [])
+                    rows = []
+                    for s in shot_log[:10]:
+                        row = {
+                            "ts": now,
+                            "tabId": s.get("tabId"),
+                            "title": (s.get("title") or ""),
+                            "url": (s.get("url") or "")
+                        }
+                        # Rows never carry the image inline; one the store
+                        # rejects (not a PNG/JPEG/WebP) is not logged.
+                        shot_id = SCREENSHOTS.put(student, s.get("dataUrl"), ts=now)
+                        if shot_id:
+                            row["shot_id"] = shot_id
+                            rows.append(row)
+                    hist.extend(STRINGS.encode_rows(rows, ("title", "url")))
+                    SCREENSHOTS.delete(e.get("shot_id") for e in hist[:-SCREENSHOTS_PER_STUDENT]
+                                       if isinstance(e, dict))
+                    d["screenshots"][student] = hist[-SCREENSHOTS_PER_STUDENT:]
+            except Exception as e:
+                print("[WARN] Heartbeat logging error:", e)
+
+        # Bumped on every heartbeat; /api/presence?since= returns rows above
+        # it. Readers take the version under the same lock, so every entry
+        # up to the version they get is already written.
+        with DATA_LOCKS.hold("presence"):
+            if student:
+                pres["v"] = BACKPLANE.incr("presence:version")
+                if b.get("screenshot") or b.get("tabshots"):
+                    pres["shot_v"] = pres["v"]
+            save_data(d)
+            class_ids = PRESENCE_SHARDS.put(student, pres) if student else []
 
-    save_data(d)
+    if class_ids:
+        shot = bool(b.get("screenshot") or b.get("tabshots"))
+        _publish_student_event(student, "presence", _presence_delta(student, pres, shot),
+                               class_ids=class_ids)
 
     return jsonify({
         "ok": True,
@@ -2833,40 +3614,218 @@ def api_heartbeat():
     })
 
 
+def _sync_presence_shard(cid, cls, d):
+    """Bring class `cid`'s presence shard in line with its roster and active flag."""
+    active = isinstance(cls, dict) and cls.get("active")
+    PRESENCE_SHARDS.sync(cid, (cls.get("students") or []) if active else None, d.get("presence"))
+
+def _seed_presence_shards():
+    """Build shards for the classes already active at startup; drop stale ones."""
+    d = ensure_keys(load_data())
+    classes = d.get("classes") or {}
+    with BACKPLANE.lock("seed:presence", timeout=30):
+        for key in BACKPLANE.keys(PresenceShards.CLASS):
+            cid = key[len(PresenceShards.CLASS):]
+            if not (classes.get(cid) or {}).get("active"):
+                PRESENCE_SHARDS.sync(cid, None)
+        for cid, cls in classes.items():
+            if isinstance(cls, dict) and cls.get("active"):
+                _sync_presence_shard(cid, cls, d)
+
+if not _POOL_WORKER:
+    _seed_presence_shards()
+
+def _class_presence(d, cid, cls, fields=None, since=None):
+    """{student: presence} of an active class; see api_presence for fields/since.
+
+    Grid fields come from the class's shard; screenshot payloads, when
+    asked for, from `d`.
+    """
+    roster = sorted({(s or "").strip().lower() for s in cls.get("students") or [] if s})
+    presence = d.get("presence") or {}
+    if PRESENCE_SHARDS.members(cid) == roster:
+        entries = PRESENCE_SHARDS.view(cid)
+    else:
+        # The shard is behind the roster (e.g. edited by another worker
+        # before a restart): read data.json rather than rebuild it on a GET.
+        entries = {s: PresenceShards.slim(presence[s]) for s in roster if isinstance(presence.get(s), dict)}
+    out = {}
+    for s, info in entries.items():
+        if not isinstance(info, dict):
+            continue
+        if since is not None and (info.get("v") or 0) <= since:
+            continue
+        images = presence.get(s) if isinstance(presence.get(s), dict) else {}
+        if fields:
+            row = {f: info[f] for f in fields if f in info and f != "shots"}
+            row.update((f, images[f]) for f in PresenceShards.IMAGE_FIELDS if f in fields and f in images)
+            if "images" in fields:
+                row["images"] = _presence_images(s, info)
+            info = row
+        else:
+            info = {k: v for k, v in info.items() if k != "shots"}
+            info.update((f, images[f]) for f in PresenceShards.IMAGE_FIELDS if f in images)
+        if "tab" in info or "tabs" in info:
+            info = _decode_presence(info)
+        out[s] = info
+    return out
+
+def _presence_images(student, pres):
+    """URLs of a student's current screenshot and per-tab shots (see api_presence_image).
+
+    `pres` is a shard entry, whose `shots` lists which images exist.
+    """
+    v = pres.get("shot_v") or 0
+    shots = pres.get("shots") or {}
+    base = url_for("api_presence_image", student=student)
+    return {
+        "screenshot": "%s?v=%s" % (base, v) if shots.get("screenshot") else None,
+        "tabshots": {tid: "%s?tab=%s&v=%s" % (base, tid, v) for tid in shots.get("tabshots") or []},
+    }
+
 @app.route("/api/presence")
 def api_presence():
     """Return live presence/screen info for a specific class session.
 
     Requires ?class_id=XYZ. Only includes students assigned to that class,
     and hides all screens whenever the class is inactive.
+
+    With ?fields= and/or ?since= the reply is {"ok", "version", "full",
+    "students"} instead of the bare map:
+      fields=a,b,...  only those keys per student; "images" adds the URLs
+                      of the screenshot/tabshots instead of their data.
+      since=<v>       only students whose presence changed after version
+                      v (the "version" of an earlier reply); full=false.
     """
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
 
+    fields = [f.strip() for f in (request.args.get("fields") or "").split(",") if f.strip()]
+    try:
+        since = int(request.args["since"]) if request.args.get("since") else None
+    except ValueError:
+        return jsonify({"ok": False, "error": "bad since"}), 400
+    envelope = bool(fields) or since is not None
+    # Read the version first: anything saved after this shows up next time.
+    with DATA_LOCKS.hold("presence"):
+        version = BACKPLANE.get("presence:version", 0)
+
     d = ensure_keys(load_data())
-    presence = d.get("presence", {}) or {}
     cid = (request.args.get("class_id") or "").strip()
-    if not cid:
-        # Strict mode: never return a global "everyone" view.
-        return jsonify({})
-
     classes = d.get("classes") or {}
-    cls = classes.get(cid)
+    cls = classes.get(cid) if cid else None
     if not cls or not cls.get("active"):
-        # When a class session is inactive, no screens are visible.
+        # Strict mode: never return a global "everyone" view, and when a
+        # class session is inactive, no screens are visible.
+        if envelope:
+            return jsonify({"ok": True, "version": version, "full": True, "students": {}})
         return jsonify({})
 
-    # Compare using normalized email addresses.
-    allowed_students = set(
-        (s or "").strip().lower() for s in cls.get("students") or [] if s
-    )
-    filtered = {}
-    for s, info in presence.items():
-        key = (s or "").strip().lower()
-        if key in allowed_students:
-            filtered[s] = info
-    return jsonify(filtered)
+    filtered = _class_presence(d, cid, cls, fields, since)
+    if not envelope:
+        return jsonify(filtered)
+    return jsonify({"ok": True, "version": version, "full": since is None, "students": filtered})
+
+@app.route("/api/presence/<path:student>/screenshot")
+def api_presence_image(student):
+    """A student's current screenshot (or ?tab=<id> tab shot) as an image."""
+    u = current_user()
+    if not u or u["role"] not in ("teacher", "admin"):
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    # Image payloads are not copied to the shards; they live in data.json.
+    pres = (ensure_keys(load_data()).get("presence") or {}).get(student) or {}
+    tab = request.args.get("tab")
+    data_url = (pres.get("tabshots") or {}).get(tab) if tab else pres.get("screenshot")
+    if isinstance(data_url, dict):
+        data_url = data_url.get("dataUrl")
+    parsed = parse_image_data_url(data_url)
+    if parsed is None:
+        return jsonify({"ok": False, "error": "not found"}), 404
+    etag = "p%s-%s" % (pres.get("shot_v") or 0, tab or "")
+    if etag in request.if_none_match:
+        return Response(status=304, headers={"ETag": '"%s"' % etag})
+    mime, data = parsed
+    # URLs from _presence_images carry ?v=, so a new shot is a new URL.
+    return _image_response(mime, data, etag, "private, max-age=3600")
+
+
+# =========================
+# Live Stream (SSE)
+# =========================
+STREAM_KEEPALIVE = 15  # seconds between comment frames on an idle stream
+
+def _student_class_ids(d, student, active_only=False):
+    """Class ids whose roster includes this student."""
+    student = (student or "").strip().lower()
+    out = []
+    for cid, cls in (d.get("classes") or {}).items():
+        if not isinstance(cls, dict):
+            continue
+        if active_only and not cls.get("active"):
+            continue
+        if student in ((s or "").strip().lower() for s in cls.get("students") or []):
+            out.append(cid)
+    return out
+
+def _publish_student_event(student, type, data, d=None, active_only=False, class_ids=None):
+    """Push an event to the stream of every class this student is in."""
+    if not student or not HUB.has_subscribers():
+        return
+    if class_ids is None:
+        if d is None:
+            d = ensure_keys(load_data())
+        class_ids = _student_class_ids(d, student, active_only=active_only)
+    for cid in class_ids:
+        HUB.publish(f"class:{cid}", type, data)
+
+def _presence_delta(student, pres, shot=False):
+    """Presence fields the dashboard renders, without the image payloads."""
+    pres = _decode_presence(pres)
+    tab = pres.get("tab") or {}
+    return {
+        "student": student,
+        "student_name": pres.get("student_name", ""),
+        "last_seen": pres.get("last_seen"),
+        "tab": {k: tab.get(k) for k in ("id", "url", "title", "favIconUrl") if k in tab},
+        "tabs": [
+            {k: t.get(k) for k in ("id", "url", "title", "favIconUrl", "active") if k in t}
+            for t in pres.get("tabs") or [] if isinstance(t, dict)
+        ],
+        "shot": bool(shot),
+    }
+
+@app.route("/api/stream")
+def api_stream():
+    """Server-Sent Events for one class: presence, hand, dm, exam_violation, alert.
+
+    Clients refetch full state on connect and whenever they get a
+    "resync" event; everything else is a delta.
+    """
+    u = current_user()
+    if not u or u["role"] not in ("teacher", "admin"):
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    cid = (request.args.get("class_id") or "").strip()
+    d = ensure_keys(load_data())
+    if not cid or cid not in (d.get("classes") or {}):
+        return jsonify({"ok": False, "error": "unknown class"}), 404
+
+    sub = HUB.subscribe(f"class:{cid}")
+
+    def gen():
+        try:
+            yield "retry: 3000\n\n"
+            yield sse_format({"id": 0, "type": "hello", "data": {"class_id": cid}})
+            while True:
+                ev = sub.get(timeout=STREAM_KEEPALIVE)
+                yield ": keepalive\n\n" if ev is None else sse_format(ev)
+        finally:
+            HUB.unsubscribe(sub)
+
+    return Response(gen(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
 
 @app.route("/api/extension/toggle", methods=["POST"])
 def api_extension_toggle():
@@ -2881,6 +3840,8 @@ def api_extension_toggle():
     data = ensure_keys(load_data())
     data["extension_enabled"] = enabled
     save_data(data)
+    _policy_changed()
+    _state_changed()
 
     print(f"[INFO] Extension toggle → {'ENABLED' if enabled else 'DISABLED'} by {user.get('email')}")
     log_action({"event": "extension_toggle", "enabled": enabled, "by": user.get("email")})
@@ -3110,6 +4071,7 @@ def _apply_policy_to_lists(base_allow, base_blocks, base_categories, policy):
 def api_policy():
     b = request.json or {}
     student = (b.get("student") or "").strip().lower()
+    policy_version = POLICY_WAITERS.version(student)
     d = ensure_keys(load_data())
 
     # Choose an active class session for this student, if any.
@@ -3137,13 +4099,13 @@ def api_policy():
     # Per-student pending items (open_tabs etc)
     pending = []
     if student:
-        pending_all = d.get("pending_per_student", {}) or {}
-        pend = pending_all.get(student, []) or []
-        if pend:
-            pending = pend
-            pending_all.pop(student, None)
-            d["pending_per_student"] = pending_all
-            save_data(d)
+        if (d.get("pending_per_student") or {}).get(student):
+            # Drain from a fresh copy so items queued since `d` was read go out now.
+            with DATA_LOCKS.hold(f"student:{student.lower()}"):
+                fresh = ensure_keys(load_data())
+                pending = fresh["pending_per_student"].pop(student, None) or []
+                if pending:
+                    save_data(fresh)
 
     
     # Scene merge logic — pull from regular scenes data
@@ -3283,10 +4245,32 @@ def api_policy():
         "scenes": {"current": scenes_current},
         "bypass_enabled": bool(d.get("settings", {}).get("bypass_enabled", False)),
         "bypass_ttl_minutes": int(d.get("settings", {}).get("bypass_ttl_minutes", 10)),
+        "policy_version": policy_version,
     }
     return jsonify(resp)
 
 
+@app.route("/api/policy/version", methods=["GET"])
+def api_policy_version():
+    """Current policy version for ?student=.
+
+    With ?since=<version>&wait=N the request is held until the version
+    differs from `since` (or N seconds pass); clients re-POST /api/policy
+    when `changed` is true.
+    """
+    student = (request.args.get("student") or "").strip().lower()
+    since = request.args.get("since")
+    version = POLICY_WAITERS.version(student)
+    wait = _wait_arg()
+    if wait and since is not None and str(version) == since:
+        version = POLICY_WAITERS.wait(student, version, wait)
+    return jsonify({
+        "ok": True,
+        "version": version,
+        "changed": since is not None and str(version) != since,
+    })
+
+
 # =========================
 # Timeline & Screenshots
 # =========================
@@ -3363,6 +4347,7 @@ def api_policies():
                 assigns[k] = {k2: v2 for k2, v2 in mp.items() if v2 != pid}
             d["policy_assignments"] = assigns
             save_data(d)
+            _policy_changed()
         return jsonify({"ok": True})
 
     pid = (body.get("id") or "").strip()
@@ -3395,6 +4380,7 @@ def api_policies():
         d["default_policy_id"] = body.get("default_policy_id")
 
     save_data(d)
+    _policy_changed()
     return jsonify({"ok": True, "id": pid, "policy": policies[pid]})
 
 
@@ -3485,11 +4471,55 @@ def api_policy_assignments():
 
     d["policy_assignments"] = assigns
     save_data(d)
+    _policy_changed()
     return jsonify({"ok": True, "policy_assignments": assigns, "default_policy_id": d.get("default_policy_id")})
 
 
+def _timeline_desc(student, arr, since=0, expand=False, before=None):
+    """One student's timeline newest first, as ((ts, student, start), row) pairs.
+
+    Starts just below `before` (the key of the last row of the previous
+    page) by bisecting on interval start, and stops at the first interval
+    that ended before `since`, so a page only touches the rows it returns.
+    Keys use the interval's start rather than its position in `arr`, which
+    shifts whenever old intervals are trimmed.
+    """
+    hi = len(arr)
+    if before is not None:
+        hi = bisect.bisect_right(arr, before[0], key=lambda e: _as_interval(e)["start"] if isinstance(e, dict) else 0)
+    for pos in range(hi - 1, -1, -1):
+        e = arr[pos]
+        if not isinstance(e, dict):
+            continue
+        iv = _as_interval(e)
+        if iv["end"] < since:
+            return
+        if expand:
+            row = {k: iv.get(k) for k in TEXT_FIELDS}
+            rows = ((ts, dict(row, ts=ts)) for ts in reversed(_interval_samples(iv, since)))
+        else:
+            rows = [(iv["ts"], dict(iv, duration=iv["end"] - iv["start"]))]
+        for ts, item in rows:
+            key = (ts, student, iv["start"])
+            if before is None or key < before:
+                yield key, item
+
+def _encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode("utf-8")).decode("ascii")
+
+def _decode_cursor(token):
+    ts, student, start = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    return (int(ts), str(student), int(start))
+
 @app.route("/api/timeline", methods=["GET"])
 def api_timeline():
+    """Browsing intervals, newest last for one student (newest first for all).
+
+    Query: student, since (intervals still open at or after it), limit,
+    cursor (`next_cursor` of the previous page, for older rows),
+    expand=1 (one row per TIMELINE_SAMPLE seconds instead of intervals),
+    dwell=1 (also return seconds spent per URL over the same range).
+    """
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
@@ -3497,17 +4527,39 @@ def api_timeline():
     student = (request.args.get("student") or "").strip()
     limit = max(1, min(int(request.args.get("limit", 200)), 1000))
     since = int(request.args.get("since", 0))
-    out = []
+    expand = request.args.get("expand") in ("1", "true")
+    before = None
+    if request.args.get("cursor"):
+        try:
+            before = _decode_cursor(request.args["cursor"])
+        except Exception:
+            return jsonify({"ok": False, "error": "bad cursor"}), 400
+    history = d.get("history", {}) or {}
+    sources = [(student, history.get(student) or [])] if student else list(history.items())
+
+    # k-way merge of the per-student streams (each already newest first);
+    # one extra row tells whether there is another page.
+    streams = [_timeline_desc(s, arr or [], since, expand, before) for s, arr in sources]
+    page = list(itertools.islice(heapq.merge(*streams, key=lambda kv: kv[0], reverse=True), limit + 1))
+    next_cursor = _encode_cursor(page[limit - 1][0]) if len(page) > limit else None
+    page = page[:limit]
+    items = STRINGS.decode_rows([dict(item, student=key[1]) if not student else item for key, item in page],
+                                TEXT_FIELDS)
     if student:
-        out = [e for e in d.get("history", {}).get(student, []) if e.get("ts", 0) >= since]
-        out.sort(key=lambda x: x.get("ts", 0))
-    else:
-        for s, arr in (d.get("history", {}) or {}).items():
-            for e in arr:
-                if e.get("ts", 0) >= since:
-                    out.append(dict(e, student=s))
-        out.sort(key=lambda x: x.get("ts", 0), reverse=True)
-    return jsonify({"ok": True, "items": out[-limit:]})
+        items.reverse()
+    resp = {"ok": True, "items": items, "next_cursor": next_cursor}
+
+    if request.args.get("dwell") in ("1", "true"):
+        intervals = [_as_interval(e) for _, arr in sources for e in arr or [] if isinstance(e, dict)]
+        intervals = STRINGS.decode_rows([iv for iv in intervals if iv["end"] >= since], TEXT_FIELDS)
+        dwell = {}
+        for iv in intervals:
+            row = dwell.setdefault(iv.get("url") or "", {"url": iv.get("url") or "", "title": iv.get("title") or "",
+                                                         "seconds": 0, "visits": 0})
+            row["seconds"] += iv["end"] - max(iv["start"], since)
+            row["visits"] += 1
+        resp["dwell"] = sorted(dwell.values(), key=lambda r: r["seconds"], reverse=True)
+    return jsonify(resp)
 
 @app.route("/api/screenshots", methods=["GET"])
 def api_screenshots():
@@ -3529,7 +4581,42 @@ def api_screenshots():
                 items.append(dict(e, student=s))
         items.sort(key=lambda x: x.get("ts", 0), reverse=True)
 
-    return jsonify({"ok": True, "items": items[-limit:]})
+    page = items[-limit:] if student else items[:limit]
+    thumbs = SCREENSHOTS.thumbs(it.get("shot_id") for it in page)
+    out = []
+    for it in STRINGS.decode_rows(page, ("title", "url")):
+        it.pop("dataUrl", None)
+        shot_id = it.get("shot_id")
+        if shot_id:
+            it["src"] = url_for("api_screenshot_image", shot_id=shot_id)
+            it["thumb"] = thumbs.get(shot_id)
+        out.append(it)
+    return jsonify({"ok": True, "items": out})
+
+@app.route("/api/screenshots/<int:shot_id>", methods=["GET"])
+def api_screenshot_image(shot_id):
+    """Full-size screenshot by id; ids are never reused, so it caches forever."""
+    u = current_user()
+    if not u or u["role"] not in ("teacher", "admin"):
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    etag = "shot-%d" % shot_id
+    if etag in request.if_none_match:
+        return Response(status=304, headers={"ETag": '"%s"' % etag})
+    shot = SCREENSHOTS.get(shot_id)
+    if shot is None:
+        return jsonify({"ok": False, "error": "not found"}), 404
+    mime, data = shot
+    return _image_response(mime, data, etag, "private, max-age=31536000, immutable")
+
+def _image_response(mime, data, etag, cache_control):
+    """Student-supplied image bytes (an IMAGE_TYPES mime), served so no browser treats them as a page."""
+    return Response(data, mimetype=mime, headers={
+        "ETag": '"%s"' % etag,
+        "Cache-Control": cache_control,
+        "X-Content-Type-Options": "nosniff",
+        "Content-Disposition": 'inline; filename="screenshot.%s"' % IMAGE_TYPES[mime],
+        "Content-Security-Policy": "default-src 'none'; sandbox",
+    })
 
 
 # =========================
@@ -3537,7 +4624,13 @@ def api_screenshots():
 # =========================
 @app.route("/api/alerts", methods=["GET", "POST"])
 def api_alerts():
-    d = ensure_keys(load_data())
+    """
+    POST: record an alert (extension or student).
+    GET:  teacher/admin view. ?after=<seq> returns only alerts newer than
+          that sequence id; otherwise the latest 200. `last_seq` is the
+          cursor for the next poll. ?student= and ?kind= narrow either to
+          one student's and/or one kind's alerts.
+    """
     if request.method == "POST":
         b = request.json or {}
         u = current_user()
@@ -3553,16 +4646,25 @@ def api_alerts():
             "url": (b.get("url") or ""),
             "note": (b.get("note") or "")
         }
-        d.setdefault("alerts", []).append(item)
-        d["alerts"] = d["alerts"][-500:]
-        save_data(d)
+        item = ALERTS.append(item)
+        ENGAGEMENT.add(student, "alert", ts=item["ts"])
         log_action({"event": "alert", "student": student, "kind": item["kind"], "score": item["score"]})
-        return jsonify({"ok": True})
+        _publish_student_event(student, "alert", item)
+        return jsonify({"ok": True, "seq": item["seq"]})
 
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    return jsonify({"ok": True, "items": d.get("alerts", [])[-200:]})
+    after = _after_seq_arg()
+    filters = {
+        "student": (request.args.get("student") or "").strip() or None,
+        "kind": (request.args.get("kind") or "").strip() or None,
+    }
+    last = ALERTS.last_seq
+    items = ALERTS.latest(200, **filters) if after is None else ALERTS.after(after, limit=200, **filters)
+    # A short page has caught up: resume from the stream head, not the last match.
+    last_seq = items[-1]["seq"] if len(items) == 200 else max([last, after or 0] + [e["seq"] for e in items[-1:]])
+    return jsonify({"ok": True, "items": items, "last_seq": last_seq})
 
 
 @app.route("/api/alerts/clear", methods=["POST"])
@@ -3572,13 +4674,11 @@ def api_alerts_clear():
         return jsonify({"ok": False, "error": "forbidden"}), 403
     b = request.json or {}
     student = (b.get("student") or "").strip()
-    d = ensure_keys(load_data())
-    if student:
-        d["alerts"] = [a for a in d.get("alerts", []) if a.get("student") != student]
-    else:
-        d["alerts"] = []
-    save_data(d)
-    return jsonify({"ok": True})
+    kind = (b.get("kind") or "").strip() or None
+    removed = ALERTS.clear(student=student or None, kind=kind)
+    if kind is None:
+        ENGAGEMENT.reset("alert", student or None)
+    return jsonify({"ok": True, "removed": removed})
 
 
 # =========================
@@ -3589,6 +4689,8 @@ def api_engagement():
     """
     Simple engagement score per student over a time window.
     Query param: window (seconds) -> default 1800, min 60, max 14400.
+    Counts come from the per-minute ENGAGEMENT buckets, so the window
+    starts on a minute boundary.
     """
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
@@ -3598,38 +4700,34 @@ def api_engagement():
         window = int(request.args.get("window", 1800))
     except Exception:
         window = 1800
-    window = max(60, min(window, 14400))
+    window = max(60, min(window, ENGAGEMENT_MAX_WINDOW))
 
     now = int(time.time())
     since = now - window
 
     d = ensure_keys(load_data())
+    results = _engagement_rows(d, since)
+    return jsonify({"ok": True, "window": window, "since": since, "now": now, "students": results})
+
+def _engagement_rows(d, since, roster=None):
+    """Engagement score rows since `since`, optionally only for `roster` (lowercased emails)."""
     presence = d.get("presence", {}) or {}
-    history = d.get("history", {}) or {}
-    off_events = d.get("offtask_events", []) or []
-    alerts = d.get("alerts", []) or []
+    counts = ENGAGEMENT.totals(since)
 
     students = set(presence.keys())
-    for student, arr in history.items():
-        if any((e.get("ts") or 0) >= since for e in (arr or [])):
-            students.add(student)
+    students.update(s for s, c in counts.items() if c.get("timeline"))
+    if roster is not None:
+        students = {s for s in students if (s or "").strip().lower() in roster}
 
     results = []
     for student in sorted(students):
         if not student:
             continue
 
-        hist = [e for e in (history.get(student) or []) if (e.get("ts") or 0) >= since]
-        total_events = len(hist)
-
-        student_off = [
-            e for e in off_events
-            if (e.get("student") == student and (e.get("ts") or 0) >= since and not bool(e.get("on_task", True)))
-        ]
-        off_count = len(student_off)
-
-        student_alerts = [a for a in alerts if (a.get("student") == student and (a.get("ts") or 0) >= since)]
-        alerts_count = len(student_alerts)
+        c = counts.get(student.strip().lower()) or {}
+        total_events = c.get("timeline", 0)
+        off_count = c.get("offtask", 0)
+        alerts_count = c.get("alert", 0)
 
         if total_events > 0:
             ratio = off_count / float(total_events)
@@ -3655,8 +4753,109 @@ def api_engagement():
             "last_seen": pres.get("last_seen") or 0,
             "risk": risk
         })
+    return results
 
-    return jsonify({"ok": True, "window": window, "since": since, "now": now, "students": results})
+
+# =========================
+# Teacher dashboard snapshot
+# =========================
+DASHBOARD_PANELS = ("class", "presence", "hands", "dm_unread", "exam_violations", "alerts", "engagement")
+
+def _known_versions_arg():
+    """Parse ?known=panel:version,... into a dict."""
+    out = {}
+    for part in (request.args.get("known") or "").split(","):
+        name, sep, v = part.partition(":")
+        if sep and name.strip():
+            out[name.strip()] = v.strip()
+    return out
+
+@app.route("/api/dashboard")
+def api_dashboard():
+    """Every teacher-page panel for one class, from a single load of state.
+
+    ?class_id=XYZ (required)
+    ?panels=a,b,...    subset of DASHBOARD_PANELS (default: all)
+    ?fields=...        presence projection, as for /api/presence
+    ?known=p:v,...     versions from an earlier reply; panels whose version
+                       is unchanged are left out of "panels".
+    ?window=<s>        engagement window (default 1800)
+
+    "presence" and "alerts" versions are cursors: with a known version
+    only newer rows are returned (presence "full" is then false).
+    Panels other than "class" only cover students on the class roster.
+    """
+    u = current_user()
+    if not u or u["role"] not in ("teacher", "admin"):
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+
+    cid = (request.args.get("class_id") or "").strip()
+    wanted = [p.strip() for p in (request.args.get("panels") or "").split(",") if p.strip()]
+    wanted = [p for p in DASHBOARD_PANELS if not wanted or p in wanted]
+    fields = [f.strip() for f in (request.args.get("fields") or "").split(",") if f.strip()]
+    known = _known_versions_arg()
+    try:
+        window = max(60, min(int(request.args.get("window", 1800)), ENGAGEMENT_MAX_WINDOW))
+    except ValueError:
+        window = 1800
+
+    # Cursors first: anything written after this shows up next time.
+    with DATA_LOCKS.hold("presence"):
+        presence_version = BACKPLANE.get("presence:version", 0)
+    alerts_seq = ALERTS.last_seq
+    d = ensure_keys(load_data())
+    cls = (d.get("classes") or {}).get(cid) if cid else None
+    if cls is None:
+        return jsonify({"ok": False, "error": "unknown class"}), 404
+    roster = {(s or "").strip().lower() for s in cls.get("students") or [] if s}
+
+    def on_roster(items):
+        return [x for x in items if isinstance(x, dict) and (x.get("student") or "").strip().lower() in roster]
+
+    versions, panels = {}, {}
+    for name in wanted:
+        if name == "presence":
+            if not cls.get("active"):
+                versions[name] = "inactive"
+                if known.get(name) != "inactive":
+                    panels[name] = {"full": True, "students": {}}
+                continue
+            try:
+                since = int(known["presence"]) if "presence" in known else None
+            except ValueError:
+                since = None
+            versions[name] = str(presence_version)
+            if since == presence_version:
+                continue
+            panels[name] = {"full": since is None, "students": _class_presence(d, cid, cls, fields, since)}
+            continue
+        if name == "alerts":
+            try:
+                after = int(known["alerts"]) if "alerts" in known else None
+            except ValueError:
+                after = None
+            versions[name] = str(alerts_seq)
+            if after == alerts_seq:
+                continue
+            items = (ALERTS.latest(200, students=roster) if after is None
+                     else ALERTS.after(after, limit=200, students=roster))
+            panels[name] = {"items": items}
+            continue
+        if name == "class":
+            data = _class_panel(d, cid)
+        elif name == "hands":
+            data = {"hands": on_roster(d.get("raises", []))}
+        elif name == "dm_unread":
+            data = {room[len("dm:"):]: n for room, n in CHAT.unread("teacher", rooms=("dm:" + s for s in sorted(roster))).items()}
+        elif name == "exam_violations":
+            data = {"items": on_roster(d.get("exam_violations", []))[-200:]}
+        else:  # engagement
+            data = {"window": window, "students": _engagement_rows(d, int(time.time()) - window, roster)}
+        versions[name] = _fingerprint(data)[:16]
+        if known.get(name) != versions[name]:
+            panels[name] = data
+
+    return jsonify({"ok": True, "class_id": cid, "versions": versions, "panels": panels})
 
 
 # =========================
@@ -3832,11 +5031,11 @@ def api_scenes_apply():
             for stu in students:
                 if stu in student_scenes:
                     student_scenes.pop(stu, None)
-                d.setdefault("pending_per_student", {}).setdefault(stu, []).append(
-                    {"type": "policy_refresh"}
-                )
 
             save_data(d)
+            _queue_pending(students, {"type": "policy_refresh"})
+            _policy_changed()
+            _push_command({"type": "policy_refresh"}, class_id=class_id)
             log_action({"event": "scene_disabled_class", "class_id": class_id})
             return jsonify({"ok": True, "current": []})
         else:
@@ -3847,6 +5046,7 @@ def api_scenes_apply():
             d["student_scenes"] = {}
             d["class_scenes"] = {}
             save_data(d)
+            _policy_changed()
             log_action({"event": "scene_disabled_global"})
             return jsonify({"ok": True, "current": []})
 
@@ -3895,12 +5095,12 @@ def api_scenes_apply():
                     cur_list.append(found)
             student_scenes[stu] = cur_list
 
-            # Push a per‑student policy refresh so the extension re‑loads policy.
-            d.setdefault("pending_per_student", {}).setdefault(stu, []).append(
-                {"type": "policy_refresh"}
-            )
-
         save_data(d)
+        # Push a per‑student policy refresh so the extension re‑loads policy.
+        _queue_pending(norm_students, {"type": "policy_refresh"})
+        _policy_changed(*norm_students)
+        for stu in norm_students:
+            _push_command({"type": "policy_refresh"}, student=stu)
         log_action(
             {"event": "scene_applied_students", "scene": found, "students": norm_students}
         )
@@ -3947,16 +5147,16 @@ def api_scenes_apply():
             for s in cls.get("students") or []
             if s and "@" in str(s)
         ]
-        for stu in students:
-            d.setdefault("pending_per_student", {}).setdefault(stu, []).append(
-                {"type": "policy_refresh"}
-            )
         save_data(d)
+        _queue_pending(students, {"type": "policy_refresh"})
+        _policy_changed()
+        _push_command({"type": "policy_refresh"}, class_id=class_id)
     else:
         # Legacy global update of scenes["current"].
         store["current"] = current_list
         _save_scenes(store)
         save_data(d)
+        _policy_changed()
 
     log_action({"event": "scene_applied", "scene": found, "class_id": class_id or None})
     return jsonify({"ok": True, "current": current_list})
@@ -3980,6 +5180,7 @@ def api_scenes_clear():
     d["student_scenes"] = {}
     d["class_scenes"] = {}
     save_data(d)
+    _policy_changed()
     return jsonify({"ok": True})
 
 @app.route("/api/scenes/set_default", methods=["POST"])
@@ -4044,13 +5245,16 @@ def api_dm_send():
     else:
         return jsonify({"ok": False, "error": "forbidden"}), 403
 
-    con = db(); cur = con.cursor()
-    cur.execute(
-        "INSERT INTO chat_messages(room,user_id,role,text,ts) VALUES(?,?,?,?,?)",
-        (room, user_id, role, text, int(time.time())),
-    )
-    con.commit(); con.close()
-    return jsonify({"ok": True})
+    m = CHAT.append(room, user_id, role, text)
+    _publish_student_event(room[len("dm:"):], "dm", dict(m, student=room[len("dm:"):]))
+    return jsonify({"ok": True, "id": m["id"]})
+
+def _page_args():
+    """(since, before, limit) from ?since=<id>&before=<id>&limit=N; ValueError if malformed."""
+    since = request.args.get("since")
+    before = request.args.get("before")
+    return (int(since) if since else None, int(before) if before else None,
+            int(request.args.get("limit") or 100))
 
 @app.route("/api/dm/me", methods=["GET"])
 def api_dm_me():
@@ -4065,10 +5269,12 @@ def api_dm_me():
     if not student:
         return jsonify({"ok": False, "error": "forbidden"}), 403
 
-    con = db(); cur = con.cursor()
-    cur.execute("SELECT user_id,role,text,ts FROM chat_messages WHERE room=? ORDER BY ts ASC", (f"dm:{student}",))
-    msgs = [{"from": r[1], "user": r[0], "text": r[2], "ts": r[3]} for r in cur.fetchall()]
-    con.close()
+    # A bare list, oldest first: the latest page, or ?since=<id> / ?before=<id>.
+    try:
+        since, before, limit = _page_args()
+    except ValueError:
+        return jsonify({"ok": False, "error": "bad cursor"}), 400
+    msgs, _ = CHAT.messages(f"dm:{student}", since=since, before=before, limit=limit)
     return jsonify(msgs)
 
 @app.route("/api/dm/<student>", methods=["GET"])
@@ -4076,28 +5282,25 @@ def api_dm_get(student):
     u = current_user()
     if not u:
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    d = ensure_keys(load_data())
-    msgs = d.get("dm", {}).get(student, [])[-200:]
-    return jsonify({"messages": msgs})
+    try:
+        since, before, limit = _page_args()
+    except ValueError:
+        return jsonify({"ok": False, "error": "bad cursor"}), 400
+    msgs, more = CHAT.messages(f"dm:{student}", since=since, before=before, limit=limit)
+    return jsonify({"messages": msgs, "more": more})
 
 @app.route("/api/dm/unread", methods=["GET"])
 def api_dm_unread():
-    d = ensure_keys(load_data())
-    out = {}
-    for student, msgs in d.get("dm", {}).items():
-        out[student] = sum(1 for m in msgs if m.get("from") == "student" and m.get("unread", True))
-    return jsonify(out)
+    """{student: n} of student messages the teacher side has not read."""
+    return jsonify({room[len("dm:"):]: n for room, n in CHAT.unread("teacher", prefix="dm:").items()})
 
 @app.route("/api/dm/mark_read", methods=["POST"])
 def api_dm_mark_read():
     body = request.json or {}
     student = body.get("student")
-    d = ensure_keys(load_data())
-    if student in d.get("dm", {}):
-        for m in d["dm"][student]:
-            if m.get("from") == "student":
-                m["unread"] = False
-        save_data(d)
+    if student:
+        u = current_user()
+        CHAT.mark_read(f"dm:{student}", "student" if u and u.get("role") == "student" else "teacher")
     return jsonify({"ok": True})
 
 
@@ -4110,15 +5313,15 @@ def api_attention_check():
     title = body.get("title", "Are you paying attention?")
     timeout = int(body.get("timeout", 30))
 
-    d = ensure_keys(load_data())
-    d["attention_check"] = {"title": title, "timeout": timeout, "ts": int(time.time()), "responses": {}}
-
-    d.setdefault("pending_commands", {}).setdefault("*", []).append({
+    with DATA_LOCKS.hold("attention_check"):
+        d = ensure_keys(load_data())
+        d["attention_check"] = {"title": title, "timeout": timeout, "ts": int(time.time()), "responses": {}}
+        save_data(d)
+    _send_command({
         "type": "attention_check",
         "title": title,
         "timeout": timeout
     })
-    save_data(d)
     log_action({"event": "attention_check_start", "title": title})
     return jsonify({"ok": True})
 
@@ -4127,12 +5330,14 @@ def api_attention_response():
     b = request.json or {}
     student = (b.get("student") or "").strip()
     response = b.get("response", "")
-    d = ensure_keys(load_data())
-    check = d.get("attention_check")
-    if not check:
-        return jsonify({"ok": False, "error": "no active check"}), 400
-    check["responses"][student] = {"response": response, "ts": int(time.time())}
-    save_data(d)
+    # attention_check is one entity for save_data(): responses need the lock.
+    with DATA_LOCKS.hold("attention_check"):
+        d = ensure_keys(load_data())
+        check = d.get("attention_check")
+        if not check:
+            return jsonify({"ok": False, "error": "no active check"}), 400
+        check["responses"][student] = {"response": response, "ts": int(time.time())}
+        save_data(d)
     log_action({"event": "attention_response", "student": student, "response": response})
     return jsonify({"ok": True})
 
@@ -4154,13 +5359,15 @@ def api_student_set():
     student = (b.get("student") or "").strip()
     if not student:
         return jsonify({"ok": False, "error": "student required"}), 400
-    d = ensure_keys(load_data())
-    ov = d.setdefault("student_overrides", {}).setdefault(student, {})
-    if "focus_mode" in b:
-        ov["focus_mode"] = bool(b.get("focus_mode"))
-    if "paused" in b:
-        ov["paused"] = bool(b.get("paused"))
-    save_data(d)
+    with DATA_LOCKS.hold(f"student:{student.lower()}"):
+        d = ensure_keys(load_data())
+        ov = d.setdefault("student_overrides", {}).setdefault(student, {})
+        if "focus_mode" in b:
+            ov["focus_mode"] = bool(b.get("focus_mode"))
+        if "paused" in b:
+            ov["paused"] = bool(b.get("paused"))
+        save_data(d)
+        _policy_changed(student)
     log_action({"event": "student_set", "student": student, "focus_mode": ov.get("focus_mode"), "paused": ov.get("paused")})
     return jsonify({"ok": True, "overrides": ov})
 
@@ -4183,26 +5390,25 @@ def api_open_tabs_alias():
     if not urls:
         return jsonify({"ok": False, "error": "urls required"}), 400
 
-    d = ensure_keys(load_data())
-    d.setdefault("pending_commands", {})
+    cmd = {"type": "open_tabs", "urls": urls, "ts": int(time.time()), "id": uuid.uuid4().hex}
 
     if student:
-        pend = d.setdefault("pending_per_student", {})
-        arr = pend.setdefault(student, [])
-        arr.append({"type": "open_tabs", "urls": urls, "ts": int(time.time())})
-        arr[:] = arr[-50:]
+        with DATA_LOCKS.hold(f"student:{student.lower()}"):
+            d = ensure_keys(load_data())
+            pend = d.setdefault("pending_per_student", {})
+            arr = pend.setdefault(student, [])
+            arr.append(cmd)
+            arr[:] = arr[-50:]
+            save_data(d)
+            _policy_changed(student)
+        _push_command(cmd, student=student)
         log_action({"event": "student_tabs", "student": student, "type": "open_tabs", "count": len(urls)})
     elif class_id:
-        classes = d.get("classes") or {}
-        cls = classes.get(class_id, {})
-        students = cls.get("students", []) or []
-        for s in students:
-            d["pending_commands"].setdefault(s, []).append({"type": "open_tabs", "urls": urls, "ts": int(time.time())})
+        _send_command(cmd, class_id=class_id)
         log_action({"event": "class_tabs", "target": class_id, "type": "open_tabs", "count": len(urls)})
     else:
         return jsonify({"ok": False, "error": "missing student or class_id"}), 400
 
-    save_data(d)
     return jsonify({"ok": True})
 @app.route("/api/student/tabs_action", methods=["POST"])
 def api_student_tabs_action():
@@ -4214,12 +5420,14 @@ def api_student_tabs_action():
     action = (b.get("action") or "").strip()  # 'restore_tabs' | 'close_tabs'
     if not student or action not in ("restore_tabs", "close_tabs"):
         return jsonify({"ok": False, "error": "student and valid action required"}), 400
-    d = ensure_keys(load_data())
-    pend = d.setdefault("pending_per_student", {})
-    arr = pend.setdefault(student, [])
-    arr.append({"type": action, "ts": int(time.time())})
-    arr[:] = arr[-50:]
-    save_data(d)
+    with DATA_LOCKS.hold(f"student:{student.lower()}"):
+        d = ensure_keys(load_data())
+        pend = d.setdefault("pending_per_student", {})
+        arr = pend.setdefault(student, [])
+        arr.append({"type": action, "ts": int(time.time())})
+        arr[:] = arr[-50:]
+        save_data(d)
+        _policy_changed(student)
     log_action({"event": "student_tabs", "student": student, "type": action})
     return jsonify({"ok": True})
 
@@ -4229,19 +5437,22 @@ def api_student_tabs_action():
 # =========================
 @app.route("/api/chat/<class_id>", methods=["GET", "POST"])
 def api_chat(class_id):
-    d = ensure_keys(load_data())
-    d.setdefault("chat", {}).setdefault(class_id, [])
     if request.method == "POST":
         b = request.json or {}
         txt = (b.get("text") or "")[:500]
         sender = b.get("from") or "student"
         if not txt:
             return jsonify({"ok": False, "error": "empty"}), 400
-        d["chat"][class_id].append({"from": sender, "text": txt, "ts": int(time.time())})
-        d["chat"][class_id] = d["chat"][class_id][-200:]
-        save_data(d)
-        return jsonify({"ok": True})
-    return jsonify({"enabled": d.get("settings", {}).get("chat_enabled", False), "messages": d["chat"][class_id][-100:]})
+        m = CHAT.append(f"class:{class_id}", sender, sender, txt)
+        return jsonify({"ok": True, "id": m["id"]})
+    try:
+        since, before, limit = _page_args()
+    except ValueError:
+        return jsonify({"ok": False, "error": "bad cursor"}), 400
+    msgs, more = CHAT.messages(f"class:{class_id}", since=since, before=before, limit=limit)
+    # Same source as /api/state and /api/data.
+    enabled = bool(ensure_keys(load_data())["settings"].get("chat_enabled", False))
+    return jsonify({"enabled": enabled, "messages": msgs, "more": more})
 
 
 # =========================
@@ -4252,12 +5463,15 @@ def api_raise_hand():
     b = request.json or {}
     student = (b.get("student") or "").strip()
     note = (b.get("note") or "").strip()
-    d = ensure_keys(load_data())
-    d.setdefault("raises", [])
-    d["raises"].append({"student": student, "note": note, "ts": int(time.time())})
-    d["raises"] = d["raises"][-200:]
-    save_data(d)
+    # Top-level lists are merged whole by save_data(): appends need the lock.
+    with DATA_LOCKS.hold("raises"):
+        d = ensure_keys(load_data())
+        d.setdefault("raises", [])
+        d["raises"].append({"student": student, "note": note, "ts": int(time.time())})
+        d["raises"] = d["raises"][-200:]
+        save_data(d)
     log_action({"event": "raise_hand", "student": student})
+    _publish_student_event(student, "hand", d["raises"][-1], d=d)
     return jsonify({"ok": True})
 
 @app.route("/api/raise_hand", methods=["GET"])
@@ -4269,14 +5483,15 @@ def get_hands():
 def clear_hand():
     b = request.json or {}
     student = (b.get("student") or "").strip()
-    d = ensure_keys(load_data())
-    lst = d.get("raises", [])
-    if student:
-        lst = [r for r in lst if r.get("student") != student]
-    else:
-        lst = []
-    d["raises"] = lst
-    save_data(d)
+    with DATA_LOCKS.hold("raises"):
+        d = ensure_keys(load_data())
+        lst = d.get("raises", [])
+        if student:
+            lst = [r for r in lst if r.get("student") != student]
+        else:
+            lst = []
+        d["raises"] = lst
+        save_data(d)
     return jsonify({"ok": True, "remaining": len(lst)})
 
 
@@ -4293,8 +5508,7 @@ def api_youtube_rules():
         set_setting("yt_allow_mode", bool(body.get("allow_mode", False)))
 
         # Broadcast an update command to all present students
-        d = ensure_keys(load_data())
-        d.setdefault("pending_commands", {}).setdefault("*", []).append({
+        _send_command({
             "type": "update_youtube_rules",
             "rules": {
                 "block_keywords": body.get("block_keywords", []),
@@ -4303,7 +5517,6 @@ def api_youtube_rules():
                 "allow_mode": bool(body.get("allow_mode", False))
             }
         })
-        save_data(d)
 
         log_action({"event": "youtube_rules_update"})
         return jsonify({"ok": True})
@@ -4348,12 +5561,10 @@ def api_save_overrides():
     d["allowlist"] = b.get("allowlist", [])
     d["teacher_blocks"] = b.get("teacher_blocks", [])
 
-    # Policy changed → force refresh for all students
-    d.setdefault("pending_commands", {}).setdefault("*", []).append({
-        "type": "policy_refresh"
-    })
-
     save_data(d)
+    _policy_changed()
+    # Policy changed → force refresh for all students
+    _send_command({"type": "policy_refresh"})
     log_action({"event": "overrides_save"})
     return jsonify({"ok": True})
 
@@ -4372,12 +5583,12 @@ def api_poll():
     if not q or not opts:
         return jsonify({"ok": False, "error": "question and options required"}), 400
     poll_id = "poll_" + str(int(time.time() * 1000))
-    d = ensure_keys(load_data())
-    d.setdefault("polls", {})[poll_id] = {"question": q, "options": opts, "responses": []}
-    d.setdefault("pending_commands", {}).setdefault("*", []).append({
-        "type": "poll", "id": poll_id, "question": q, "options": opts
-    })
-    save_data(d)
+    with DATA_LOCKS.hold("polls"):
+        d = ensure_keys(load_data())
+        d.setdefault("polls", {})[poll_id] = {"question": q, "options": opts, "responses": []}
+        save_data(d)
+    _send_command({"type": "poll", "id": poll_id, "question": q, "options": opts},
+                  class_id=(body.get("class_id") or "").strip(), d=d)
     log_action({"event": "poll_create", "poll_id": poll_id})
     return jsonify({"ok": True, "poll_id": poll_id})
 
@@ -4389,15 +5600,16 @@ def api_poll_response():
     student = (b.get("student") or "").strip()
     if not poll_id:
         return jsonify({"ok": False, "error": "no poll id"}), 400
-    d = ensure_keys(load_data())
-    if poll_id not in d.get("polls", {}):
-        return jsonify({"ok": False, "error": "unknown poll"}), 404
-    d["polls"][poll_id].setdefault("responses", []).append({
-        "student": student,
-        "answer": answer,
-        "ts": int(time.time())
-    })
-    save_data(d)
+    with DATA_LOCKS.hold("polls"):
+        d = ensure_keys(load_data())
+        if poll_id not in d.get("polls", {}):
+            return jsonify({"ok": False, "error": "unknown poll"}), 404
+        d["polls"][poll_id].setdefault("responses", []).append({
+            "student": student,
+            "answer": answer,
+            "ts": int(time.time())
+        })
+        save_data(d)
     log_action({"event": "poll_response", "poll_id": poll_id, "student": student})
     return jsonify({"ok": True})
 
@@ -4405,18 +5617,58 @@ def api_poll_response():
 # =========================
 # State (feature flags bucket)
 # =========================
-@app.route("/api/state")
-def api_state():
+def _state_doc():
+    """Feature flags, YouTube rules and the switches extensions read."""
     d = ensure_keys(load_data())
-    yt_rules = {
+    settings = d.get("settings") or {}
+    features = dict(settings.get("features") or {})
+    features["youtube_rules"] = {
         "block": get_setting("yt_block_keywords", []),
         "allow": get_setting("yt_allow", []),
         "allow_mode": bool(get_setting("yt_allow_mode", False))
     }
-    features = d.setdefault("settings", {}).setdefault("features", {})
-    features["youtube_rules"] = yt_rules
     features.setdefault("youtube_filter", True)
-    return jsonify(d)
+    return {
+        "settings": {"features": features, "chat_enabled": bool(settings.get("chat_enabled", False))},
+        "extension_enabled": bool(d.get("extension_enabled", True)),
+    }
+
+@app.route("/api/state")
+def api_state():
+    """Feature-flag document, same shape as the matching slice of data.json.
+
+    Cached per "state:version" and served with an ETag; clients that send
+    If-None-Match get a 304 until a flag changes. The full dump is
+    /api/admin/export.
+    """
+    version = BACKPLANE.get("state:version", 0)
+    entry = _STATE_CACHE["entry"]
+    if entry is None or entry[0] != version:
+        doc = dict(_state_doc(), version=version)
+        entry = _STATE_CACHE["entry"] = (version, doc, _fingerprint(doc))
+    _, doc, etag = entry
+    if etag in request.if_none_match:
+        return Response(status=304, headers={"ETag": '"%s"' % etag, "Cache-Control": "no-cache"})
+    resp = jsonify(doc)
+    resp.headers["ETag"] = '"%s"' % etag
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+@app.route("/api/admin/export")
+def api_admin_export():
+    """Full data.json with interned strings decoded (admin only)."""
+    u = current_user()
+    if not u or u["role"] != "admin":
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    d = ensure_keys(load_data())
+    d["presence"] = {s: _decode_presence(p) if isinstance(p, dict) else p for s, p in d["presence"].items()}
+    d["history"] = {s: STRINGS.decode_rows([e for e in arr if isinstance(e, dict)], TEXT_FIELDS)
+                    for s, arr in d["history"].items()}
+    d["screenshots"] = {s: STRINGS.decode_rows([e for e in arr if isinstance(e, dict)], ("title", "url"))
+                        for s, arr in d["screenshots"].items()}
+    resp = jsonify(d)
+    resp.headers["Content-Disposition"] = "attachment; filename=gschool-export-%d.json" % int(time.time())
+    return resp
 
 
 # =========================
@@ -4434,12 +5686,14 @@ def api_student_open_tabs():
     if not student or not urls:
         return jsonify({"ok": False, "error": "student and urls required"}), 400
 
-    d = load_data()
-    pend = d.setdefault("pending_per_student", {})
-    arr = pend.setdefault(student, [])
-    arr.append({"type": "open_tabs", "urls": urls, "ts": int(time.time())})
-    arr[:] = arr[-50:]
-    save_data(d)
+    with DATA_LOCKS.hold(f"student:{student.lower()}"):
+        d = load_data()
+        pend = d.setdefault("pending_per_student", {})
+        arr = pend.setdefault(student, [])
+        arr.append({"type": "open_tabs", "urls": urls, "ts": int(time.time())})
+        arr[:] = arr[-50:]
+        save_data(d)
+        _policy_changed(student)
     return jsonify({"ok": True})
 
 
@@ -4461,25 +5715,19 @@ def api_exam():
         return jsonify({"ok": False, "error": "class_id required"}), 400
 
     d = ensure_keys(load_data())
-    d.setdefault("pending_commands", {})
-    classes = d.get("classes") or {}
-    cls = classes.get(class_id, {})
-    students = cls.get("students", []) or []
 
     if action == "start":
         if not url:
             return jsonify({"ok": False, "error": "url required"}), 400
-        for s in students:
-            d["pending_commands"].setdefault(s, []).append({"type": "exam_start", "url": url})
         d.setdefault("exam_state", {})[class_id] = {"active": True, "url": url}
         save_data(d)
+        _send_command({"type": "exam_start", "url": url}, class_id=class_id, d=d)
         log_action({"event": "exam", "action": "start", "class_id": class_id, "url": url})
         return jsonify({"ok": True})
     elif action == "end":
-        for s in students:
-            d["pending_commands"].setdefault(s, []).append({"type": "exam_end"})
         d.setdefault("exam_state", {}).setdefault(class_id, {})["active"] = False
         save_data(d)
+        _send_command({"type": "exam_end"}, class_id=class_id, d=d)
         log_action({"event": "exam", "action": "end", "class_id": class_id})
         return jsonify({"ok": True})
 
@@ -4492,13 +5740,15 @@ def api_exam_violation():
     reason = (b.get("reason") or "tab_violation").strip()
     if not student:
         return jsonify({"ok": False, "error": "student required"}), 400
-    d = ensure_keys(load_data())
-    d.setdefault("exam_violations", []).append({
-        "student": student, "url": url, "reason": reason, "ts": int(time.time())
-    })
-    d["exam_violations"] = d["exam_violations"][-500:]
-    save_data(d)
+    with DATA_LOCKS.hold("exam_violations"):
+        d = ensure_keys(load_data())
+        d.setdefault("exam_violations", []).append({
+            "student": student, "url": url, "reason": reason, "ts": int(time.time())
+        })
+        d["exam_violations"] = d["exam_violations"][-500:]
+        save_data(d)
     log_action({"event": "exam_violation", "student": student, "reason": reason})
+    _publish_student_event(student, "exam_violation", d["exam_violations"][-1], d=d)
     return jsonify({"ok": True})
 
 @app.route("/api/exam_violations", methods=["GET"])
@@ -4516,12 +5766,13 @@ def api_exam_violations_clear():
         return jsonify({"ok": False, "error": "forbidden"}), 403
     b = request.json or {}
     student = (b.get("student") or "").strip()
-    d = ensure_keys(load_data())
-    if student:
-        d["exam_violations"] = [v for v in d.get("exam_violations", []) if v.get("student") != student]
-    else:
-        d["exam_violations"] = []
-    save_data(d)
+    with DATA_LOCKS.hold("exam_violations"):
+        d = ensure_keys(load_data())
+        if student:
+            d["exam_violations"] = [v for v in d.get("exam_violations", []) if v.get("student") != student]
+        else:
+            d["exam_violations"] = []
+        save_data(d)
     log_action({"event": "exam_violations_clear", "student": student or "*"})
     return jsonify({"ok": True})
 
@@ -4537,11 +5788,7 @@ def api_notify():
     b = request.json or {}
     title = (b.get("title") or "G School")[:120]
     message = (b.get("message") or "")[:500]
-    d = ensure_keys(load_data())
-    d.setdefault("pending_commands", {}).setdefault("*", []).append({
-        "type": "notify", "title": title, "message": message
-    })
-    save_data(d)
+    _send_command({"type": "notify", "title": title, "message": message})
     log_action({"event": "notify", "title": title})
     return jsonify({"ok": True})
 
@@ -4562,7 +5809,7 @@ def _ensure_image_filter_config(d):
     cfg.setdefault("block_threshold", 0.6)  # 0–1, higher = stricter
     cfg.setdefault("alert_on_block", True)
     cfg.setdefault("max_log_entries", 500)
-    d.setdefault("image_filter_events", [])
+    IMAGE_FILTER_EVENTS.resize(int(cfg.get("max_log_entries") or 500))
     return cfg
 
 
@@ -4616,6 +5863,170 @@ def api_image_filter_config():
     return jsonify({"ok": True, "config": cfg})
 
 
+# Shared across all students: the same banners and thumbnails show up on
+# hundreds of screens, so a verdict computed once is reused by everyone.
+_IMAGE_VERDICTS = VerdictCache(max_entries=int(os.environ.get("IMAGE_FILTER_CACHE_SIZE", 20000)))
+
+# Decode/score worker pool. IMAGE_FILTER_WORKERS=0 scores inline (no pool);
+# single-image requests arriving within IMAGE_FILTER_BATCH_WINDOW_MS of
+# each other are shipped to a worker together.
+_IMAGE_BATCHER = ImageBatcher(
+    workers=int(os.environ["IMAGE_FILTER_WORKERS"]) if os.environ.get("IMAGE_FILTER_WORKERS") else None,
+    window=float(os.environ.get("IMAGE_FILTER_BATCH_WINDOW_MS", 10)) / 1000.0,
+)
+IMAGE_FILTER_TIMEOUT = 10  # seconds to wait on the pool before allowing
+IMAGE_FILTER_MAX_BATCH = 100
+
+IMAGE_FILTER_PRIMARY_LABELS = [
+    "explicit_nudity",
+    "partial_nudity",
+    "suggestive",
+    "violence",
+    "weapon",
+    "self_harm",
+]
+
+
+def _image_filter_config_version(cfg):
+    """Cache version: any change to what turns scores into an action."""
+    return (cfg.get("mode", "block"), float(cfg.get("block_threshold", 0.6)))
+
+
+def _image_filter_decide(scores, cfg):
+    """Pick the highest concerning label and map it to allow/block/monitor."""
+    block_threshold = float(cfg.get("block_threshold", 0.6))
+
+    best_label = "other"
+    best_score = 0.0
+    for label in IMAGE_FILTER_PRIMARY_LABELS:
+        val = float(scores.get(label, 0.0))
+        if val > best_score:
+            best_score = val
+            best_label = label
+
+    action = "allow"
+    if best_score >= block_threshold:
+        action = "block" if cfg.get("mode", "block") == "block" else "monitor"
+    return {"action": action, "label": best_label, "score": best_score, "scores": scores}
+
+
+def _image_filter_max_scores(scores, hints):
+    """Per-label maximum of two score dicts."""
+    return {k: max(float(scores.get(k, 0.0)), float(hints.get(k, 0.0))) for k in set(scores) | set(hints)}
+
+
+def _image_filter_verdicts(cfg, items):
+    """
+    Verdicts for a list of (thumbnail, src, page_url) items.
+
+    Items are first looked up by normalized src URL, which needs no
+    decoding at all. The rest are decoded, fingerprinted and scored in
+    the _IMAGE_BATCHER process pool; a perceptual-hash hit then reuses
+    the pixel scores already given to the same picture under another URL.
+    Only pixel scores are cached by hash: the same picture may sit under
+    a benign URL and a keyword-laden one, so each request's src hints are
+    merged on top before the verdict is cached under its src. page_url
+    hints differ per page, so they are merged on top afterwards.
+    """
+    version = _image_filter_config_version(cfg)
+    out = [None] * len(items)
+    src_keys = []
+    misses = []
+    for i, (thumbnail, src, _page_url) in enumerate(items):
+        src_key = normalize_src(src)
+        src_key = "src:" + src_key if src_key else ""
+        src_keys.append(src_key)
+        verdict = _IMAGE_VERDICTS.get(version, src_key)
+        # A verdict made without pixels (tainted canvas) must not shadow a
+        # request that does carry a thumbnail.
+        if verdict is not None and thumbnail and not verdict.get("pixels"):
+            verdict = None
+        if verdict is None:
+            misses.append(i)
+        else:
+            out[i] = dict(verdict, cached=True)
+
+    if len(misses) == 1:
+        thumbnail, src, _page_url = items[misses[0]]
+        analyzed = [_IMAGE_BATCHER.submit(thumbnail, src).result(timeout=IMAGE_FILTER_TIMEOUT)]
+    else:
+        analyzed = _IMAGE_BATCHER.map([items[i][:2] for i in misses], timeout=IMAGE_FILTER_TIMEOUT)
+
+    for i, res in zip(misses, analyzed):
+        phash_key = "phash:" + res["phash"] if res["phash"] else ""
+        pixel = _IMAGE_VERDICTS.get(version, phash_key)
+        cached = pixel is not None
+        if pixel is None:
+            pixel = {"scores": res["scores"], "pixels": res["pixels"]}
+            _IMAGE_VERDICTS.put(version, (phash_key,), pixel)
+        scores = _image_filter_max_scores(pixel["scores"], res["src_scores"])
+        verdict = dict(_image_filter_decide(scores, cfg), pixels=pixel["pixels"])
+        _IMAGE_VERDICTS.put(version, (src_keys[i],), verdict)
+        out[i] = dict(verdict, cached=cached)
+
+    for i, (_thumbnail, _src, page_url) in enumerate(items):
+        if not page_url:
+            continue
+        verdict = out[i]
+        page_scores = _gschool_classify_image(None, page_url=page_url)
+        if any(page_scores.get(k, 0.0) > verdict["scores"].get(k, 0.0) for k in IMAGE_FILTER_PRIMARY_LABELS):
+            merged = _image_filter_max_scores(verdict["scores"], page_scores)
+            out[i] = dict(_image_filter_decide(merged, cfg), pixels=verdict.get("pixels"), cached=verdict["cached"])
+    return out
+
+
+def _image_filter_record(cfg, student, evaluated):
+    """Log evaluated (src, page_url, verdict) triples and alert on blocks."""
+    now = int(time.time())
+    events = []
+    blocked = []
+    for src, page_url, verdict in evaluated:
+        events.append({
+            "ts": now,
+            "student": student,
+            "page_url": page_url,
+            "src": src,
+            "action": verdict["action"],
+            "label": verdict["label"],
+            "score": verdict["score"],
+        })
+        if verdict["action"] == "block":
+            blocked.append((src, page_url, verdict))
+    IMAGE_FILTER_EVENTS.extend(events)
+
+    # When blocked, also create an alert for the teacher/admin
+    if blocked and cfg.get("alert_on_block", True):
+        try:
+            alerts = []
+            for src, page_url, verdict in blocked:
+                alerts.append({
+                    "ts": now,
+                    "student": student or "",
+                    "kind": "image_inappropriate",
+                    "score": float(verdict["score"]),
+                    "title": verdict["label"],
+                    "url": page_url or src,
+                    "note": src,
+                })
+            stored = ALERTS.extend(alerts)
+            ENGAGEMENT.add_many([(student, "alert", 1, a["ts"]) for a in stored])
+            if student and HUB.has_subscribers():
+                d = ensure_keys(load_data())
+                for item in stored:
+                    _publish_student_event(student, "alert", item, d=d)
+            for src, page_url, verdict in blocked:
+                log_action({
+                    "event": "image_filter_block",
+                    "student": student,
+                    "label": verdict["label"],
+                    "score": verdict["score"],
+                    "page_url": page_url,
+                    "src": src,
+                })
+        except Exception:
+            pass
+
+
 @app.route("/api/image_filter/evaluate", methods=["POST"])
 def api_image_filter_evaluate():
     """
@@ -4634,7 +6045,8 @@ def api_image_filter_evaluate():
         "ok": true,
         "action": "allow" | "block" | "monitor",
         "reason": "explicit_nudity" | "other",
-        "scores": {label: score}
+        "scores": {label: score},
+        "cached": bool
       }
     """
     d = ensure_keys(load_data())
@@ -4650,84 +6062,95 @@ def api_image_filter_evaluate():
     if not cfg.get("enabled", False):
         return jsonify({"ok": True, "action": "allow", "reason": "disabled", "scores": {}})
 
-    # Run lightweight classifier
+    # Run lightweight classifier (or reuse a cached verdict)
     try:
-        scores = _gschool_classify_image(thumbnail or None, src=src, page_url=page_url)
+        verdict = _image_filter_verdicts(cfg, [(thumbnail, src, page_url)])[0]
     except Exception as e:
         log_action({"event": "image_filter_error", "error": str(e)})
         return jsonify({"ok": True, "action": "allow", "reason": "error", "scores": {}})
 
-    # Decide based on highest concerning label
-    block_threshold = float(cfg.get("block_threshold", 0.6))
-    primary_labels = [
-        "explicit_nudity",
-        "partial_nudity",
-        "suggestive",
-        "violence",
-        "weapon",
-        "self_harm",
-    ]
+    _image_filter_record(cfg, student, [(src, page_url, verdict)])
 
-    best_label = "other"
-    best_score = 0.0
-    for label in primary_labels:
-        val = float(scores.get(label, 0.0))
-        if val > best_score:
-            best_score = val
-            best_label = label
+    return jsonify({
+        "ok": True,
+        "action": verdict["action"],
+        "reason": verdict["label"],
+        "scores": verdict["scores"],
+        "cached": verdict["cached"],
+    })
 
-    action = "allow"
-    if best_score >= block_threshold:
-        action = "block" if cfg.get("mode", "block") == "block" else "monitor"
 
-    # Append to dedicated log buffer
-    events = d.setdefault("image_filter_events", [])
-    events.append({
-        "ts": int(time.time()),
-        "student": student,
-        "page_url": page_url,
-        "src": src,
-        "action": action,
-        "label": best_label,
-        "score": best_score,
-    })
-    max_events = int(cfg.get("max_log_entries", 500) or 500)
-    d["image_filter_events"] = events[-max_events:]
-    save_data(d)
+@app.route("/api/image_filter/evaluate_batch", methods=["POST"])
+def api_image_filter_evaluate_batch():
+    """
+    Evaluate many images from one page in a single request.
 
-    # When blocked, also create an alert for the teacher/admin
-    if action == "block" and cfg.get("alert_on_block", True):
-        try:
-            d2 = ensure_keys(load_data())
-            alerts = d2.setdefault("alerts", [])
-            alerts.append({
-                "ts": int(time.time()),
-                "student": student or "",
-                "kind": "image_inappropriate",
-                "score": float(best_score),
-                "title": best_label,
-                "url": page_url or src,
-                "note": src,
-            })
-            d2["alerts"] = alerts[-500:]
-            save_data(d2)
-            log_action({
-                "event": "image_filter_block",
-                "student": student,
-                "label": best_label,
-                "score": best_score,
-                "page_url": page_url,
-                "src": src,
-            })
-        except Exception:
-            pass
+    Body:
+      {
+        "student": "student@example.com",
+        "page_url": "https://example.com/page",      # default for all items
+        "items": [
+          {"id": "img-1", "src": "https://...", "thumbnail": "data:...", "page_url": "..."},
+          ...
+        ]
+      }
 
-    return jsonify({
-        "ok": True,
-        "action": action,
-        "reason": best_label,
-        "scores": scores,
-    })
+    Response:
+      {
+        "ok": true,
+        "results": [{"id", "src", "action", "reason", "scores", "cached"}, ...]
+      }
+
+    Results are in the same order as `items`. At most
+    IMAGE_FILTER_MAX_BATCH items are accepted per request.
+    """
+    d = ensure_keys(load_data())
+    cfg = _ensure_image_filter_config(d)
+
+    body = request.json or {}
+    raw_items = body.get("items") or []
+    if not isinstance(raw_items, list):
+        return jsonify({"ok": False, "error": "items must be a list"}), 400
+    if len(raw_items) > IMAGE_FILTER_MAX_BATCH:
+        return jsonify({"ok": False, "error": f"at most {IMAGE_FILTER_MAX_BATCH} items"}), 400
+
+    student = (body.get("student") or "").strip()
+    default_page_url = (body.get("page_url") or "").strip()
+
+    items = []
+    for it in raw_items:
+        it = it if isinstance(it, dict) else {}
+        items.append((
+            it.get("thumbnail") or it.get("image") or "",
+            (it.get("src") or "").strip(),
+            (it.get("page_url") or default_page_url).strip(),
+        ))
+
+    def _result(it, verdict):
+        return {
+            "id": it.get("id") if isinstance(it, dict) else None,
+            "src": (it.get("src") or "") if isinstance(it, dict) else "",
+            "action": verdict["action"],
+            "reason": verdict["label"],
+            "scores": verdict["scores"],
+            "cached": verdict.get("cached", False),
+        }
+
+    if not cfg.get("enabled", False):
+        off = {"action": "allow", "label": "disabled", "scores": {}}
+        return jsonify({"ok": True, "results": [_result(it, off) for it in raw_items]})
+
+    try:
+        verdicts = _image_filter_verdicts(cfg, items)
+    except Exception as e:
+        log_action({"event": "image_filter_error", "error": str(e)})
+        err = {"action": "allow", "label": "error", "scores": {}}
+        return jsonify({"ok": True, "results": [_result(it, err) for it in raw_items]})
+
+    if verdicts:
+        _image_filter_record(cfg, student, [(src, page_url, v) for (_t, src, page_url), v in zip(items, verdicts)])
+
+    return jsonify({"ok": True, "results": [_result(it, v) for it, v in zip(raw_items, verdicts)]})
 
 
 @app.route("/api/image_filter/logs", methods=["GET"])
@@ -4735,14 +6158,22 @@ def api_image_filter_logs():
     """
     Admin-only endpoint to see recent image filter events.
     Used by admin.html to show a live log of blocked/flagged images.
+
+    ?after=<seq> returns only events newer than that sequence id; the
+    response's `last_seq` is the cursor for the next poll.
     """
     u = current_user()
     if not u or u.get("role") != "admin":
         return jsonify({"ok": False, "error": "forbidden"}), 403
 
-    d = ensure_keys(load_data())
-    events = d.get("image_filter_events", [])[-500:]
-    return jsonify({"ok": True, "events": events})
+    after = _after_seq_arg()
+    events = IMAGE_FILTER_EVENTS.latest(500) if after is None else IMAGE_FILTER_EVENTS.after(after, limit=500)
+    return jsonify({
+        "ok": True,
+        "events": events,
+        "last_seq": events[-1]["seq"] if events else (IMAGE_FILTER_EVENTS.last_seq if after is None else after),
+        "cache": _IMAGE_VERDICTS.stats(),
+    })
 
 # =========================
 # Off-task alert (student)
@@ -4755,13 +6186,11 @@ def api_off_task():
         url = (b.get("url") or "").strip()
         reason = (b.get("reason") or "blocked_visit")
         log_action({"event": "off_task", "student": student, "url": url, "reason": reason, "ts": int(time.time())})
-        d = ensure_keys(load_data())
-        d.setdefault("pending_commands", {}).setdefault("*", []).append({
+        _send_command({
             "type": "notify",
             "title": "Off-task detected",
             "message": f"{student or 'Student'} visited a blocked page."
         })
-        save_data(d)
         return jsonify({"ok": True})
     except Exception as e:
         try:
@@ -4778,4 +6207,7 @@ def api_off_task():
 if __name__ == "__main__":
     # Ensure data.json exists and is sane on boot
     save_data(ensure_keys(load_data()))
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    if socketio is not None:
+        socketio.run(app, host="0.0.0.0", port=5000, debug=True, allow_unsafe_werkzeug=True)
+    else:
+        app.run(host="0.0.0.0", port=5000, debug=True)
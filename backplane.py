@@ -0,0 +1,409 @@
+"""
+backplane.py
+Shared state for running more than one server process.
+
+Everything that used to live only in one process' memory and has to be
+seen by every worker -- presentation signaling rooms, long-poll wakeups,
+dashboard events, Socket.IO pushes -- goes through a Backplane:
+
+    bp = make_backplane(os.environ.get("BACKPLANE_URL", "local://"))
+    bp.set("present:room1", {...}, ttl=900)
+    bp.subscribe("hub", on_message)       # called from a background thread
+    bp.publish("hub", {"type": "hand"})
+    with bp.lock("present:room1"):
+        ...
+
+Implementations:
+  local://              LocalBackplane   single process (the default)
+  sqlite:// [/path]     SQLiteBackplane  several processes on one machine
+  redis://host:6379/0   RedisBackplane   several machines (needs `redis`)
+
+Values must be JSON-serializable; every backend stores a copy, so
+mutating a value after set() or get() never leaks between callers.
+publish() delivers to local subscribers immediately and to other
+processes as fast as the backend allows (SQLite polls every 50ms).
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import redis  # optional
+except Exception:
+    redis = None
+
+
+class LockTimeout(TimeoutError):
+    """Raised when a backplane lock could not be acquired in time."""
+
+
+class Backplane:
+    """Interface: key/value with TTL, counters, pub/sub and named locks."""
+
+    # True when every user of this backplane lives in this process.
+    local = False
+
+    def __init__(self):
+        self.origin = uuid.uuid4().hex
+        self._subs = defaultdict(list)
+        self._subs_lock = threading.Lock()
+
+    # ---------- key/value ----------
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def keys(self, prefix=""):
+        raise NotImplementedError
+
+    def incr(self, key, amount=1):
+        """Atomically add to an integer counter; returns the new value."""
+        raise NotImplementedError
+
+    # ---------- pub/sub ----------
+    def subscribe(self, channel, callback):
+        """Call `callback(message)` for every message published on `channel`."""
+        with self._subs_lock:
+            self._subs[channel].append(callback)
+        self._start_listener()
+
+    def publish(self, channel, message):
+        self._deliver(channel, message)
+        self._publish_remote(channel, message)
+
+    def _deliver(self, channel, message):
+        with self._subs_lock:
+            callbacks = list(self._subs.get(channel, ()))
+        for cb in callbacks:
+            try:
+                cb(message)
+            except Exception as e:
+                print("[WARN] backplane subscriber failed:", channel, e)
+
+    def _publish_remote(self, channel, message):
+        pass
+
+    def _start_listener(self):
+        pass
+
+    # ---------- locks ----------
+    @contextmanager
+    def lock(self, name, timeout=10, ttl=30):
+        """Hold `name` across all processes; raises LockTimeout after `timeout` seconds.
+
+        `ttl` bounds how long a crashed holder can keep others out.
+        """
+        token = self._acquire(name, timeout, ttl)
+        try:
+            yield
+        finally:
+            self._release(name, token)
+
+    def _acquire(self, name, timeout, ttl):
+        raise NotImplementedError
+
+    def _release(self, name, token):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class LocalBackplane(Backplane):
+    """In-process backplane; also the stand-in when only one worker runs."""
+
+    local = True
+
+    def __init__(self):
+        super().__init__()
+        self._kv = {}
+        self._kv_lock = threading.Lock()
+        self._locks = defaultdict(threading.Lock)
+
+    def get(self, key, default=None):
+        with self._kv_lock:
+            item = self._kv.get(key)
+            if item is None:
+                return default
+            raw, expires = item
+            if expires is not None and expires <= time.time():
+                del self._kv[key]
+                return default
+        return json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        raw = json.dumps(value)
+        with self._kv_lock:
+            self._kv[key] = (raw, time.time() + ttl if ttl else None)
+
+    def delete(self, key):
+        with self._kv_lock:
+            self._kv.pop(key, None)
+
+    def keys(self, prefix=""):
+        now = time.time()
+        with self._kv_lock:
+            return [k for k, (_, exp) in self._kv.items()
+                    if k.startswith(prefix) and (exp is None or exp > now)]
+
+    def incr(self, key, amount=1):
+        with self._kv_lock:
+            raw, expires = self._kv.get(key, ("0", None))
+            value = int(json.loads(raw)) + amount
+            self._kv[key] = (json.dumps(value), expires)
+            return value
+
+    def _acquire(self, name, timeout, ttl):
+        with self._kv_lock:
+            lk = self._locks[name]
+        if not lk.acquire(timeout=timeout):
+            raise LockTimeout(name)
+        return lk
+
+    def _release(self, name, token):
+        token.release()
+
+
+class SQLiteBackplane(Backplane):
+    """Backplane in a SQLite file shared by the processes on one machine."""
+
+    POLL_INTERVAL = 0.05
+    MESSAGE_TTL = 60
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._tls = threading.local()
+        self._listener = None
+        con = self._db()
+        con.execute("CREATE TABLE IF NOT EXISTS bp_kv (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS bp_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts REAL, channel TEXT, origin TEXT, payload TEXT
+            )
+        """)
+        con.execute("CREATE TABLE IF NOT EXISTS bp_locks (name TEXT PRIMARY KEY, owner TEXT, expires REAL)")
+
+    def _db(self):
+        con = getattr(self._tls, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            con.execute("PRAGMA journal_mode=WAL")
+            self._tls.con = con
+        return con
+
+    # ---------- key/value ----------
+    def get(self, key, default=None):
+        row = self._db().execute(
+            "SELECT value FROM bp_kv WHERE key=? AND (expires IS NULL OR expires>?)",
+            (key, time.time()),
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key, value, ttl=None):
+        self._db().execute(
+            "INSERT OR REPLACE INTO bp_kv(key, value, expires) VALUES (?,?,?)",
+            (key, json.dumps(value), time.time() + ttl if ttl else None),
+        )
+
+    def delete(self, key):
+        self._db().execute("DELETE FROM bp_kv WHERE key=?", (key,))
+
+    def keys(self, prefix=""):
+        now = time.time()
+        con = self._db()
+        con.execute("DELETE FROM bp_kv WHERE expires IS NOT NULL AND expires<=?", (now,))
+        rows = con.execute(
+            "SELECT key FROM bp_kv WHERE substr(key, 1, ?)=?", (len(prefix), prefix)
+        ).fetchall()
+        return [r[0] for r in rows]
+
+    def incr(self, key, amount=1):
+        con = self._db()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            row = con.execute("SELECT value FROM bp_kv WHERE key=?", (key,)).fetchone()
+            value = (int(json.loads(row[0])) if row else 0) + amount
+            con.execute("INSERT OR REPLACE INTO bp_kv(key, value, expires) VALUES (?,?,NULL)",
+                        (key, json.dumps(value)))
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        return value
+
+    # ---------- pub/sub ----------
+    def _publish_remote(self, channel, message):
+        self._db().execute(
+            "INSERT INTO bp_messages(ts, channel, origin, payload) VALUES (?,?,?,?)",
+            (time.time(), channel, self.origin, json.dumps(message)),
+        )
+
+    def _start_listener(self):
+        with self._subs_lock:
+            if self._listener is not None:
+                return
+            # Start after what is already there, as of subscribe() returning.
+            (last,) = self._db().execute("SELECT COALESCE(MAX(id), 0) FROM bp_messages").fetchone()
+            self._listener = threading.Thread(target=self._listen, args=(last,),
+                                              name="backplane-sqlite", daemon=True)
+        self._listener.start()
+
+    def _listen(self, last):
+        con = self._db()
+        next_trim = 0
+        while True:
+            try:
+                rows = con.execute(
+                    "SELECT id, channel, origin, payload FROM bp_messages WHERE id>? ORDER BY id",
+                    (last,),
+                ).fetchall()
+                for mid, channel, origin, payload in rows:
+                    last = mid
+                    if origin != self.origin:
+                        self._deliver(channel, json.loads(payload))
+                now = time.time()
+                if now >= next_trim:
+                    con.execute("DELETE FROM bp_messages WHERE ts<?", (now - self.MESSAGE_TTL,))
+                    next_trim = now + 10
+            except Exception as e:
+                print("[WARN] backplane listener:", e)
+            time.sleep(self.POLL_INTERVAL)
+
+    # ---------- locks ----------
+    def _acquire(self, name, timeout, ttl):
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        delay = 0.002
+        con = self._db()
+        while True:
+            now = time.time()
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                con.execute("DELETE FROM bp_locks WHERE name=? AND expires<=?", (name, now))
+                cur = con.execute("INSERT OR IGNORE INTO bp_locks(name, owner, expires) VALUES (?,?,?)",
+                                  (name, token, now + ttl))
+                con.execute("COMMIT")
+            except Exception:
+                con.execute("ROLLBACK")
+                raise
+            if cur.rowcount == 1:
+                return token
+            if time.monotonic() >= deadline:
+                raise LockTimeout(name)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    def _release(self, name, token):
+        self._db().execute("DELETE FROM bp_locks WHERE name=? AND owner=?", (name, token))
+
+
+class RedisBackplane(Backplane):
+    """Backplane on Redis. Pass `client` to use an existing (or stand-in) client."""
+
+    _RELEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, url=None, client=None, prefix="gschool:"):
+        super().__init__()
+        if client is None:
+            if redis is None:
+                raise RuntimeError("BACKPLANE_URL is redis:// but the redis package is not installed")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self._listener = None
+
+    def _k(self, key):
+        return self.prefix + key
+
+    def get(self, key, default=None):
+        raw = self.client.get(self._k(key))
+        return json.loads(raw) if raw is not None else default
+
+    def set(self, key, value, ttl=None):
+        px = int(ttl * 1000) if ttl else None
+        self.client.set(self._k(key), json.dumps(value), px=px)
+
+    def delete(self, key):
+        self.client.delete(self._k(key))
+
+    def keys(self, prefix=""):
+        n = len(self.prefix)
+        out = []
+        for k in self.client.scan_iter(match=self._k(prefix) + "*"):
+            k = k.decode() if isinstance(k, bytes) else k
+            out.append(k[n:])
+        return out
+
+    def incr(self, key, amount=1):
+        return int(self.client.incrby(self._k(key), amount))
+
+    def _publish_remote(self, channel, message):
+        self.client.publish(self._k("ch:" + channel), json.dumps({"o": self.origin, "m": message}))
+
+    def _start_listener(self):
+        with self._subs_lock:
+            if self._listener is not None:
+                return
+            self._listener = threading.Thread(target=self._listen, name="backplane-redis", daemon=True)
+        self._listener.start()
+
+    def _listen(self):
+        strip = len(self._k("ch:"))
+        while True:
+            try:
+                ps = self.client.pubsub(ignore_subscribe_messages=True)
+                ps.psubscribe(self._k("ch:") + "*")
+                while True:
+                    msg = ps.get_message(timeout=1.0)
+                    if not msg:
+                        continue
+                    channel = msg["channel"]
+                    channel = (channel.decode() if isinstance(channel, bytes) else channel)[strip:]
+                    body = json.loads(msg["data"])
+                    if body.get("o") != self.origin:
+                        self._deliver(channel, body.get("m"))
+            except Exception as e:
+                print("[WARN] backplane listener:", e)
+                time.sleep(1)
+
+    def _acquire(self, name, timeout, ttl):
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        delay = 0.002
+        while not self.client.set(self._k("lock:" + name), token, nx=True, px=int(ttl * 1000)):
+            if time.monotonic() >= deadline:
+                raise LockTimeout(name)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+        return token
+
+    def _release(self, name, token):
+        self.client.eval(self._RELEASE, 1, self._k("lock:" + name), token)
+
+
+def make_backplane(url=None, sqlite_path=None):
+    """Build a backplane from a BACKPLANE_URL-style string (see module docstring)."""
+    url = (url or "local://").strip()
+    if url in ("local", "local://"):
+        return LocalBackplane()
+    if url.startswith("sqlite://"):
+        path = url[len("sqlite://"):] or sqlite_path
+        if not path:
+            raise ValueError("sqlite:// backplane needs a path")
+        return SQLiteBackplane(path)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackplane(url)
+    raise ValueError("unknown BACKPLANE_URL: %s" % url)
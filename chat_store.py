@@ -0,0 +1,187 @@
+"""
+chat_store.py
+Class chat and teacher/student DMs in one SQLite table.
+
+Every message is a row of chat_messages keyed by room ("dm:<student>" or
+"class:<cid>"), read a page at a time through the (room, id) index using
+the message id as cursor:
+
+    CHAT = ChatStore(DB_PATH)
+    m = CHAT.append("dm:a@b.org", "a@b.org", "student", "hi")
+    CHAT.messages("dm:a@b.org")                 # newest page, oldest first
+    CHAT.messages("dm:a@b.org", since=m["id"])  # only newer messages
+    CHAT.messages("dm:a@b.org", before=m["id"]) # the page before
+
+Unread counts are kept per room and reader side in chat_unread, bumped in
+the same transaction as the insert and zeroed by mark_read(), so a badge
+is one primary-key lookup rather than a scan of the conversation.
+"""
+
+import sqlite3
+import time
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS chat_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        room TEXT,
+        user_id TEXT,
+        role TEXT,
+        text TEXT,
+        ts INTEGER
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_chat_messages_room ON chat_messages(room, id)",
+    "CREATE INDEX IF NOT EXISTS idx_chat_messages_room_ts ON chat_messages(room, ts)",
+    """
+    CREATE TABLE IF NOT EXISTS chat_unread (
+        room TEXT NOT NULL,
+        reader TEXT NOT NULL,
+        n INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (room, reader)
+    )
+    """,
+]
+
+
+class ChatStore:
+    # Who a message is unread for, by the sender's role.
+    READERS = {"student": "teacher", "teacher": "student"}
+
+    def __init__(self, db_path, max_page=200):
+        self.db_path = db_path
+        self.max_page = int(max_page)
+        con = self._db()
+        try:
+            for stmt in _SCHEMA:
+                con.execute(stmt)
+            con.commit()
+        finally:
+            con.close()
+
+    def _db(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    @staticmethod
+    def _row(r):
+        return {"id": r[0], "from": r[2], "user": r[1], "text": r[3], "ts": r[4]}
+
+    # ---------- writes ----------
+    def append(self, room, user_id, role, text, ts=None):
+        """Store a message; bumps the room's unread count for the other side."""
+        return self.extend(room, [(user_id, role, text, ts)])[-1]
+
+    def extend(self, room, items):
+        """Store several (user_id, role, text, ts) messages in one transaction."""
+        out = []
+        con = self._db()
+        try:
+            for user_id, role, text, ts in items:
+                ts = int(ts or time.time())
+                cur = con.execute(
+                    "INSERT INTO chat_messages(room,user_id,role,text,ts) VALUES(?,?,?,?,?)",
+                    (room, user_id, role, text, ts),
+                )
+                reader = self.READERS.get(role)
+                if reader:
+                    con.execute(
+                        "INSERT INTO chat_unread(room, reader, n) VALUES (?,?,1) "
+                        "ON CONFLICT(room, reader) DO UPDATE SET n = n + 1",
+                        (room, reader),
+                    )
+                out.append({"id": cur.lastrowid, "from": role, "user": user_id, "text": text, "ts": ts})
+            con.commit()
+        finally:
+            con.close()
+        return out
+
+    def mark_read(self, room, reader):
+        con = self._db()
+        try:
+            con.execute("UPDATE chat_unread SET n=0 WHERE room=? AND reader=?", (room, reader))
+            con.commit()
+        finally:
+            con.close()
+
+    def expire(self, before_ts, limit=1000):
+        """Drop up to `limit` of the oldest messages sent before `before_ts`; returns how many.
+
+        Unread counts of the rooms touched are clamped, in the same
+        transaction, to the messages still there for that reader.
+        """
+        con = self._db()
+        try:
+            ids = con.execute(
+                "SELECT id, room FROM chat_messages WHERE ts<? ORDER BY id LIMIT ?",
+                (int(before_ts), int(limit)),
+            ).fetchall()
+            if not ids:
+                return 0
+            con.executemany("DELETE FROM chat_messages WHERE id=?", [(i,) for i, _ in ids])
+            for room in {r for _, r in ids}:
+                for role, reader in self.READERS.items():
+                    con.execute(
+                        "UPDATE chat_unread SET n=MIN(n, (SELECT COUNT(*) FROM chat_messages "
+                        "WHERE room=? AND role=?)) WHERE room=? AND reader=?",
+                        (room, role, room, reader),
+                    )
+            con.commit()
+            return len(ids)
+        finally:
+            con.close()
+
+    # ---------- reads ----------
+    def messages(self, room, since=None, before=None, limit=100):
+        """A page of a room's messages, oldest first, and whether more exist.
+
+        since=<id>   the oldest `limit` messages after that id (polling);
+        before=<id>  the newest `limit` messages before that id (scrollback);
+        neither      the newest `limit` messages.
+        "more" means further messages exist past the far end of the page.
+        """
+        limit = max(1, min(int(limit), self.max_page))
+        con = self._db()
+        try:
+            if since is not None:
+                rows = con.execute(
+                    "SELECT id,user_id,role,text,ts FROM chat_messages WHERE room=? AND id>? "
+                    "ORDER BY id ASC LIMIT ?", (room, int(since), limit + 1),
+                ).fetchall()
+                more = len(rows) > limit
+                rows = rows[:limit]
+            else:
+                rows = con.execute(
+                    "SELECT id,user_id,role,text,ts FROM chat_messages WHERE room=? AND id<? "
+                    "ORDER BY id DESC LIMIT ?",
+                    (room, int(before) if before is not None else 2 ** 63 - 1, limit + 1),
+                ).fetchall()
+                more = len(rows) > limit
+                rows = rows[:limit][::-1]
+        finally:
+            con.close()
+        return [self._row(r) for r in rows], more
+
+    def unread(self, reader, rooms=None, prefix=None):
+        """{room: n} of non-zero unread counts for `reader`, for the given rooms or room prefix."""
+        con = self._db()
+        try:
+            if rooms is not None:
+                rooms = list(rooms)
+                out = {}
+                for i in range(0, len(rooms), 500):
+                    chunk = rooms[i:i + 500]
+                    out.update(con.execute(
+                        "SELECT room, n FROM chat_unread WHERE reader=? AND n>0 AND room IN (%s)"
+                        % ",".join("?" * len(chunk)), [reader] + chunk,
+                    ).fetchall())
+                return out
+            # Rooms starting with `prefix` sort between it and its successor.
+            prefix = prefix or ""
+            upper = prefix[:-1] + chr(ord(prefix[-1]) + 1) if prefix else "\U0010ffff"
+            return dict(con.execute(
+                "SELECT room, n FROM chat_unread WHERE room>=? AND room<? AND reader=? AND n>0",
+                (prefix, upper, reader),
+            ).fetchall())
+        finally:
+            con.close()
+
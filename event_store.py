@@ -0,0 +1,737 @@
+"""
+event_store.py
+Fixed-capacity event streams with monotonically increasing sequence ids.
+
+Used for the high-churn logs that used to live as lists inside data.json
+(image filter events, alerts, off-task checks). Appending to those meant
+copying the list, trimming it and rewriting the whole file; here an
+append is one INSERT plus a deque push, and readers only fetch what they
+have not seen yet:
+
+    ring = EventRing(DB_PATH, "alerts", capacity=500)
+    ev = ring.append({"student": "a@b.org", "kind": "off_task"})
+    newer = ring.after(ev["seq"])
+
+Each stream keeps its newest `capacity` events in memory and in the
+event_log table (trimmed in batches, so the table is effectively
+append-only). Sequence ids are allocated from the event_streams table,
+so they never go backwards -- not after a clear, not across restarts and
+not across worker processes sharing the same database.
+
+StudentEventLog is for streams read per student (alerts): every event is
+a row indexed by (student, kind, seq), at most `per_student` are kept for
+each student, and reads, clears and trims by student or kind only touch
+that student's rows. Sequence ids come from the same event_streams row,
+so ?after= cursors work across all students.
+
+CommandLog is the same idea for commands sent to student extensions:
+one row per send, addressed to a target ("student:<email>",
+"class:<cid>" or "*"), read by each student through its own ack cursor.
+Shared targets are only read from the seq a student joined them at, so
+someone added to a class is not replayed what it was sent before.
+
+MinuteCounters keeps per-student counts of those events in one-minute
+buckets, updated as they are ingested, so window totals cost one row per
+student, kind and minute instead of a scan of every stored event.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from collections import deque
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS event_log (
+        stream TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        ts INTEGER,
+        student TEXT,
+        body TEXT,
+        PRIMARY KEY (stream, seq)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS event_streams (
+        stream TEXT PRIMARY KEY,
+        last_seq INTEGER NOT NULL DEFAULT 0,
+        epoch INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS command_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts INTEGER NOT NULL,
+        target TEXT NOT NULL,
+        body TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_command_log_target ON command_log(target, seq)",
+    """
+    CREATE TABLE IF NOT EXISTS student_events (
+        stream TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        student TEXT NOT NULL,
+        kind TEXT,
+        ts INTEGER,
+        body TEXT,
+        PRIMARY KEY (stream, seq)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_student_events_student ON student_events(stream, student, seq)",
+    "CREATE INDEX IF NOT EXISTS idx_student_events_kind ON student_events(stream, student, kind, seq)",
+    """
+    CREATE TABLE IF NOT EXISTS command_cursors (
+        reader TEXT PRIMARY KEY,
+        acked INTEGER NOT NULL DEFAULT 0,
+        ts INTEGER
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS command_joins (
+        reader TEXT NOT NULL,
+        target TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        PRIMARY KEY (reader, target)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS minute_counts (
+        student TEXT NOT NULL,
+        minute INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        n INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (minute, student, kind)
+    )
+    """,
+]
+
+
+class EventRing:
+    """A ring buffer of events for one named stream."""
+
+    def __init__(self, db_path, stream, capacity=500):
+        self.db_path = db_path
+        self.stream = stream
+        self.capacity = max(1, int(capacity))
+        self._events = deque(maxlen=self.capacity)
+        self._last_seq = 0
+        self._epoch = 0
+        self._since_trim = 0
+        self._lock = threading.Lock()
+
+        con = self._db()
+        try:
+            for stmt in _SCHEMA:
+                con.execute(stmt)
+            con.execute("INSERT OR IGNORE INTO event_streams(stream) VALUES (?)", (stream,))
+            con.commit()
+        finally:
+            con.close()
+        with self._lock:
+            self._sync_locked()
+
+    def _db(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    # ---------- sync ----------
+    def _sync_locked(self):
+        """Catch up with appends (and clears) made by other processes."""
+        con = self._db()
+        try:
+            row = con.execute(
+                "SELECT last_seq, epoch FROM event_streams WHERE stream=?", (self.stream,)
+            ).fetchone()
+            last_seq, epoch = row if row else (0, 0)
+            if epoch != self._epoch:
+                # Someone removed events; rebuild from the table.
+                self._events.clear()
+                self._last_seq = 0
+                self._epoch = epoch
+            if last_seq <= self._last_seq:
+                return
+            rows = con.execute(
+                "SELECT seq, body FROM event_log WHERE stream=? AND seq>? ORDER BY seq DESC LIMIT ?",
+                (self.stream, self._last_seq, self.capacity),
+            ).fetchall()
+        finally:
+            con.close()
+        for seq, body in reversed(rows):
+            try:
+                ev = json.loads(body)
+            except Exception:
+                continue
+            ev["seq"] = seq
+            self._events.append(ev)
+        self._last_seq = last_seq
+
+    # ---------- writes ----------
+    def append(self, event):
+        """Store one event; returns a copy carrying its new `seq`."""
+        return self.extend([event])[0]
+
+    def extend(self, events, _only_if_empty=False):
+        events = [dict(e or {}) for e in events]
+        if not events:
+            return []
+        with self._lock:
+            con = self._db()
+            try:
+                con.execute("BEGIN IMMEDIATE")
+                (last,) = con.execute(
+                    "SELECT last_seq FROM event_streams WHERE stream=?", (self.stream,)
+                ).fetchone()
+                if _only_if_empty and last:
+                    con.rollback()
+                    return []
+                rows = []
+                for i, ev in enumerate(events, start=1):
+                    ev.pop("seq", None)
+                    ev.setdefault("ts", int(time.time()))
+                    rows.append((self.stream, last + i, ev.get("ts"), ev.get("student"), json.dumps(ev)))
+                    ev["seq"] = last + i
+                new_last = last + len(events)
+                con.executemany(
+                    "INSERT INTO event_log(stream, seq, ts, student, body) VALUES (?,?,?,?,?)", rows
+                )
+                con.execute("UPDATE event_streams SET last_seq=? WHERE stream=?", (new_last, self.stream))
+                # Trim in batches of `capacity` so the table stays bounded
+                # without a DELETE on every append.
+                self._since_trim += len(events)
+                if self._since_trim >= self.capacity:
+                    con.execute(
+                        "DELETE FROM event_log WHERE stream=? AND seq<=?",
+                        (self.stream, new_last - self.capacity),
+                    )
+                    self._since_trim = 0
+                con.commit()
+            finally:
+                con.close()
+            self._sync_locked()
+        return events
+
+    def seed(self, events):
+        """Import legacy events, but only into a stream that was never written."""
+        return self.extend(events, _only_if_empty=True)
+
+    def remove_where(self, predicate):
+        """Drop matching events; returns how many were removed."""
+        with self._lock:
+            self._sync_locked()
+            doomed = [e["seq"] for e in self._events if predicate(e)]
+            if not doomed:
+                return 0
+            con = self._db()
+            try:
+                con.execute("BEGIN IMMEDIATE")
+                con.executemany(
+                    "DELETE FROM event_log WHERE stream=? AND seq=?",
+                    [(self.stream, seq) for seq in doomed],
+                )
+                con.execute("UPDATE event_streams SET epoch=epoch+1 WHERE stream=?", (self.stream,))
+                con.commit()
+            finally:
+                con.close()
+            self._sync_locked()
+            return len(doomed)
+
+    def clear(self):
+        with self._lock:
+            con = self._db()
+            try:
+                con.execute("BEGIN IMMEDIATE")
+                con.execute("DELETE FROM event_log WHERE stream=?", (self.stream,))
+                con.execute("UPDATE event_streams SET epoch=epoch+1 WHERE stream=?", (self.stream,))
+                con.commit()
+            finally:
+                con.close()
+            self._sync_locked()
+
+    def expire(self, before_ts):
+        """Drop events older than `before_ts`; returns how many were removed."""
+        with self._lock:
+            con = self._db()
+            try:
+                con.execute("BEGIN IMMEDIATE")
+                n = con.execute(
+                    "DELETE FROM event_log WHERE stream=? AND ts<?", (self.stream, int(before_ts))
+                ).rowcount
+                if n:
+                    con.execute("UPDATE event_streams SET epoch=epoch+1 WHERE stream=?", (self.stream,))
+                con.commit()
+            finally:
+                con.close()
+            if n:
+                self._sync_locked()
+            return n
+
+    def resize(self, capacity):
+        capacity = max(1, int(capacity))
+        with self._lock:
+            if capacity == self.capacity:
+                return
+            grow = capacity > self.capacity
+            self.capacity = capacity
+            self._events = deque(self._events, maxlen=capacity)
+            if grow:
+                # Older events may still be in the table; reload them.
+                self._last_seq = 0
+                self._events.clear()
+                self._sync_locked()
+
+    # ---------- reads ----------
+    @property
+    def last_seq(self):
+        with self._lock:
+            self._sync_locked()
+            return self._last_seq
+
+    def after(self, seq=0, limit=None):
+        """Events with seq > `seq`, oldest first (at most `limit`, the oldest ones)."""
+        with self._lock:
+            self._sync_locked()
+            out = []
+            for ev in reversed(self._events):
+                if ev["seq"] <= seq:
+                    break
+                out.append(ev)
+        out.reverse()
+        if limit is not None:
+            out = out[:limit]
+        return out
+
+    def latest(self, limit=None):
+        """Newest `limit` events (all buffered events if None), oldest first."""
+        with self._lock:
+            self._sync_locked()
+            items = list(self._events)
+        if limit is not None:
+            items = items[-limit:] if limit > 0 else []
+        return items
+
+
+class StudentEventLog:
+    """Events indexed by student and kind, bounded per student.
+
+    Filters (`student`, `students`, `kind`) compose with `after`; student
+    keys are compared lowercased. Events an EventRing of the same stream
+    left in event_log are moved over on first use.
+    """
+
+    def __init__(self, db_path, stream, per_student=200):
+        self.db_path = db_path
+        self.stream = stream
+        self.per_student = max(1, int(per_student))
+        con = self._db()
+        try:
+            for stmt in _SCHEMA:
+                con.execute(stmt)
+            con.execute("INSERT OR IGNORE INTO event_streams(stream) VALUES (?)", (stream,))
+            con.commit()
+            self._adopt_ring(con)
+        finally:
+            con.close()
+
+    def _db(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    @staticmethod
+    def _key(student):
+        return str(student or "").strip().lower()
+
+    def _adopt_ring(self, con):
+        con.execute("BEGIN IMMEDIATE")
+        rows = con.execute("SELECT seq, ts, body FROM event_log WHERE stream=?", (self.stream,)).fetchall()
+        if not rows:
+            con.rollback()
+            return
+        students = set()
+        for seq, ts, body in rows:
+            try:
+                ev = json.loads(body)
+            except Exception:
+                continue
+            students.add(self._key(ev.get("student")))
+            con.execute(
+                "INSERT OR IGNORE INTO student_events(stream, seq, student, kind, ts, body) VALUES (?,?,?,?,?,?)",
+                (self.stream, seq, self._key(ev.get("student")), ev.get("kind"), ts, body),
+            )
+        con.execute("DELETE FROM event_log WHERE stream=?", (self.stream,))
+        for student in students:
+            self._trim(con, student)
+        con.commit()
+
+    def _trim(self, con, student):
+        con.execute(
+            "DELETE FROM student_events WHERE stream=? AND student=? AND seq <= ("
+            "SELECT seq FROM student_events WHERE stream=? AND student=? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+            (self.stream, student, self.stream, student, self.per_student),
+        )
+
+    @staticmethod
+    def _filters(student=None, students=None, kind=None):
+        where, args = [], []
+        if student is not None:
+            students = [student]
+        if students is not None:
+            keys = sorted({StudentEventLog._key(s) for s in students})
+            where.append("student IN (%s)" % ",".join("?" * len(keys)) if keys else "0")
+            args += keys
+        if kind is not None:
+            where.append("kind=?")
+            args.append(kind)
+        return where, args
+
+    # ---------- writes ----------
+    def append(self, event):
+        """Store one event; returns a copy carrying its new `seq`."""
+        return self.extend([event])[0]
+
+    def extend(self, events, _only_if_empty=False):
+        events = [dict(e or {}) for e in events]
+        if not events:
+            return []
+        con = self._db()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            (last,) = con.execute(
+                "SELECT last_seq FROM event_streams WHERE stream=?", (self.stream,)
+            ).fetchone()
+            if _only_if_empty and last:
+                con.rollback()
+                return []
+            students = set()
+            for i, ev in enumerate(events, start=1):
+                ev.pop("seq", None)
+                ev.setdefault("ts", int(time.time()))
+                key = self._key(ev.get("student"))
+                students.add(key)
+                con.execute(
+                    "INSERT INTO student_events(stream, seq, student, kind, ts, body) VALUES (?,?,?,?,?,?)",
+                    (self.stream, last + i, key, ev.get("kind"), ev.get("ts"), json.dumps(ev)),
+                )
+                ev["seq"] = last + i
+            con.execute("UPDATE event_streams SET last_seq=? WHERE stream=?", (last + len(events), self.stream))
+            for key in students:
+                self._trim(con, key)
+            con.commit()
+        finally:
+            con.close()
+        return events
+
+    def seed(self, events):
+        """Import legacy events, but only into a stream that was never written."""
+        return self.extend(events, _only_if_empty=True)
+
+    def clear(self, student=None, kind=None):
+        """Drop the events of one student and/or kind (all if neither); returns how many."""
+        where, args = self._filters(student=student, kind=kind)
+        con = self._db()
+        try:
+            cur = con.execute(
+                "DELETE FROM student_events WHERE %s" % " AND ".join(["stream=?"] + where),
+                [self.stream] + args,
+            )
+            con.commit()
+            return cur.rowcount
+        finally:
+            con.close()
+
+    def expire(self, before_ts, limit=1000):
+        """Drop up to `limit` of the oldest events older than `before_ts`; returns how many."""
+        con = self._db()
+        try:
+            cur = con.execute(
+                "DELETE FROM student_events WHERE stream=? AND seq IN ("
+                "SELECT seq FROM student_events WHERE stream=? AND ts<? ORDER BY seq LIMIT ?)",
+                (self.stream, self.stream, int(before_ts), int(limit)),
+            )
+            con.commit()
+            return cur.rowcount
+        finally:
+            con.close()
+
+    # ---------- reads ----------
+    @property
+    def last_seq(self):
+        con = self._db()
+        try:
+            row = con.execute("SELECT last_seq FROM event_streams WHERE stream=?", (self.stream,)).fetchone()
+        finally:
+            con.close()
+        return row[0] if row else 0
+
+    def _select(self, where, args, order, limit):
+        sql = "SELECT seq, body FROM student_events WHERE %s ORDER BY seq %s" % (
+            " AND ".join(["stream=?"] + where), order)
+        if limit is not None:
+            sql += " LIMIT %d" % max(0, int(limit))
+        con = self._db()
+        try:
+            rows = con.execute(sql, [self.stream] + args).fetchall()
+        finally:
+            con.close()
+        out = []
+        for seq, body in rows:
+            try:
+                ev = json.loads(body)
+            except Exception:
+                continue
+            ev["seq"] = seq
+            out.append(ev)
+        return out
+
+    def after(self, seq=0, limit=None, student=None, students=None, kind=None):
+        """Matching events with seq > `seq`, oldest first (at most `limit`, the oldest ones)."""
+        where, args = self._filters(student, students, kind)
+        return self._select(where + ["seq>?"], args + [int(seq)], "ASC", limit)
+
+    def latest(self, limit=None, student=None, students=None, kind=None):
+        """Newest `limit` matching events (all if None), oldest first."""
+        where, args = self._filters(student, students, kind)
+        return self._select(where, args, "DESC", limit)[::-1]
+
+
+class CommandLog:
+    """Append-only command log with per-reader acknowledgement cursors.
+
+    A class or broadcast command is one row however many students read
+    it. Readers see rows addressed to any of their targets with a seq
+    above their cursor and no older than `ttl` seconds, so a student who
+    never connected is not replayed a day of stale commands.
+
+    Shared targets (a class, "*") are also gated by a join seq per reader
+    and target: join() records it when a student is added to a roster,
+    and pending() records it on first sight otherwise, so a reader only
+    sees what was sent to a shared target after it joined.
+    """
+
+    def __init__(self, db_path, ttl=3600, retention=86400):
+        self.db_path = db_path
+        self.ttl = int(ttl)
+        self.retention = max(int(retention), self.ttl)
+        self._appends = 0
+        self._lock = threading.Lock()
+        con = self._db()
+        try:
+            for stmt in _SCHEMA:
+                con.execute(stmt)
+            con.commit()
+        finally:
+            con.close()
+
+    def _db(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def append(self, target, command):
+        """Store a command for `target`; returns a copy carrying `seq` and `ts`."""
+        cmd = dict(command or {})
+        cmd.pop("seq", None)
+        ts = int(time.time())
+        con = self._db()
+        try:
+            cur = con.execute(
+                "INSERT INTO command_log(ts, target, body) VALUES (?,?,?)",
+                (ts, target, json.dumps(cmd)),
+            )
+            cmd["seq"] = cur.lastrowid
+            with self._lock:
+                self._appends += 1
+                trim = self._appends % 500 == 0
+            if trim:
+                con.execute("DELETE FROM command_log WHERE ts<?", (ts - self.retention,))
+                con.execute("DELETE FROM command_cursors WHERE ts<?", (ts - self.retention,))
+            con.commit()
+        finally:
+            con.close()
+        cmd.setdefault("ts", ts)
+        return cmd
+
+    @staticmethod
+    def _last_seq(con):
+        row = con.execute("SELECT seq FROM sqlite_sequence WHERE name='command_log'").fetchone()
+        return row[0] if row else 0
+
+    def join(self, target, readers):
+        """Start `readers` on shared `target` from the current seq (no-op if already joined)."""
+        readers = [r for r in readers if r]
+        if not readers:
+            return
+        con = self._db()
+        try:
+            seq = self._last_seq(con)
+            con.executemany(
+                "INSERT OR IGNORE INTO command_joins(reader, target, seq) VALUES (?,?,?)",
+                [(r, target, seq) for r in readers],
+            )
+            con.commit()
+        finally:
+            con.close()
+
+    def leave(self, target, readers):
+        con = self._db()
+        try:
+            con.executemany(
+                "DELETE FROM command_joins WHERE reader=? AND target=?", [(r, target) for r in readers if r]
+            )
+            con.commit()
+        finally:
+            con.close()
+
+    def cursor(self, reader):
+        con = self._db()
+        try:
+            row = con.execute("SELECT acked FROM command_cursors WHERE reader=?", (reader,)).fetchone()
+        finally:
+            con.close()
+        return row[0] if row else 0
+
+    def ack(self, reader, seq):
+        """Advance `reader`'s cursor to `seq` (never backwards, never past the last seq); returns the cursor."""
+        con = self._db()
+        try:
+            seq = max(0, min(int(seq or 0), self._last_seq(con)))
+            con.execute(
+                "INSERT INTO command_cursors(reader, acked, ts) VALUES (?,?,?) "
+                "ON CONFLICT(reader) DO UPDATE SET acked=MAX(acked, excluded.acked), ts=excluded.ts",
+                (reader, seq, int(time.time())),
+            )
+            con.commit()
+            (acked,) = con.execute("SELECT acked FROM command_cursors WHERE reader=?", (reader,)).fetchone()
+        finally:
+            con.close()
+        return acked
+
+    def pending(self, reader, targets, limit=100, shared=()):
+        """Unacknowledged commands for `reader` across `targets`, oldest first.
+
+        `shared` are the targets among them gated by a join seq; those
+        the reader has not joined yet are joined now.
+        """
+        targets = list(targets)
+        if not targets:
+            return []
+        since = int(time.time()) - self.ttl
+        con = self._db()
+        try:
+            if shared:
+                seq = self._last_seq(con)
+                con.executemany(
+                    "INSERT OR IGNORE INTO command_joins(reader, target, seq) VALUES (?,?,?)",
+                    [(reader, t, seq) for t in shared if t in targets],
+                )
+                con.commit()
+            row = con.execute("SELECT acked FROM command_cursors WHERE reader=?", (reader,)).fetchone()
+            acked = row[0] if row else 0
+            rows = con.execute(
+                "SELECT l.seq, l.body FROM command_log l "
+                "LEFT JOIN command_joins j ON j.reader=? AND j.target=l.target "
+                "WHERE l.target IN (%s) AND l.seq>? AND l.ts>=? AND l.seq>COALESCE(j.seq, 0) "
+                "ORDER BY l.seq LIMIT ?" % ",".join("?" * len(targets)),
+                [reader] + targets + [acked, since, int(limit)],
+            ).fetchall()
+        finally:
+            con.close()
+        out = []
+        for seq, body in rows:
+            try:
+                cmd = json.loads(body)
+            except Exception:
+                continue
+            cmd["seq"] = seq
+            out.append(cmd)
+        return out
+
+
+class MinuteCounters:
+    """Per-student event counts in one-minute buckets.
+
+        COUNTS = MinuteCounters(DB_PATH, retention=4 * 3600)
+        COUNTS.add("a@b.org", "alert")
+        COUNTS.totals(since=now - 1800)   # -> {"a@b.org": {"alert": 1}}
+
+    Buckets older than `retention` seconds are dropped in batches.
+    """
+
+    def __init__(self, db_path, retention=4 * 3600):
+        self.db_path = db_path
+        self.retention = int(retention)
+        self._adds = 0
+        self._lock = threading.Lock()
+        con = self._db()
+        try:
+            for stmt in _SCHEMA:
+                con.execute(stmt)
+            con.commit()
+        finally:
+            con.close()
+
+    def _db(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def add(self, student, kind, n=1, ts=None):
+        self.add_many([(student, kind, n, ts)])
+
+    def add_many(self, items):
+        """Count (student, kind, n, ts) tuples; ts None means now."""
+        now = int(time.time())
+        rows = [((student or "").strip().lower(), int(ts or now) // 60, kind, int(n))
+                for student, kind, n, ts in items if student]
+        if not rows:
+            return
+        con = self._db()
+        try:
+            con.executemany(
+                "INSERT INTO minute_counts(student, minute, kind, n) VALUES (?,?,?,?) "
+                "ON CONFLICT(minute, student, kind) DO UPDATE SET n=n+excluded.n",
+                rows,
+            )
+            with self._lock:
+                self._adds += len(rows)
+                trim = self._adds >= 1000
+                if trim:
+                    self._adds = 0
+            if trim:
+                con.execute("DELETE FROM minute_counts WHERE minute<?", ((now - self.retention) // 60,))
+            con.commit()
+        finally:
+            con.close()
+
+    def reset(self, kind, student=None):
+        """Forget all counts of `kind` (for one student if given)."""
+        sql, args = "DELETE FROM minute_counts WHERE kind=?", [kind]
+        if student is not None:
+            sql += " AND student=?"
+            args.append(student.strip().lower())
+        con = self._db()
+        try:
+            con.execute(sql, args)
+            con.commit()
+        finally:
+            con.close()
+
+    def is_empty(self):
+        con = self._db()
+        try:
+            return con.execute("SELECT 1 FROM minute_counts LIMIT 1").fetchone() is None
+        finally:
+            con.close()
+
+    def totals(self, since, kinds=None):
+        """{student: {kind: count}} for buckets from `since`'s minute onwards."""
+        sql = "SELECT student, kind, SUM(n) FROM minute_counts WHERE minute>=?"
+        args = [int(since) // 60]
+        if kinds:
+            kinds = list(kinds)
+            sql += " AND kind IN (%s)" % ",".join("?" * len(kinds))
+            args += kinds
+        con = self._db()
+        try:
+            rows = con.execute(sql + " GROUP BY student, kind", args).fetchall()
+        finally:
+            con.close()
+        out = {}
+        for student, kind, n in rows:
+            out.setdefault(student, {})[kind] = n
+        return out
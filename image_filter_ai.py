@@ -19,6 +19,11 @@ Returns a dict:
         "self_harm": float 0–1,
         "other": float 0–1,
     }
+
+Decoding is bounded: payloads above MAX_IMAGE_BYTES or headers declaring
+more than MAX_IMAGE_PIXELS are rejected before any pixel data is read, and
+JPEGs are decoded directly at reduced scale. Rejected images are scored
+on URL keywords only, exactly like images we cannot read at all.
 """
 
 from __future__ import annotations
@@ -26,14 +31,36 @@ from __future__ import annotations
 import base64
 import io
 import math
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from typing import Dict
+from urllib.parse import urlsplit, urlunsplit
 
 try:
-    from PIL import Image
+    from PIL import Image, ImageChops
 except Exception:  # Pillow not installed – classifier will fall back to URL heuristics only
     Image = None
+    ImageChops = None
+
+try:
+    import numpy as np
+except Exception:  # NumPy is optional – _skin_ratio falls back to Pillow band ops
+    np = None
 
 
+# Decode budget. Thumbnails from the extension are a few KB; anything far
+# beyond that is either a bug or a page trying to make us burn CPU.
+MAX_IMAGE_BYTES = int(os.environ.get("IMAGE_FILTER_MAX_BYTES", 1024 * 1024))
+MAX_IMAGE_PIXELS = int(os.environ.get("IMAGE_FILTER_MAX_PIXELS", 2048 * 2048))
+DECODE_MAX_SIDE = 256  # same as the _skin_ratio downsample target
+DECODE_FORMATS = ("JPEG", "PNG", "GIF", "WEBP", "BMP")
+
 LABELS = [
     "explicit_nudity",
     "partial_nudity",
@@ -69,25 +96,55 @@ SELF_HARM_KEYWORDS = [
 def _from_data_url(data_url: str) -> bytes | None:
     if not data_url:
         return None
-    if "," not in data_url:
-        # assume just base64
-        try:
-            return base64.b64decode(data_url)
-        except Exception:
-            return None
+    b64 = data_url.split(",", 1)[1] if "," in data_url else data_url  # assume just base64
+    # Every 4 base64 chars decode to 3 bytes; refuse before allocating.
+    if len(b64) // 4 * 3 > MAX_IMAGE_BYTES:
+        return None
     try:
-        header, b64 = data_url.split(",", 1)
         return base64.b64decode(b64)
     except Exception:
         return None
 
 
+def _decode_image(img_bytes: bytes) -> "Image.Image | None":
+    """
+    Open image bytes with a fixed worst-case cost.
+
+    Image.open() only parses the header, so the byte and pixel budgets
+    are checked before any pixel data is decompressed. JPEGs use draft()
+    to let libjpeg decode straight at 1/2, 1/4 or 1/8 scale. Returns None
+    when the image is over budget or unreadable.
+    """
+    if Image is None or not img_bytes or len(img_bytes) > MAX_IMAGE_BYTES:
+        return None
+    try:
+        img = Image.open(io.BytesIO(img_bytes), formats=DECODE_FORMATS)
+        w, h = img.size
+        if w <= 0 or h <= 0 or w * h > MAX_IMAGE_PIXELS:
+            return None
+        if img.format == "JPEG":
+            img.draft("RGB", (DECODE_MAX_SIDE, DECODE_MAX_SIDE))
+        img.load()
+        return img
+    except Exception:
+        return None
+
+
 def _skin_ratio(img: "Image.Image") -> float:
     """
     Very rough skin detector, based on RGB rules-of-thumb.
 
     This is NOT perfect, but it can help flag images with a very high
     proportion of skin-tone pixels as potentially explicit.
+
+    A pixel counts as skin when:
+        r > 95 and g > 40 and b > 20
+        and max(r, g, b) - min(r, g, b) > 15
+        and abs(r - g) > 15 and r > g and r > b
+
+    The rule is evaluated over whole bands at once (NumPy masks, or
+    Pillow point/ImageChops ops when NumPy is missing) instead of
+    walking pixels in Python.
     """
     if img.mode not in ("RGB", "RGBA"):
         img = img.convert("RGB")
@@ -101,32 +158,45 @@ def _skin_ratio(img: "Image.Image") -> float:
         img = img.resize((int(w * scale), int(h * scale)))
         w, h = img.size
 
-    pixels = img.load()
-    if pixels is None:
-        return 0.0
-
-    total = 0
-    skin = 0
-    for y in range(h):
-        for x in range(w):
-            r, g, b = pixels[x, y][:3]
-            total += 1
-            # Very simple RGB skin detection heuristic
-            if (
-                r > 95
-                and g > 40
-                and b > 20
-                and max(r, g, b) - min(r, g, b) > 15
-                and abs(r - g) > 15
-                and r > g
-                and r > b
-            ):
-                skin += 1
+    total = w * h
     if total == 0:
         return 0.0
+
+    if np is not None:
+        skin = _skin_count_numpy(img)
+    else:
+        skin = _skin_count_bands(img)
     return float(skin) / float(total)
 
 
+def _skin_count_numpy(img: "Image.Image") -> int:
+    # int16 so that differences between channels cannot wrap around.
+    px = np.asarray(img, dtype=np.int16)
+    r = px[..., 0]
+    g = px[..., 1]
+    b = px[..., 2]
+    # With r > g and r > b, max(r, g, b) is r, and r - min(g, b) >= r - g,
+    # so "abs(r - g) > 15 and r > g" already implies the max-min spread.
+    mask = (r > 95) & (g > 40) & (b > 20) & (r - g > 15) & (r > b)
+    return int(np.count_nonzero(mask))
+
+
+def _skin_count_bands(img: "Image.Image") -> int:
+    r, g, b = img.split()[:3]
+    masks = [
+        r.point(lambda v: 255 if v > 95 else 0),
+        g.point(lambda v: 255 if v > 40 else 0),
+        b.point(lambda v: 255 if v > 20 else 0),
+        # subtract() clips at 0, so these are r - g > 15 and r - b > 0
+        ImageChops.subtract(r, g).point(lambda v: 255 if v > 15 else 0),
+        ImageChops.subtract(r, b).point(lambda v: 255 if v > 0 else 0),
+    ]
+    mask = masks[0]
+    for m in masks[1:]:
+        mask = ImageChops.darker(mask, m)  # per-pixel AND of 0/255 masks
+    return mask.histogram()[255]
+
+
 def _keyword_boost(text: str) -> Dict[str, float]:
     text = (text or "").lower()
     scores = {k: 0.0 for k in LABELS}
@@ -148,11 +218,114 @@ def _keyword_boost(text: str) -> Dict[str, float]:
     return scores
 
 
+def decode_thumbnail(image_bytes_or_data_url: bytes | str | None) -> "Image.Image | None":
+    """Decode a thumbnail (raw bytes or data URL) within the decode budget."""
+    if isinstance(image_bytes_or_data_url, str):
+        img_bytes = _from_data_url(image_bytes_or_data_url)
+    else:
+        img_bytes = image_bytes_or_data_url
+    return _decode_image(img_bytes) if img_bytes else None
+
+
+def perceptual_hash(img: "Image.Image") -> str:
+    """
+    64-bit difference hash (dHash) plus a coarse average colour.
+
+    dHash alone only sees gradients, so a flat skin-coloured image and a
+    flat white one would collide; the 4-bit-per-channel mean colour keeps
+    them apart while still matching re-encoded or resized copies.
+    """
+    small = img.convert("RGB").resize((9, 8))
+    px = list(small.convert("L").getdata())
+    bits = 0
+    for y in range(8):
+        row = px[y * 9:(y + 1) * 9]
+        for x in range(8):
+            bits = (bits << 1) | (1 if row[x] > row[x + 1] else 0)
+    r, g, b = small.resize((1, 1)).getpixel((0, 0))
+    return "%016x-%x%x%x" % (bits, r >> 4, g >> 4, b >> 4)
+
+
+def normalize_src(src: str) -> str:
+    """
+    Canonical form of an image URL for cache keys, or "" if it should
+    not be cached (data:/blob: URLs, non-http schemes, absurd lengths).
+    """
+    src = (src or "").strip()
+    if not src or len(src) > 2048:
+        return ""
+    try:
+        parts = urlsplit(src)
+    except ValueError:
+        return ""
+    if parts.scheme.lower() not in ("http", "https"):
+        return ""
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or "/", parts.query, ""))
+
+
+class VerdictCache:
+    """
+    Thread-safe LRU of image filter verdicts.
+
+    One verdict can be stored under several keys (normalized src URL,
+    perceptual hash). Every entry belongs to a single config version:
+    looking up or storing with a different version drops the whole cache,
+    so changing block_threshold or mode never serves a stale verdict.
+    """
+
+    def __init__(self, max_entries: int = 5000):
+        self.max_entries = max(1, int(max_entries))
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[str, dict]" = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _sync_version(self, version) -> None:
+        if version != self._version:
+            self._items.clear()
+            self._version = version
+
+    def get(self, version, key: str) -> dict | None:
+        if not key:
+            return None
+        with self._lock:
+            self._sync_version(version)
+            verdict = self._items.get(key)
+            if verdict is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return verdict
+
+    def put(self, version, keys, verdict: dict) -> None:
+        with self._lock:
+            self._sync_version(version)
+            for key in keys:
+                if not key:
+                    continue
+                self._items[key] = verdict
+                self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._items),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
 def classify_image(
     image_bytes_or_data_url: bytes | str | None,
     *,
     src: str = "",
     page_url: str = "",
+    image: "Image.Image | None" = None,
 ) -> Dict[str, float]:
     """
     Classify an image into coarse safety categories.
@@ -161,6 +334,9 @@ def classify_image(
     over-block when there is a high skin ratio or strong NSFW keywords
     in the URL. For production you can replace the internals with a
     stronger model while keeping the same interface.
+
+    Pass `image` when the caller already decoded the thumbnail (e.g. to
+    hash it) so the pixels are not decoded twice.
     """
     scores = {k: 0.0 for k in LABELS}
 
@@ -170,15 +346,9 @@ def classify_image(
         scores[k] = max(scores[k], v)
 
     # Pixel-based heuristic (if Pillow available and we have bytes)
-    img_bytes: bytes | None
-    if isinstance(image_bytes_or_data_url, str):
-        img_bytes = _from_data_url(image_bytes_or_data_url)
-    else:
-        img_bytes = image_bytes_or_data_url
-
-    if Image is not None and img_bytes:
+    img = image if image is not None else decode_thumbnail(image_bytes_or_data_url)
+    if img is not None:
         try:
-            img = Image.open(io.BytesIO(img_bytes))
             sr = _skin_ratio(img)
             # Tune thresholds: high skin ratio => likely explicit
             if sr > 0.5:
@@ -207,3 +377,142 @@ def classify_image(
         scores[k] = float(v)
 
     return scores
+
+
+def analyze_thumbnail(thumbnail: bytes | str | None, src: str = "") -> dict:
+    """
+    Everything that needs the pixels, in one call: decode, fingerprint
+    and score. Top-level (picklable) so it can run in a worker process.
+    "scores" come from the pixels alone, so they can be shared by every
+    copy of the picture; the src URL's keyword hints are kept apart in
+    "src_scores". page_url hints are left to the caller because they are
+    per page.
+    """
+    img = decode_thumbnail(thumbnail) if thumbnail else None
+    return {
+        "scores": classify_image(None, image=img),
+        "src_scores": classify_image(None, src=src),
+        "phash": perceptual_hash(img) if img is not None else "",
+        "pixels": img is not None,
+    }
+
+
+def analyze_batch(items) -> list:
+    """analyze_thumbnail over a list of (thumbnail, src) pairs."""
+    return [analyze_thumbnail(thumbnail, src) for thumbnail, src in items]
+
+
+class ImageBatcher:
+    """
+    Runs analyze_thumbnail in a process pool so pixel work is not bound
+    by the GIL of the web process.
+
+    submit() is for one-off requests: items queued within `window`
+    seconds of each other (up to `max_batch`) travel to a worker as one
+    task, so a burst of single-image requests costs a few IPC round trips
+    instead of one each. map() is for callers that already hold a batch
+    and splits it across all workers immediately.
+
+    With workers=0 everything runs inline in the calling thread.
+
+    Workers are spawned, not forked: the pool is created lazily from a
+    request thread while other threads (Socket.IO, backplane listener,
+    janitor, thumbnails) may hold locks a forked child would inherit
+    locked. A spawned child re-imports the entry script as "__mp_main__",
+    so that script must keep its server startup behind a check of __name__.
+    """
+
+    def __init__(self, workers: int | None = None, window: float = 0.01, max_batch: int = 32):
+        self.workers = (os.cpu_count() or 1) if workers is None else max(0, int(workers))
+        self.window = max(0.0, float(window))
+        self.max_batch = max(1, int(max_batch))
+        self._queue: "queue.Queue" = queue.Queue()
+        self._pool: ProcessPoolExecutor | None = None
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._collect, name="image-batcher", daemon=True)
+                self._thread.start()
+            return self._pool
+
+    def _reset_pool(self, broken: ProcessPoolExecutor) -> None:
+        # A worker died (OOM, segfault in a codec); start a fresh pool.
+        with self._lock:
+            if self._pool is broken:
+                self._pool = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, items) -> Future:
+        pool = self._get_pool()
+        try:
+            return pool.submit(analyze_batch, items)
+        except BrokenProcessPool:
+            self._reset_pool(pool)
+            return self._get_pool().submit(analyze_batch, items)
+
+    def submit(self, thumbnail: bytes | str | None, src: str = "") -> Future:
+        fut: Future = Future()
+        if self.workers == 0:
+            try:
+                fut.set_result(analyze_thumbnail(thumbnail, src))
+            except Exception as e:
+                fut.set_exception(e)
+            return fut
+        self._get_pool()
+        self._queue.put(((thumbnail, src), fut))
+        return fut
+
+    def map(self, items, timeout: float | None = None) -> list:
+        items = list(items)
+        if not items:
+            return []
+        if self.workers == 0:
+            return analyze_batch(items)
+        size = -(-len(items) // self.workers)  # ceil: one chunk per worker
+        tasks = [self._run(items[i:i + size]) for i in range(0, len(items), size)]
+        out = []
+        for task in tasks:
+            out.extend(task.result(timeout=timeout))
+        return out
+
+    def _collect(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._dispatch(batch)
+
+    def _dispatch(self, batch) -> None:
+        futures = [fut for _, fut in batch]
+        try:
+            task = self._run([item for item, _ in batch])
+        except Exception as e:
+            for fut in futures:
+                fut.set_exception(e)
+            return
+
+        def _done(task: Future) -> None:
+            try:
+                results = task.result()
+            except Exception as e:
+                for fut in futures:
+                    fut.set_exception(e)
+                return
+            for fut, result in zip(futures, results):
+                fut.set_result(result)
+
+        task.add_done_callback(_done)
@@ -0,0 +1,99 @@
+"""
+janitor.py
+Background expiry of everything that grows with use.
+
+Each collection is registered once with its retention policy -- a maximum
+age in seconds and/or a maximum number of entries, None meaning no limit
+-- and a sweep function that applies it:
+
+    JANITOR = Janitor(BACKPLANE, interval=60)
+    JANITOR.register("gprotect.logs", sweep_logs, max_age=30 * 86400, max_count=5000)
+    JANITOR.start()
+
+sweep(policy, now) removes at most one bounded batch and returns how many
+entries it dropped; collections keyed per student keep their own cursor
+so a large one is worked through over several ticks. The thread runs one
+collection per tick, round robin, so no single pass holds up requests.
+With several workers, a tick is skipped while another worker's janitor
+holds the backplane lock.
+"""
+
+import threading
+import time
+from collections import namedtuple
+
+from backplane import LocalBackplane, LockTimeout
+
+Retention = namedtuple("Retention", "max_age max_count")
+
+
+class Janitor:
+    def __init__(self, backplane=None, interval=60, name="janitor"):
+        self._bp = backplane or LocalBackplane()
+        self.interval = float(interval)
+        self.name = name
+        self._sweeps = {}  # name -> (Retention, sweep)
+        self._order = []
+        self._next = 0
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def register(self, name, sweep, max_age=None, max_count=None):
+        with self._lock:
+            if name not in self._sweeps:
+                self._order.append(name)
+            self._sweeps[name] = (Retention(max_age, max_count), sweep)
+            self._stats.setdefault(name, {"runs": 0, "removed": 0, "errors": 0, "last_run": None, "last_ms": 0.0})
+
+    def policies(self):
+        return {name: dict(self._sweeps[name][0]._asdict()) for name in self._order}
+
+    # ---------- running ----------
+    def run_once(self, name=None):
+        """Sweep `name` (or the next collection in turn); returns the number removed."""
+        with self._lock:
+            if not self._order:
+                return 0
+            if name is None:
+                name = self._order[self._next % len(self._order)]
+                self._next += 1
+            policy, sweep = self._sweeps[name]
+        t0 = time.monotonic()
+        removed, failed = 0, False
+        try:
+            removed = sweep(policy, int(time.time())) or 0
+        except Exception as e:
+            failed = True
+            print("[WARN] janitor sweep failed:", name, e)
+        with self._lock:
+            s = self._stats[name]
+            s["runs"] += 1
+            s["removed"] += removed
+            s["errors"] += failed
+            s["last_run"] = int(time.time())
+            s["last_ms"] = round((time.monotonic() - t0) * 1000.0, 3)
+        return removed
+
+    def tick(self):
+        try:
+            with self._bp.lock(self.name, timeout=0, ttl=max(60, self.interval * 2)):
+                return self.run_once()
+        except LockTimeout:
+            return 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None or self.interval <= 0:
+                return
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.tick()
+
+    def stats(self):
+        with self._lock:
+            return {name: dict(self._stats[name], **self._sweeps[name][0]._asdict()) for name in self._order}
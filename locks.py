@@ -0,0 +1,100 @@
+"""
+locks.py
+Named locks around read-modify-write of shared state, with wait metrics.
+
+Lock names are "<section>:<entity>" ("student:a@b.org", "class:period1",
+"data.json"); holding one keeps every other thread and -- through the
+backplane -- every other worker out of that entity until released:
+
+    LOCKS = LockManager(BACKPLANE)
+    with LOCKS.hold("student:a@b.org"):
+        d = load_data()
+        ...
+        save_data(d)
+
+hold() takes several names in sorted order, so two requests locking the
+same pair cannot deadlock, and is re-entrant per thread: names this thread
+already holds are skipped. Wait and hold times are aggregated per section
+for stats().
+"""
+
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from backplane import LockTimeout
+
+
+class LockManager:
+    def __init__(self, backplane, timeout=10, ttl=30):
+        self._bp = backplane
+        self.timeout = timeout
+        self.ttl = ttl
+        self._held = threading.local()
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def _record(self, name, waited=None, held=None, timed_out=False):
+        section = name.split(":", 1)[0]
+        with self._stats_lock:
+            s = self._stats.get(section)
+            if s is None:
+                s = self._stats[section] = {
+                    "acquired": 0, "contended": 0, "timeouts": 0,
+                    "wait_total_ms": 0.0, "wait_max_ms": 0.0, "hold_max_ms": 0.0,
+                }
+            if timed_out:
+                s["timeouts"] += 1
+            if waited is not None:
+                ms = waited * 1000.0
+                s["acquired"] += 1
+                s["wait_total_ms"] += ms
+                s["wait_max_ms"] = max(s["wait_max_ms"], ms)
+                if ms >= 1.0:
+                    s["contended"] += 1
+            if held is not None:
+                s["hold_max_ms"] = max(s["hold_max_ms"], held * 1000.0)
+
+    @contextmanager
+    def _one(self, name):
+        t0 = t1 = time.monotonic()
+        acquired = False
+        try:
+            with self._bp.lock(name, timeout=self.timeout, ttl=self.ttl):
+                acquired = True
+                t1 = time.monotonic()
+                self._record(name, waited=t1 - t0)
+                yield
+        except LockTimeout:
+            if not acquired:
+                self._record(name, timed_out=True)
+            raise
+        finally:
+            if acquired:
+                self._record(name, held=time.monotonic() - t1)
+
+    @contextmanager
+    def hold(self, *names):
+        """Hold every lock in `names` (falsy names are ignored) for the block."""
+        held = getattr(self._held, "names", None)
+        if held is None:
+            held = self._held.names = set()
+        todo = sorted({n for n in names if n} - held)
+        with ExitStack() as stack:
+            for name in todo:
+                stack.enter_context(self._one(name))
+                held.add(name)
+                stack.callback(held.discard, name)
+            yield
+
+    def stats(self):
+        """Per-section counters; times in milliseconds."""
+        with self._stats_lock:
+            out = {}
+            for section, s in self._stats.items():
+                s = dict(s)
+                s["wait_avg_ms"] = round(s["wait_total_ms"] / s["acquired"], 3) if s["acquired"] else 0.0
+                for k in ("wait_total_ms", "wait_max_ms", "hold_max_ms"):
+                    s[k] = round(s[k], 3)
+                out[section] = s
+            return out
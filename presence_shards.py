@@ -0,0 +1,122 @@
+"""
+presence_shards.py
+Live presence partitioned by active class.
+
+data.json keeps one presence entry per student for the whole district;
+the teacher grid only ever wants the students of one class. This keeps,
+in a backplane (see backplane.py), one shard per *active* class -- its
+roster -- plus a reverse index from student to the active classes they
+are in, and a slim copy of each member's latest presence entry (the grid
+fields, without the screenshot payloads, which stay in data.json):
+
+    SHARDS = PresenceShards(BACKPLANE)
+    SHARDS.sync("period1", ["a@b.org", "c@d.org"])   # class started / roster edited
+    SHARDS.put("a@b.org", pres)                       # heartbeat -> ["period1"]
+    SHARDS.view("period1")                            # -> {"a@b.org": pres}
+    SHARDS.sync("period1", None)                      # class ended
+
+A class view reads its roster and one entry per member, so it costs
+O(class size) whatever the number of students elsewhere. Inactive classes
+have no shard, and a student in no active class has no index entry and no
+copy, so heartbeats from them cost a single key lookup. Heartbeats do not
+take the shard lock either: put() writes the entry and then re-checks
+membership, undoing the write if sync() dropped the student meanwhile.
+"""
+
+from backplane import LocalBackplane
+
+
+def _norm(s):
+    return str(s or "").strip().lower()
+
+
+class PresenceShards:
+    CLASS = "presence:class:"      # cid -> sorted roster (active classes only)
+    MEMBER = "presence:member:"    # student -> [cid, ...] active classes they are in
+    ENTRY = "presence:entry:"      # student -> latest presence entry
+    LOCK = "presence:shards"
+    IMAGE_FIELDS = ("screenshot", "tabshots")
+
+    def __init__(self, backplane=None):
+        self._bp = backplane or LocalBackplane()
+
+    @classmethod
+    def slim(cls, pres):
+        """The shard's copy of a presence entry: image payloads replaced by
+        `shots`, which only says which of them exist."""
+        out = {k: v for k, v in pres.items() if k not in cls.IMAGE_FIELDS}
+        out["shots"] = {
+            "screenshot": bool(pres.get("screenshot")),
+            "tabshots": sorted(pres.get("tabshots") or {}),
+        }
+        return out
+
+    # ---------- membership ----------
+    def sync(self, cid, students, entries=None):
+        """Make class `cid`'s shard hold `students`; None drops the shard.
+
+        Students joining get their entry copied from `entries` (the
+        data.json presence map) unless a newer heartbeat already put one.
+        """
+        new = None if students is None else sorted({_norm(s) for s in students if _norm(s)})
+        with self._bp.lock(self.LOCK):
+            old = self._bp.get(self.CLASS + cid)
+            if old is None and new is None:
+                return
+            old_set, new_set = set(old or []), set(new or [])
+            for s in old_set - new_set:
+                cids = [c for c in self._bp.get(self.MEMBER + s) or [] if c != cid]
+                if cids:
+                    self._bp.set(self.MEMBER + s, cids)
+                else:
+                    self._bp.delete(self.MEMBER + s)
+                    self._bp.delete(self.ENTRY + s)
+            for s in new_set - old_set:
+                cids = self._bp.get(self.MEMBER + s) or []
+                if cid not in cids:
+                    self._bp.set(self.MEMBER + s, cids + [cid])
+                entry = (entries or {}).get(s)
+                if isinstance(entry, dict) and self._bp.get(self.ENTRY + s) is None:
+                    self._bp.set(self.ENTRY + s, self.slim(entry))
+            if new is None:
+                self._bp.delete(self.CLASS + cid)
+            elif new != old:
+                self._bp.set(self.CLASS + cid, new)
+
+    def members(self, cid):
+        """Roster of an active class's shard, or None if it has none."""
+        return self._bp.get(self.CLASS + cid)
+
+    def classes_of(self, student):
+        """Active class ids the student is in."""
+        return list(self._bp.get(self.MEMBER + _norm(student)) or [])
+
+    # ---------- entries ----------
+    def put(self, student, pres):
+        """Store a heartbeat's presence entry; returns the student's active class ids."""
+        student = _norm(student)
+        cids = self.classes_of(student)
+        if cids:
+            self._bp.set(self.ENTRY + student, self.slim(pres))
+            # sync() (under LOCK) may have dropped the student between the
+            # check and the write; don't leave an entry it already removed.
+            cids = self.classes_of(student)
+            if not cids:
+                self._bp.delete(self.ENTRY + student)
+        return cids
+
+    def drop(self, student):
+        """Forget a student's entry (their presence expired); membership stays."""
+        self._bp.delete(self.ENTRY + _norm(student))
+
+    def get(self, student):
+        return self._bp.get(self.ENTRY + _norm(student))
+
+    def view(self, cid):
+        """{student: entry} for the members of class `cid` that have one."""
+        out = {}
+        for s in self.members(cid) or []:
+            entry = self._bp.get(self.ENTRY + s)
+            if entry is not None:
+                out[s] = entry
+        return out
@@ -0,0 +1,209 @@
+"""
+present_registry.py
+Bounded store for presentation (WebRTC) signaling rooms.
+
+A room holds the viewers' offers, the teacher's answers and the trickle
+ICE candidates each side has not fetched yet. Everything here is
+short-lived: once a viewer's peer connection is up it never talks to
+the server again, so viewers that have been quiet for `viewer_ttl`
+seconds are dropped, and rooms are dropped after `idle_ttl` seconds
+without activity (`active_ttl` while the teacher is presenting).
+
+Rooms live in a backplane (see backplane.py), one key per room, so a
+viewer's offer posted to one worker is visible to the teacher polling
+another. Without one, an in-process LocalBackplane is used.
+
+Reads never create rooms; only a teacher starting or a viewer posting an
+offer does. Sizes are capped per client, per room and overall, so a
+long-running server keeps a flat footprint no matter what clients send:
+
+    reg = PresentRegistry()
+    reg.start("room1")
+    reg.add_offer("room1", "c1", sdp)
+    reg.offers("room1")   # -> {"c1": sdp}
+"""
+
+import time
+from contextlib import contextmanager
+
+from backplane import LocalBackplane
+
+
+class RoomFull(Exception):
+    """Raised when a room or the registry is at capacity."""
+
+
+class PresentRegistry:
+    PREFIX = "present:room:"
+    LOCK = "present:registry"  # serializes room creation against max_rooms
+
+    def __init__(self, idle_ttl=900, active_ttl=4 * 3600, viewer_ttl=120,
+                 max_rooms=500, max_viewers=200, max_candidates=64,
+                 backplane=None):
+        self.idle_ttl = idle_ttl
+        self.active_ttl = active_ttl
+        self.viewer_ttl = viewer_ttl
+        self.max_rooms = max_rooms
+        self.max_viewers = max_viewers
+        self.max_candidates = max_candidates
+        self._bp = backplane or LocalBackplane()
+
+    # ---------- internals ----------
+    @staticmethod
+    def _new_room(now):
+        return {"active": False, "created": now, "updated": now, "viewers": {}}
+
+    def _load(self, name):
+        room = self._bp.get(self.PREFIX + name)
+        if room is not None:
+            now = time.time()
+            viewers = room["viewers"]
+            for cid in [c for c, v in viewers.items() if now - v["seen"] > self.viewer_ttl]:
+                del viewers[cid]
+        return room
+
+    def _names(self):
+        n = len(self.PREFIX)
+        return [k[n:] for k in self._bp.keys(self.PREFIX)]
+
+    def _make_space(self):
+        names = self._names()
+        if len(names) < self.max_rooms:
+            return
+        # Make room by dropping the least recently used inactive room.
+        idle = []
+        for n in names:
+            r = self._bp.get(self.PREFIX + n)
+            if r is not None and not r["active"]:
+                idle.append((r["updated"], n))
+        if not idle:
+            raise RoomFull("too many rooms")
+        self._bp.delete(self.PREFIX + min(idle)[1])
+
+    @contextmanager
+    def _room(self, name, create=False):
+        """Load a room under its lock and store it back (touched) afterwards.
+
+        Yields None for an unknown room unless `create` is set. The room
+        expires from the backplane `idle_ttl`/`active_ttl` after the last
+        time it was stored.
+        """
+        key = self.PREFIX + name
+        with self._bp.lock(key, timeout=5):
+            room = self._load(name)
+            if room is None and create:
+                # Count and claim the slot in one step, so concurrent
+                # creates cannot both get past max_rooms.
+                with self._bp.lock(self.LOCK, timeout=5):
+                    self._make_space()
+                    room = self._new_room(time.time())
+                    self._bp.set(key, room, ttl=self.idle_ttl)
+            yield room
+            if room is not None:
+                room["updated"] = time.time()
+                self._bp.set(key, room, ttl=self.active_ttl if room["active"] else self.idle_ttl)
+
+    def _viewer(self, room, client_id, create=False):
+        viewers = room["viewers"]
+        v = viewers.get(client_id)
+        if v is None:
+            if not create:
+                return None
+            if len(viewers) >= self.max_viewers:
+                raise RoomFull("room is full")
+            v = viewers[client_id] = {"offer": None, "answer": None, "cand_v": [], "cand_t": []}
+        v["seen"] = time.time()
+        return v
+
+    # ---------- room lifecycle ----------
+    def start(self, name):
+        with self._room(name, create=True) as room:
+            room["active"] = True
+
+    def end(self, name):
+        """Forget a room and all of its viewers."""
+        self._bp.delete(self.PREFIX + name)
+
+    def is_active(self, name):
+        room = self._bp.get(self.PREFIX + name)
+        return bool(room and room["active"])
+
+    # ---------- offers / answers ----------
+    def add_offer(self, name, client_id, sdp):
+        with self._room(name, create=True) as room:
+            v = self._viewer(room, client_id, create=True)
+            v["offer"] = sdp
+            v["answer"] = None
+
+    def offers(self, name):
+        """Offers still waiting for an answer, by client_id."""
+        room = self._load(name)
+        if room is None:
+            return {}
+        return {cid: v["offer"] for cid, v in room["viewers"].items() if v["offer"] is not None}
+
+    def set_answer(self, name, client_id, sdp):
+        """Store the teacher's answer; False if the viewer is gone."""
+        with self._room(name) as room:
+            v = room["viewers"].get(client_id) if room else None
+            if v is None:
+                return False
+            v["answer"] = sdp
+            v["offer"] = None
+            return True
+
+    def answer(self, name, client_id):
+        with self._room(name) as room:
+            v = self._viewer(room, client_id) if room else None
+            return v["answer"] if v else None
+
+    # ---------- ICE ----------
+    def add_candidates(self, name, side, client_id, candidates):
+        """Queue candidates from `side` ("viewer"/"teacher"); returns those accepted.
+
+        Past `max_candidates` per client and direction the rest are dropped;
+        the first candidates gathered are the useful ones.
+        """
+        with self._room(name, create=(side == "viewer")) as room:
+            v = self._viewer(room, client_id, create=(side == "viewer")) if room else None
+            if v is None:
+                return []
+            bucket = v["cand_v"] if side == "viewer" else v["cand_t"]
+            accepted = list(candidates)[:max(0, self.max_candidates - len(bucket))]
+            bucket.extend(accepted)
+            return accepted
+
+    def take_candidates(self, name, side, client_id):
+        """Fetch and clear the candidates addressed to `side`."""
+        with self._room(name) as room:
+            v = self._viewer(room, client_id) if room else None
+            if v is None:
+                return []
+            key = "cand_t" if side == "viewer" else "cand_v"
+            out, v[key] = v[key], []
+            return out
+
+    # ---------- diagnostics ----------
+    def _room_stats(self, room):
+        viewers = room["viewers"]
+        return {
+            "active": room["active"],
+            "idle_seconds": int(time.time() - room["updated"]),
+            "viewers": len(viewers),
+            "offers": sum(1 for v in viewers.values() if v["offer"] is not None),
+            "answers": sum(1 for v in viewers.values() if v["answer"] is not None),
+            "cand_v": {cid: len(v["cand_v"]) for cid, v in viewers.items() if v["cand_v"]},
+            "cand_t": {cid: len(v["cand_t"]) for cid, v in viewers.items() if v["cand_t"]},
+        }
+
+    def stats(self, name=None):
+        """Stats for one room (None if unknown) or, without a name, for all rooms."""
+        if name is not None:
+            room = self._load(name)
+            return self._room_stats(room) if room else None
+        rooms = {}
+        for n in self._names():
+            room = self._load(n)
+            if room is not None:
+                rooms[n] = self._room_stats(room)
+        return {"rooms": len(rooms), "max_rooms": self.max_rooms, "by_room": rooms}
@@ -0,0 +1,223 @@
+"""
+realtime.py
+In-process publish/subscribe hub for pushing typed events to dashboards.
+
+Writers publish to a channel (e.g. "class:period1"); each open stream
+holds a Subscription with its own bounded queue, so a slow or stalled
+reader never blocks the request that published:
+
+    HUB = EventHub()
+    sub = HUB.subscribe("class:period1")
+    HUB.publish("class:period1", "hand", {"student": "a@b.org"})
+    ev = sub.get(timeout=15)      # -> {"id": 1, "type": "hand", "data": {...}}
+    HUB.unsubscribe(sub)
+
+Publishing to a channel nobody listens on is a dict lookup, so call
+sites can publish unconditionally. If a subscriber falls `backlog`
+events behind, its queue is flushed and it receives a single "resync"
+event instead, telling the client to refetch full state.
+
+Waiters backs long-poll endpoints: a request reads a key's version,
+checks for work, and if there is none blocks until the version moves
+or its timeout runs out. Blocked requests sit on a condition variable
+(a green one under eventlet), so they cost nothing until notified.
+
+Both take an optional backplane (see backplane.py). With one, events
+and notifications published in any worker process reach subscribers
+and waiters in every worker, and Waiters keep their versions in the
+backplane so all workers agree on them.
+"""
+
+import itertools
+import json
+import queue
+import threading
+import time
+from collections import defaultdict
+
+
+class Subscription:
+    def __init__(self, channels, backlog):
+        self.channels = tuple(channels)
+        self._q = queue.Queue(maxsize=backlog)
+        self._overflow = False
+        self._lock = threading.Lock()
+
+    def _offer(self, event):
+        with self._lock:
+            if self._overflow:
+                return
+            try:
+                self._q.put_nowait(event)
+            except queue.Full:
+                # Reader is too far behind to catch up event by event.
+                self._overflow = True
+                while True:
+                    try:
+                        self._q.get_nowait()
+                    except queue.Empty:
+                        break
+                self._q.put_nowait({"id": event["id"], "type": "resync", "data": {}})
+
+    def get(self, timeout=None):
+        """Next event, or None if nothing arrived within `timeout` seconds."""
+        try:
+            event = self._q.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if event["type"] == "resync":
+            with self._lock:
+                self._overflow = False
+        return event
+
+
+class EventHub:
+    def __init__(self, backlog=256, backplane=None, name="hub"):
+        self.backlog = backlog
+        self._subs = defaultdict(set)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._bp = backplane
+        self._channel = name
+        if backplane is not None:
+            backplane.subscribe(name, self._on_message)
+
+    def subscribe(self, *channels):
+        sub = Subscription(channels, self.backlog)
+        with self._lock:
+            for ch in channels:
+                self._subs[ch].add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            for ch in sub.channels:
+                subs = self._subs.get(ch)
+                if subs is None:
+                    continue
+                subs.discard(sub)
+                if not subs:
+                    del self._subs[ch]
+
+    def has_subscribers(self, channel=None):
+        """True if anyone listens on `channel` (or on any channel if None).
+
+        Subscribers in other workers cannot be counted cheaply, so with a
+        shared backplane this is always True.
+        """
+        if self._bp is not None and not self._bp.local:
+            return True
+        with self._lock:
+            if channel is None:
+                return bool(self._subs)
+            return channel in self._subs
+
+    def publish(self, channel, type, data=None):
+        """Queue an event for every subscriber of `channel`.
+
+        Returns how many subscribers in this process received it; with a
+        backplane the event is forwarded to every worker instead and the
+        local count is not known here, so the result is None.
+        """
+        if self._bp is not None:
+            self._bp.publish(self._channel, {"channel": channel, "type": type, "data": data or {}})
+            return None
+        return self._publish_local(channel, type, data)
+
+    def _on_message(self, msg):
+        self._publish_local(msg["channel"], msg["type"], msg.get("data"))
+
+    def _publish_local(self, channel, type, data=None):
+        with self._lock:
+            subs = list(self._subs.get(channel, ()))
+            if not subs:
+                return 0
+            event = {"id": next(self._ids), "type": type, "data": data or {}}
+        for sub in subs:
+            sub._offer(event)
+        return len(subs)
+
+    def stats(self):
+        with self._lock:
+            return {ch: len(subs) for ch, subs in self._subs.items()}
+
+
+def sse_format(event):
+    """Serialize an event as a text/event-stream frame."""
+    data = json.dumps(event.get("data") or {}, separators=(",", ":"))
+    return "id: %s\nevent: %s\ndata: %s\n\n" % (event.get("id", ""), event["type"], data)
+
+
+class Waiters:
+    """Per-key version counters that long-poll requests can block on.
+
+    notify("*") moves every key's version and wakes all waiters.
+    Versions are only compared for equality, so a client that presents a
+    version from before a restart simply gets an immediate answer.
+    """
+
+    def __init__(self, backplane=None, name="waiters"):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._conds = {}  # key -> [Condition, number of waiters]
+        self._bp = backplane
+        self._name = name
+        if backplane is not None:
+            backplane.subscribe(name, self._wake)
+
+    def _count(self, key):
+        if self._bp is not None:
+            return self._bp.get("%s:%s" % (self._name, key), 0)
+        return self._versions.get(key, 0)
+
+    def _version_locked(self, key):
+        return self._count(key) + self._count("*")
+
+    def version(self, key):
+        with self._lock:
+            return self._version_locked(key)
+
+    def notify(self, key):
+        if self._bp is not None:
+            self._bp.incr("%s:%s" % (self._name, key))
+            self._bp.publish(self._name, key)  # -> _wake() in every worker
+            return
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self._wake_locked(key)
+
+    def _wake(self, key):
+        with self._lock:
+            self._wake_locked(key)
+
+    def _wake_locked(self, key):
+        if key == "*":
+            entries = list(self._conds.values())
+        else:
+            entries = [self._conds[key]] if key in self._conds else []
+        for cond, _ in entries:
+            cond.notify_all()
+
+    def wait(self, key, since, timeout):
+        """Block until version(key) != since or `timeout` seconds pass; returns the version."""
+        deadline = time.monotonic() + max(0.0, timeout)
+        with self._lock:
+            entry = self._conds.get(key)
+            if entry is None:
+                entry = self._conds[key] = [threading.Condition(self._lock), 0]
+            entry[1] += 1
+            try:
+                while self._version_locked(key) == since:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    entry[0].wait(remaining)
+                return self._version_locked(key)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._conds[key]
+
+    def waiting(self):
+        with self._lock:
+            return sum(n for _, n in self._conds.values())
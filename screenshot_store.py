@@ -0,0 +1,243 @@
+"""
+screenshot_store.py
+Screenshot images kept in SQLite instead of inline in data.json.
+
+The screenshot log in data.json only keeps metadata and a `shot_id`; the
+image bytes live here together with a small JPEG thumbnail that a
+background worker renders once, right after ingest:
+
+    SHOTS = ScreenshotStore(DB_PATH)
+    sid = SHOTS.put("a@b.org", "data:image/png;base64,...")
+    SHOTS.thumbs([sid])   # -> {sid: "data:image/jpeg;base64,..."} once rendered
+    SHOTS.get(sid)        # -> ("image/png", b"...")
+
+Only PNG, JPEG and WebP are accepted, and the type is taken from the
+bytes rather than the data URL, so nothing stored here can be served
+back as a page. Without Pillow no thumbnails are made and listings fall back to the
+full image URL.
+"""
+
+import base64
+import io
+import queue
+import sqlite3
+import threading
+import time
+
+try:
+    from PIL import Image
+except Exception:  # Pillow not installed – no thumbnails
+    Image = None
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS screenshot_blobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        student TEXT,
+        ts INTEGER,
+        mime TEXT,
+        data BLOB,
+        thumb BLOB
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_screenshot_blobs_student ON screenshot_blobs(student, ts)",
+]
+
+MAX_SCREENSHOT_BYTES = 8 * 1024 * 1024
+MAX_SCREENSHOT_PIXELS = 4096 * 4096
+
+# The only types stored and served back, with their file extensions.
+# Anything else a client declares (text/html, image/svg+xml, ...) would be
+# rendered as a page on the app's origin.
+IMAGE_TYPES = {"image/png": "png", "image/jpeg": "jpg", "image/webp": "webp"}
+
+
+def parse_data_url(data_url):
+    """(mime, bytes) of a base64 data URL, or None if it is not one."""
+    if not isinstance(data_url, str) or not data_url.startswith("data:"):
+        return None
+    head, _, b64 = data_url.partition(",")
+    if not head.endswith(";base64") or len(b64) // 4 * 3 > MAX_SCREENSHOT_BYTES:
+        return None
+    try:
+        return head[5:-7] or "application/octet-stream", base64.b64decode(b64)
+    except Exception:
+        return None
+
+
+def sniff_image(data):
+    """The IMAGE_TYPES mime `data` starts like, or None."""
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def parse_image_data_url(data_url):
+    """(mime, bytes) of a PNG, JPEG or WebP data URL, or None.
+
+    The declared type must be one of IMAGE_TYPES and the bytes must be
+    one of them too; the returned mime is the one the bytes carry.
+    """
+    parsed = parse_data_url(data_url)
+    if parsed is None:
+        return None
+    mime, data = parsed
+    if mime.split(";")[0].strip().lower() not in IMAGE_TYPES:
+        return None
+    mime = sniff_image(data)
+    return (mime, data) if mime else None
+
+
+class ScreenshotStore:
+    def __init__(self, db_path, thumb_side=160, thumb_quality=60):
+        self.db_path = db_path
+        self.thumb_side = int(thumb_side)
+        self.thumb_quality = int(thumb_quality)
+        self._q = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+        con = self._db()
+        try:
+            for stmt in _SCHEMA:
+                con.execute(stmt)
+            con.commit()
+        finally:
+            con.close()
+
+    def _db(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    # ---------- writes ----------
+    def put(self, student, data_url, ts=None):
+        """Store a data-URL image; returns its id, or None if it is not a PNG/JPEG/WebP data URL."""
+        parsed = parse_image_data_url(data_url)
+        if parsed is None:
+            return None
+        mime, data = parsed
+        con = self._db()
+        try:
+            cur = con.execute(
+                "INSERT INTO screenshot_blobs(student, ts, mime, data) VALUES (?,?,?,?)",
+                (student, int(ts or time.time()), mime, sqlite3.Binary(data)),
+            )
+            con.commit()
+            shot_id = cur.lastrowid
+        finally:
+            con.close()
+        self._enqueue(shot_id)
+        return shot_id
+
+    def delete(self, ids):
+        ids = [int(i) for i in ids if i]
+        if not ids:
+            return
+        con = self._db()
+        try:
+            con.executemany("DELETE FROM screenshot_blobs WHERE id=?", [(i,) for i in ids])
+            con.commit()
+        finally:
+            con.close()
+
+    def expire(self, before_ts, limit=500):
+        """Drop up to `limit` of the oldest images taken before `before_ts`; returns how many."""
+        con = self._db()
+        try:
+            cur = con.execute(
+                "DELETE FROM screenshot_blobs WHERE id IN ("
+                "SELECT id FROM screenshot_blobs WHERE ts<? ORDER BY id LIMIT ?)",
+                (int(before_ts), int(limit)),
+            )
+            con.commit()
+            return cur.rowcount
+        finally:
+            con.close()
+
+    # ---------- reads ----------
+    def get(self, shot_id):
+        """(mime, bytes) of the full image, or None (also for rows that are not an image)."""
+        con = self._db()
+        try:
+            row = con.execute("SELECT data FROM screenshot_blobs WHERE id=?", (int(shot_id),)).fetchone()
+        finally:
+            con.close()
+        if not row:
+            return None
+        data = bytes(row[0])
+        mime = sniff_image(data)
+        return (mime, data) if mime else None
+
+    def thumbs(self, ids):
+        """{id: thumbnail data URL} for the given ids whose thumbnail is ready."""
+        ids = [int(i) for i in ids if i]
+        out = {}
+        con = self._db()
+        try:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                rows = con.execute(
+                    "SELECT id, thumb FROM screenshot_blobs WHERE id IN (%s) AND length(thumb)>0"
+                    % ",".join("?" * len(chunk)), chunk,
+                ).fetchall()
+                for shot_id, thumb in rows:
+                    out[shot_id] = "data:image/jpeg;base64," + base64.b64encode(bytes(thumb)).decode("ascii")
+        finally:
+            con.close()
+        return out
+
+    # ---------- thumbnails ----------
+    def _enqueue(self, shot_id):
+        if Image is None:
+            return
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="screenshot-thumbs", daemon=True)
+                self._worker.start()
+                # Pick up anything left unrendered by a previous process.
+                con = self._db()
+                try:
+                    rows = con.execute("SELECT id FROM screenshot_blobs WHERE thumb IS NULL AND id<>?",
+                                       (shot_id,)).fetchall()
+                finally:
+                    con.close()
+                for (old,) in rows:
+                    self._q.put(old)
+        self._q.put(shot_id)
+
+    def render_thumbnail(self, data):
+        """JPEG thumbnail bytes, or b"" when the image cannot be decoded."""
+        try:
+            img = Image.open(io.BytesIO(data))
+            w, h = img.size
+            if w <= 0 or h <= 0 or w * h > MAX_SCREENSHOT_PIXELS:
+                return b""
+            if img.format == "JPEG":
+                img.draft("RGB", (self.thumb_side, self.thumb_side))
+            img = img.convert("RGB")
+            img.thumbnail((self.thumb_side, self.thumb_side))
+            buf = io.BytesIO()
+            img.save(buf, "JPEG", quality=self.thumb_quality, optimize=True)
+            return buf.getvalue()
+        except Exception:
+            return b""
+
+    def _run(self):
+        while True:
+            shot_id = self._q.get()
+            try:
+                con = self._db()
+                try:
+                    row = con.execute("SELECT data FROM screenshot_blobs WHERE id=? AND thumb IS NULL",
+                                      (shot_id,)).fetchone()
+                    if row is None:
+                        continue
+                    thumb = self.render_thumbnail(bytes(row[0]))
+                    con.execute("UPDATE screenshot_blobs SET thumb=? WHERE id=?", (sqlite3.Binary(thumb), shot_id))
+                    con.commit()
+                finally:
+                    con.close()
+            except Exception as e:
+                print("[WARN] screenshot thumbnail failed:", shot_id, e)
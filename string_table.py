@@ -0,0 +1,202 @@
+"""
+string_table.py
+Interned strings for the URLs, titles and favicons repeated across
+presence, history and screenshot rows.
+
+Rows store a small integer id per string field instead of the string;
+the id <-> string table lives in SQLite so every worker agrees on it,
+with a bounded in-process cache in front:
+
+    STRINGS = StringTable(DB_PATH)
+    row = STRINGS.encode({"url": "https://docs.google.com/", "ts": 1}, ("url",))
+    # -> {"url": 17, "ts": 1}
+    STRINGS.decode(row, ("url",))   # -> {"url": "https://docs.google.com/", "ts": 1}
+
+Only non-empty strings are interned; None, "" and values that are already
+ids pass through encode(), and decode() leaves strings alone, so rows
+written before interning read back unchanged.
+
+Strings no row points at any more are collected by sweep(), which the
+caller feeds with the ids still in use. An id is only deleted after it
+has been unused for longer than any worker's cache may still hand it out,
+and ids are never reused, so a late reference never reads the wrong string.
+"""
+
+import sqlite3
+import threading
+import time
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS string_table (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        s TEXT NOT NULL UNIQUE
+    )
+    """,
+    # Ids seen unreferenced by sweep(), and since when.
+    """
+    CREATE TABLE IF NOT EXISTS string_table_unused (
+        id INTEGER PRIMARY KEY,
+        since INTEGER NOT NULL
+    )
+    """,
+]
+
+
+class StringTable:
+    def __init__(self, db_path, cache_size=200000, cache_ttl=3600):
+        self.db_path = db_path
+        self.cache_size = int(cache_size)
+        self.cache_ttl = float(cache_ttl)  # sweep()'s grace must be longer
+        self._ids = {}   # string -> id
+        self._strs = {}  # id -> string
+        self._cached_at = time.monotonic()
+        self._lock = threading.Lock()
+        con = self._db()
+        try:
+            for stmt in _SCHEMA:
+                con.execute(stmt)
+            con.commit()
+        finally:
+            con.close()
+
+    def _db(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _expire_cache_locked(self):
+        if time.monotonic() - self._cached_at > self.cache_ttl:
+            self._ids.clear()
+            self._strs.clear()
+            self._cached_at = time.monotonic()
+
+    def _remember_locked(self, pairs):
+        if len(self._ids) + len(pairs) > self.cache_size:
+            self._ids.clear()
+            self._strs.clear()
+            self._cached_at = time.monotonic()
+        for i, s in pairs:
+            self._ids[s] = i
+            self._strs[i] = s
+
+    # ---------- strings -> ids ----------
+    def intern_many(self, strings):
+        """{string: id} for every non-empty string in `strings`."""
+        wanted = {s for s in strings if isinstance(s, str) and s}
+        with self._lock:
+            self._expire_cache_locked()
+            out = {s: self._ids[s] for s in wanted if s in self._ids}
+        missing = list(wanted - set(out))
+        if missing:
+            con = self._db()
+            try:
+                con.executemany("INSERT OR IGNORE INTO string_table(s) VALUES (?)", [(s,) for s in missing])
+                con.commit()
+                pairs = []
+                for i in range(0, len(missing), 500):
+                    chunk = missing[i:i + 500]
+                    pairs += con.execute(
+                        "SELECT id, s FROM string_table WHERE s IN (%s)" % ",".join("?" * len(chunk)), chunk
+                    ).fetchall()
+                # In use again: a pending sweep must not delete them.
+                con.executemany("DELETE FROM string_table_unused WHERE id=?", [(i,) for i, _ in pairs])
+                con.commit()
+            finally:
+                con.close()
+            with self._lock:
+                self._remember_locked(pairs)
+            out.update((s, i) for i, s in pairs)
+        return out
+
+    def intern(self, s):
+        return self.intern_many([s]).get(s, s)
+
+    # ---------- ids -> strings ----------
+    def lookup_many(self, ids):
+        """{id: string} for every id in `ids` that is known."""
+        wanted = {i for i in ids if isinstance(i, int) and not isinstance(i, bool)}
+        with self._lock:
+            self._expire_cache_locked()
+            out = {i: self._strs[i] for i in wanted if i in self._strs}
+        missing = list(wanted - set(out))
+        if missing:
+            con = self._db()
+            try:
+                pairs = []
+                for i in range(0, len(missing), 500):
+                    chunk = missing[i:i + 500]
+                    pairs += con.execute(
+                        "SELECT id, s FROM string_table WHERE id IN (%s)" % ",".join("?" * len(chunk)), chunk
+                    ).fetchall()
+            finally:
+                con.close()
+            with self._lock:
+                self._remember_locked(pairs)
+            out.update(pairs)
+        return out
+
+    def lookup(self, i):
+        return self.lookup_many([i]).get(i, i) if isinstance(i, int) else i
+
+    # ---------- expiry ----------
+    def sweep(self, live, after=0, limit=1000, grace=86400, now=None):
+        """Collect the (up to `limit`) ids after `after` that are not in `live`.
+
+        An unreferenced id is marked the first time it is seen and
+        deleted by a later sweep once it has stayed unreferenced for
+        `grace` seconds, which must exceed cache_ttl; interning or
+        referencing it again clears the mark. Returns (removed, cursor):
+        pass cursor as `after` next time, 0 meaning start over.
+        """
+        now = int(now or time.time())
+        con = self._db()
+        try:
+            # Serialized against intern_many() clearing marks.
+            con.execute("BEGIN IMMEDIATE")
+            ids = [i for (i,) in con.execute(
+                "SELECT id FROM string_table WHERE id>? ORDER BY id LIMIT ?", (int(after), int(limit))
+            )]
+            unused = [i for i in ids if i not in live]
+            con.executemany("DELETE FROM string_table_unused WHERE id=?", [(i,) for i in ids if i in live])
+            con.executemany("INSERT OR IGNORE INTO string_table_unused(id, since) VALUES (?,?)",
+                            [(i, now) for i in unused])
+            gone = []
+            for i in range(0, len(unused), 500):
+                chunk = unused[i:i + 500]
+                gone += [j for (j,) in con.execute(
+                    "SELECT id FROM string_table_unused WHERE since<=? AND id IN (%s)" % ",".join("?" * len(chunk)),
+                    [now - int(grace)] + chunk,
+                )]
+            con.executemany("DELETE FROM string_table WHERE id=?", [(i,) for i in gone])
+            con.executemany("DELETE FROM string_table_unused WHERE id=?", [(i,) for i in gone])
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        finally:
+            con.close()
+        if gone:
+            with self._lock:
+                for i in gone:
+                    s = self._strs.pop(i, None)
+                    if self._ids.get(s) == i:
+                        del self._ids[s]
+        return len(gone), (ids[-1] if len(ids) == limit else 0)
+
+    # ---------- rows ----------
+    def encode_rows(self, rows, fields):
+        """Copies of `rows` (dicts) with `fields` replaced by ids."""
+        ids = self.intern_many(r.get(f) for r in rows for f in fields)
+        return [dict(r, **{f: ids[r[f]] for f in fields if isinstance(r.get(f), str) and r[f] in ids})
+                for r in rows]
+
+    def decode_rows(self, rows, fields):
+        """Copies of `rows` (dicts) with the ids in `fields` replaced by strings."""
+        strs = self.lookup_many(r.get(f) for r in rows for f in fields)
+        return [dict(r, **{f: strs[r[f]] for f in fields if isinstance(r.get(f), int) and r[f] in strs})
+                for r in rows]
+
+    def encode(self, row, fields):
+        return self.encode_rows([row], fields)[0]
+
+    def decode(self, row, fields):
+        return self.decode_rows([row], fields)[0]